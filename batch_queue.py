@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+多台機器分散產生報告的工作佇列（SQLite，放在共用檔案系統上）
+一台機器受限於自己的核心數與對外 IP 的速率限制；把 jobs.jsonl 放進佇列後，
+各主機上的 worker 以租約 (lease) 領取工作，交給 report_pipeline 排程：
+- 領取時設定租約到期時間，處理期間背景執行緒定期延長（heartbeat）
+- worker 當機或斷線時租約過期，其他 worker 會重新領取（最多 QUEUE_MAX_ATTEMPTS 次）
+- 回報結果時確認租約仍屬於自己，過期後才完成的舊 worker 結果不會覆蓋新結果
+- 所有結果合併成一份 manifest
+
+SQLite 需要可靠的檔案鎖；NFS 等網路檔案系統請確認 lockd 正常，或在其中一台主機的本機磁碟建立佇列再共用
+
+用法：
+    python batch_queue.py enqueue <queue.db> <jobs.jsonl>
+    python batch_queue.py work <queue.db> [--worker-id ID] [--batch N] [--exit-when-empty]
+    python batch_queue.py status <queue.db>
+    python batch_queue.py manifest <queue.db> [--out manifest.json]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+
+QUEUE_LEASE_SECONDS = float(os.getenv("QUEUE_LEASE_SECONDS", "120"))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+# 每次領取的工作數；同一批在本機由 report_pipeline 交錯執行
+QUEUE_BATCH = int(os.getenv("QUEUE_BATCH", "8"))
+QUEUE_IDLE_SECONDS = float(os.getenv("QUEUE_IDLE_SECONDS", "5"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY,
+    spec          TEXT NOT NULL,
+    status        TEXT NOT NULL DEFAULT 'pending',  -- pending / leased / done / failed
+    owner         TEXT,
+    lease_expires REAL,
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    result        TEXT,
+    updated_at    REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, lease_expires);
+"""
+
+
+def connect(path):
+    # isolation_level=None：交易由 BEGIN IMMEDIATE 明確控制，領取時先取得寫入鎖
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA busy_timeout=60000")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def enqueue(conn, specs):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany("INSERT INTO jobs (spec, updated_at) VALUES (?, ?)",
+                         [(json.dumps(spec, ensure_ascii=False), now) for spec in specs])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(specs)
+
+
+def claim(conn, owner, limit):
+    """領取最多 limit 個待處理或租約已過期的工作，回傳 [(id, spec)]"""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 已用完重試次數而租約又過期的工作標記為失敗
+        conn.execute(
+            "UPDATE jobs SET status = 'failed', owner = NULL, updated_at = ?, "
+            "result = json_object('error', 'Lease expired after ' || attempts || ' attempts') "
+            "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+            (now, now, QUEUE_MAX_ATTEMPTS),
+        )
+        rows = conn.execute(
+            "SELECT id, spec FROM jobs WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+            "ORDER BY id LIMIT ?",
+            (now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+            "updated_at = ? WHERE id = ?",
+            [(owner, now + QUEUE_LEASE_SECONDS, now, row["id"]) for row in rows],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [(row["id"], json.loads(row["spec"])) for row in rows]
+
+
+def heartbeat(conn, owner, ids):
+    """延長仍屬於自己的租約，回傳仍持有的工作數"""
+    now = time.time()
+    marks = ",".join("?" * len(ids))
+    cur = conn.execute(
+        f"UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE owner = ? AND status = 'leased' AND id IN ({marks})",
+        [now + QUEUE_LEASE_SECONDS, now, owner, *ids],
+    )
+    return cur.rowcount
+
+
+def complete(conn, owner, job_id, result):
+    """回報結果；租約已被其他 worker 接手時回傳 False 並捨棄結果"""
+    status = "failed" if "error" in result else "done"
+    cur = conn.execute(
+        "UPDATE jobs SET status = ?, result = ?, owner = NULL, lease_expires = NULL, updated_at = ? "
+        "WHERE id = ? AND owner = ? AND status = 'leased'",
+        (status, json.dumps(result, ensure_ascii=False), time.time(), job_id, owner),
+    )
+    return cur.rowcount == 1
+
+
+class Heartbeat:
+    """背景執行緒每 1/3 租約時間延長一次目前持有的工作"""
+
+    def __init__(self, path, owner, ids):
+        self.path = path
+        self.owner = owner
+        self.ids = list(ids)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="queue-heartbeat", daemon=True)
+
+    def _run(self):
+        conn = connect(self.path)
+        while not self._stop.wait(QUEUE_LEASE_SECONDS / 3):
+            try:
+                held = heartbeat(conn, self.owner, self.ids)
+                if held < len(self.ids):
+                    print(f"[Queue] lost {len(self.ids) - held} lease(s)", file=sys.stderr)
+            except sqlite3.Error as e:
+                print(f"[Queue] heartbeat failed: {e}", file=sys.stderr)
+        conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def work(path, owner=None, batch=None, exit_when_empty=False):
+    """領取 -> 執行 -> 回報，直到佇列清空（exit_when_empty）或被中斷"""
+    import report_pipeline
+    owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+    conn = connect(path)
+    processed = 0
+    while True:
+        claimed = claim(conn, owner, batch or QUEUE_BATCH)
+        if not claimed:
+            if exit_when_empty and not pending_count(conn):
+                break
+            time.sleep(QUEUE_IDLE_SECONDS)
+            continue
+        print(f"[Queue] {owner} claimed {len(claimed)} job(s)", file=sys.stderr)
+        jobs, results = [], {}
+        for job_id, spec in claimed:
+            try:
+                jobs.append((job_id, report_pipeline.job_from_spec(spec)))
+            except (KeyError, TypeError) as e:
+                results[job_id] = {"error": f"Invalid job spec: {e}"}
+        with Heartbeat(path, owner, [job_id for job_id, _ in claimed]):
+            if jobs:
+                outcomes = report_pipeline.run_jobs([job for _, job in jobs])
+                results.update({job_id: result for (job_id, _), result in zip(jobs, outcomes)})
+        for job_id, result in results.items():
+            result["worker"] = owner
+            if not complete(conn, owner, job_id, result):
+                print(f"[Queue] job {job_id}: lease was taken over; result discarded", file=sys.stderr)
+        processed += len(results)
+    conn.close()
+    return processed
+
+
+def pending_count(conn):
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased')").fetchone()[0]
+
+
+def status(conn):
+    counts = {row["status"]: row["n"] for row in conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+    workers = [dict(row) for row in conn.execute(
+        "SELECT owner, COUNT(*) AS jobs, MIN(lease_expires) AS next_expiry FROM jobs "
+        "WHERE status = 'leased' GROUP BY owner")]
+    return {"counts": counts, "workers": workers}
+
+
+def manifest(conn):
+    """依加入順序合併所有工作的結果"""
+    entries = []
+    for row in conn.execute("SELECT id, spec, status, attempts, result FROM jobs ORDER BY id"):
+        entries.append({
+            "id": row["id"],
+            "spec": json.loads(row["spec"]),
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+        })
+    done = sum(1 for e in entries if e["status"] == "done")
+    return {"jobs": len(entries), "done": done, "failed": sum(1 for e in entries if e["status"] == "failed"),
+            "entries": entries}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Distributed report generation queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_enqueue = sub.add_parser("enqueue")
+    p_enqueue.add_argument("db")
+    p_enqueue.add_argument("jobs")
+    p_work = sub.add_parser("work")
+    p_work.add_argument("db")
+    p_work.add_argument("--worker-id")
+    p_work.add_argument("--batch", type=int)
+    p_work.add_argument("--exit-when-empty", action="store_true")
+    p_status = sub.add_parser("status")
+    p_status.add_argument("db")
+    p_manifest = sub.add_parser("manifest")
+    p_manifest.add_argument("db")
+    p_manifest.add_argument("--out")
+    args = parser.parse_args(argv)
+
+    if args.command == "enqueue":
+        with open(args.jobs, "r", encoding="utf-8") as f:
+            specs = [json.loads(line) for line in f if line.strip()]
+        print(json.dumps({"enqueued": enqueue(connect(args.db), specs)}))
+    elif args.command == "work":
+        try:
+            processed = work(args.db, args.worker_id, args.batch, args.exit_when_empty)
+        except KeyboardInterrupt:
+            # 未完成的工作租約到期後由其他 worker 接手
+            processed = None
+        print(json.dumps({"processed": processed}))
+    elif args.command == "status":
+        print(json.dumps(status(connect(args.db))))
+    else:
+        result = manifest(connect(args.db))
+        if args.out:
+            tmp = f"{args.out}.tmp{os.getpid()}"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, args.out)
+            print(json.dumps({"manifest": args.out, "jobs": result["jobs"], "done": result["done"],
+                              "failed": result["failed"]}))
+        else:
+            print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
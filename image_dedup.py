@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+同一病人近似重複照片的偵測（感知雜湊）
+重拍或重新上傳的照片通常只差幾個像素或 JPEG 重新壓縮，位元組完全不同，
+因此改用縮小灰階圖計算的 pHash / dHash 比對漢明距離；
+距離在 DEDUP_MAX_DISTANCE 內時沿用之前的推論結果（與同語言的 AI 建議），不再呼叫付費 API
+
+索引：<DEDUP_DIR>/<patientId>.jsonl，每行 {"hash", "image", "record_id", "key"}
+結果：<DEDUP_DIR>/<patientId>/<key>.json，{"item": 推論結果, "advice": {lang: 建議}}
+"""
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+import memory_budget
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEDUP_DIR = os.getenv("DEDUP_DIR", os.path.join(BASE_DIR, "outputs", "dedup"))
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+# phash：對重新壓縮、輕微亮度變化較穩定；dhash：更快，對小幅平移較敏感
+DEDUP_HASH = os.getenv("DEDUP_HASH", "phash")
+# 64 位元雜湊的最大漢明距離（0 = 只接受視覺上完全相同）
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+
+_lock = threading.Lock()
+
+
+def _gray(path, data=None):
+    # 以 1/4 解析度解碼，雜湊只需要 32x32，不必解碼整張圖
+    try:
+        img = memory_budget.decode_image(path, cv2.IMREAD_REDUCED_GRAYSCALE_4, data)
+    except cv2.error:
+        # 小於 4 像素的圖無法縮小解碼
+        img = None
+    if img is None:
+        img = memory_budget.decode_image(path, cv2.IMREAD_GRAYSCALE, data)
+    if img is None:
+        raise ValueError(f"Could not read image: {path}")
+    return img
+
+
+def _bits_to_int(bits):
+    return int("".join("1" if b else "0" for b in bits.flatten()), 2)
+
+
+def phash(img):
+    """32x32 DCT 的左上 8x8 低頻係數（不含 DC）與中位數比較 -> 64 位元"""
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return _bits_to_int(low > np.median(low.flatten()[1:]))
+
+
+def dhash(img):
+    """9x8 縮圖相鄰像素的亮度梯度 -> 64 位元"""
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+HASHES = {"phash": phash, "dhash": dhash}
+
+
+def image_hash(path, method=None, data=None):
+    method = method or DEDUP_HASH
+    if method not in HASHES:
+        raise ValueError(f"DEDUP_HASH must be one of: {', '.join(HASHES)}")
+    return f"{method}:{HASHES[method](_gray(path, data)):016x}"
+
+
+def distance(a, b):
+    """兩個雜湊的漢明距離；方法不同時回傳 None"""
+    method_a, value_a = a.split(":", 1)
+    method_b, value_b = b.split(":", 1)
+    if method_a != method_b:
+        return None
+    return bin(int(value_a, 16) ^ int(value_b, 16)).count("1")
+
+
+def _safe(patient_id):
+    safe = "".join(ch for ch in str(patient_id) if ch.isalnum() or ch in "-_")
+    if not safe:
+        raise ValueError(f"Invalid patient id: {patient_id!r}")
+    return safe
+
+
+def _index_path(patient_id):
+    return os.path.join(DEDUP_DIR, f"{_safe(patient_id)}.jsonl")
+
+
+def _result_path(patient_id, key):
+    return os.path.join(DEDUP_DIR, _safe(patient_id), f"{key}.json")
+
+
+def find(patient_id, hash_value, max_distance=None):
+    """在同一病人已分析過的照片中找最接近的一張；回傳 (entry, 距離) 或 (None, None)"""
+    max_distance = DEDUP_MAX_DISTANCE if max_distance is None else max_distance
+    path = _index_path(patient_id)
+    if not os.path.exists(path):
+        return None, None
+    best, best_distance = None, None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            d = distance(hash_value, entry["hash"])
+            if d is None or d > max_distance or not os.path.exists(_result_path(patient_id, entry["key"])):
+                continue
+            if best_distance is None or d < best_distance:
+                best, best_distance = entry, d
+    return best, best_distance
+
+
+def _encode_item(item):
+    """推論結果 -> 可存成 JSON 的 dict（本地後端的 numpy 影像轉成 PNG base64）"""
+    encoded = {}
+    for key, value in item.items():
+        if isinstance(value, np.ndarray):
+            ok, buf = cv2.imencode(".png", value)
+            value = base64.b64encode(buf.tobytes()).decode("ascii") if ok else None
+        encoded[key] = value
+    return encoded
+
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def remember(patient_id, hash_value, item, image_path=None, record_id=None):
+    """記錄新分析的照片與推論結果，回傳結果的 key"""
+    key = hashlib.sha1(f"{hash_value}:{image_path}:{time.time()}".encode("utf-8")).hexdigest()[:16]
+    result_path = _result_path(patient_id, key)
+    os.makedirs(os.path.dirname(result_path), exist_ok=True)
+    _write_json(result_path, {"item": _encode_item(item), "advice": {}})
+    entry = {"hash": hash_value, "image": image_path, "record_id": record_id, "key": key,
+             "created_at": int(time.time())}
+    with _lock, open(_index_path(patient_id), "a", encoding="utf-8") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(entry) + "\n")
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return key
+
+
+def load_result(patient_id, key):
+    with open(_result_path(patient_id, key), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def remember_advice(patient_id, key, lang, advice):
+    """把 AI 建議存到對應的推論結果旁，之後同一張（近似）照片、同語言直接沿用"""
+    with _lock:
+        result = load_result(patient_id, key)
+        result["advice"][lang] = advice
+        _write_json(_result_path(patient_id, key), result)
+
+
+def lookup(patient_id, image_path, data=None):
+    """
+    計算照片雜湊並查詢；回傳 dict：
+    {"hash", "key", "reused", "distance", "matched_image", "item"}（未命中時 key / item 為 None）
+    data：記憶體中的編碼影像（此時 image_path 只作為名稱）
+    """
+    hash_value = image_hash(image_path, data=data)
+    entry, d = find(patient_id, hash_value)
+    if entry is None:
+        print(f"[Dedup] {os.path.basename(image_path)}: no near-duplicate for patient {patient_id}", file=sys.stderr)
+        return {"hash": hash_value, "key": None, "reused": False, "distance": None,
+                "matched_image": None, "item": None}
+    print(f"[Dedup] {os.path.basename(image_path)}: reusing {entry.get('image')} "
+          f"(distance {d} <= {DEDUP_MAX_DISTANCE})", file=sys.stderr)
+    return {"hash": hash_value, "key": entry["key"], "reused": True, "distance": d,
+            "matched_image": entry.get("image"), "item": load_result(patient_id, entry["key"])["item"]}
+
+
+if __name__ == "__main__":
+    # 用法：python image_dedup.py <image_a> <image_b>  ->  兩張照片的雜湊距離
+    a, b = image_hash(sys.argv[1]), image_hash(sys.argv[2])
+    print(json.dumps({"a": a, "b": b, "distance": distance(a, b), "max_distance": DEDUP_MAX_DISTANCE}))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+上傳照片的多解析度衍生圖
+每張原圖（最大 10 MB）只解碼一次，產生 thumb / preview / inference 三個尺寸，
+存在同目錄的 derivatives/ 下並附 manifest；各階段改用「長邊足夠的最小衍生圖」，
+不必每次都讀取、上傳原圖：
+
+    public/<patientId>/photo.jpg
+    public/<patientId>/derivatives/photo.jpg.json          manifest
+    public/<patientId>/derivatives/photo.jpg.thumb.webp
+    public/<patientId>/derivatives/photo.jpg.preview.webp
+    public/<patientId>/derivatives/photo.jpg.inference.jpg
+
+檔名包含原圖副檔名，photo.jpg 與 photo.png 的衍生圖不會互相覆蓋
+
+原圖比某個尺寸還小時不放大，該尺寸直接指向原圖
+原圖的大小或修改時間改變後 manifest 視為過期，重新產生
+
+用法（批次補產生既有照片）：
+    python image_derivatives.py <目錄或檔案> [...] [--force] [--workers N]
+"""
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+
+DERIVATIVES_DIRNAME = "derivatives"
+# 名稱 -> (長邊像素, 副檔名, imwrite 參數)
+# 推論用 JPEG（各推論後端都接受）；縮圖與預覽用 WebP，同畫質下檔案較小
+LEVELS = {
+    "thumb": (int(os.getenv("DERIVATIVE_THUMB_SIDE", "256")), ".webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    "preview": (int(os.getenv("DERIVATIVE_PREVIEW_SIDE", "1280")), ".webp", [cv2.IMWRITE_WEBP_QUALITY, 85]),
+    "inference": (int(os.getenv("DERIVATIVE_INFERENCE_SIDE", "1600")), ".jpg", [cv2.IMWRITE_JPEG_QUALITY, 92]),
+}
+# 推論改用衍生圖（0 = 一律上傳原圖）
+INFERENCE_DERIVATIVE = os.getenv("INFERENCE_DERIVATIVE", "1") == "1"
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", str(os.cpu_count() or 2)))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def _paths(image_path):
+    folder, name = os.path.split(os.path.abspath(image_path))
+    out_dir = os.path.join(folder, DERIVATIVES_DIRNAME)
+    return out_dir, os.path.join(out_dir, f"{name}.json")
+
+
+def _source_info(image_path):
+    st = os.stat(image_path)
+    return {"path": os.path.abspath(image_path), "bytes": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def load_manifest(image_path):
+    """讀取 manifest；不存在、原圖已變更或衍生圖遺失時回傳 None"""
+    _, manifest_path = _paths(image_path)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        source = _source_info(image_path)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("source", {}).get("bytes") != source["bytes"] or \
+            manifest["source"].get("mtime_ns") != source["mtime_ns"]:
+        return None
+    if not all(os.path.exists(level["path"]) for level in manifest["levels"].values()):
+        return None
+    return manifest
+
+
+def generate(image_path, force=False):
+    """產生（或沿用仍有效的）衍生圖並回傳 manifest"""
+    if not force:
+        manifest = load_manifest(image_path)
+        if manifest is not None:
+            return manifest
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not read image: {image_path}")
+    out_dir, manifest_path = _paths(image_path)
+    os.makedirs(out_dir, exist_ok=True)
+    basename = os.path.basename(image_path)
+    h, w = img.shape[:2]
+    source = dict(_source_info(image_path), width=w, height=h)
+
+    levels = {}
+    current = img
+    # 由大到小逐級縮小（金字塔），每一級只從上一級縮，不必每次從原圖開始
+    for name, (side, ext, params) in sorted(LEVELS.items(), key=lambda kv: -kv[1][0]):
+        if side >= max(h, w):
+            levels[name] = {"path": source["path"], "width": w, "height": h, "bytes": source["bytes"],
+                            "original": True}
+            continue
+        scale = side / max(current.shape[:2])
+        current = cv2.resize(current, (max(1, round(current.shape[1] * scale)), max(1, round(current.shape[0] * scale))),
+                             interpolation=cv2.INTER_AREA)
+        path = os.path.join(out_dir, f"{basename}.{name}{ext}")
+        if not cv2.imwrite(path, current, params):
+            raise ValueError(f"Could not write derivative: {path}")
+        levels[name] = {"path": path, "width": current.shape[1], "height": current.shape[0],
+                        "bytes": os.path.getsize(path), "original": False}
+
+    manifest = {"source": source, "levels": levels}
+    tmp = f"{manifest_path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_path)
+    return manifest
+
+
+def pick(image_path, min_side, create=True):
+    """
+    回傳長邊 >= min_side 的最小衍生圖路徑；沒有合適的衍生圖時回傳原圖
+    create=False 時只使用既有的 manifest，不在這裡產生
+    """
+    manifest = load_manifest(image_path)
+    if manifest is None and create:
+        try:
+            manifest = generate(image_path)
+        except Exception as e:
+            print(f"[Derivatives] {os.path.basename(image_path)}: {e}; using original", file=sys.stderr)
+            return image_path
+    if manifest is None:
+        return image_path
+    fits = [level for level in manifest["levels"].values() if max(level["width"], level["height"]) >= min_side]
+    if not fits:
+        return image_path
+    return min(fits, key=lambda level: level["bytes"])["path"]
+
+
+def for_stage(image_path, level, create=True):
+    """依衍生圖名稱（thumb / preview / inference）取得該階段要讀的檔案"""
+    return pick(image_path, LEVELS[level][0], create)
+
+
+def _generate_one(args):
+    path, force = args
+    try:
+        manifest = generate(path, force)
+        return path, sum(level["bytes"] for level in manifest["levels"].values() if not level["original"]), None
+    except Exception as e:
+        return path, 0, str(e)
+
+
+def iter_images(targets):
+    for target in targets:
+        if os.path.isfile(target):
+            yield target
+            continue
+        for folder, dirs, files in os.walk(target):
+            dirs[:] = [d for d in dirs if d != DERIVATIVES_DIRNAME]
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(folder, name)
+
+
+def generate_all(targets, force=False, workers=None):
+    """以行程池平行處理整批照片，回傳 {"images", "failed", "derivative_bytes"}"""
+    paths = list(iter_images(targets))
+    summary = {"images": len(paths), "failed": [], "derivative_bytes": 0}
+    with ProcessPoolExecutor(workers or DERIVATIVE_WORKERS) as pool:
+        for path, nbytes, error in pool.map(_generate_one, [(p, force) for p in paths], chunksize=4):
+            if error:
+                summary["failed"].append({"image": path, "error": error})
+                print(f"[Derivatives] {path}: {error}", file=sys.stderr)
+            summary["derivative_bytes"] += nbytes
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate thumbnail / preview / inference derivatives")
+    parser.add_argument("targets", nargs="+")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+    print(json.dumps(generate_all(args.targets, args.force, args.workers)))
+
+
+if __name__ == "__main__":
+    main()
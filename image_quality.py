@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+推論前的影像品質檢查（毫秒級，僅用 OpenCV 向量化運算）
+模糊、曝光不足 / 過度或解析度太低的照片在呼叫付費的推論與 LLM 之前就擋下或標記：
+- resolution：短邊像素數
+- blur：縮小灰階圖的 Laplacian 變異數（越小越模糊）
+- exposure：灰階直方圖的平均亮度與過暗 / 過亮像素比例
+
+QUALITY_GATE=reject（預設）拒絕不合格照片；flag 只標記原因並照常分析；off 不檢查
+"""
+import os
+import sys
+import json
+import time
+
+import cv2
+import numpy as np
+
+import memory_budget
+
+QUALITY_GATE = os.getenv("QUALITY_GATE", "reject")
+QUALITY_MIN_SIDE = int(os.getenv("QUALITY_MIN_SIDE", "480"))
+QUALITY_MIN_SHARPNESS = float(os.getenv("QUALITY_MIN_SHARPNESS", "60"))
+QUALITY_MIN_BRIGHTNESS = float(os.getenv("QUALITY_MIN_BRIGHTNESS", "50"))
+QUALITY_MAX_BRIGHTNESS = float(os.getenv("QUALITY_MAX_BRIGHTNESS", "220"))
+# 過暗（<16）或過亮（>240）像素超過此比例視為曝光不良
+QUALITY_MAX_CLIPPED = float(os.getenv("QUALITY_MAX_CLIPPED", "0.4"))
+# 模糊與曝光在固定大小的縮圖上計算，結果不受原圖解析度影響、耗時固定
+ANALYSIS_SIDE = 512
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                 (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)]
+
+
+def _reason(code, message, value, threshold):
+    return {"code": code, "message": message, "value": round(float(value), 3), "threshold": threshold}
+
+
+def _read_gray(image_path, data=None):
+    """
+    回傳 (灰階影像, 原圖寬, 原圖高)
+    原圖尺寸從檔頭讀取，大圖以 JPEG DCT 縮小解碼，只解碼到略大於 ANALYSIS_SIDE
+    """
+    try:
+        dims = memory_budget.image_dimensions(image_path, data)
+    except OSError:
+        return None, 0, 0
+    flag = cv2.IMREAD_GRAYSCALE
+    if dims:
+        for factor, reduced in REDUCED_FLAGS:
+            if max(dims) // factor >= ANALYSIS_SIDE:
+                flag = reduced
+                break
+    img = memory_budget.decode_image(image_path, flag, data)
+    if img is None:
+        return None, 0, 0
+    w, h = dims if dims else (img.shape[1], img.shape[0])
+    return img, w, h
+
+
+def check(image_path, data=None):
+    """
+    回傳 {"ok", "reasons": [{"code", "message", "value", "threshold"}], "metrics", "elapsed_ms"}
+    code：unreadable / low_resolution / blurry / underexposed / overexposed
+    data：記憶體中的編碼影像（此時 image_path 只作為名稱）
+    """
+    started = time.perf_counter()
+    img, w, h = _read_gray(image_path, data)
+    if img is None:
+        return {"ok": False, "reasons": [_reason("unreadable", "Image could not be decoded", 0, None)],
+                "metrics": {}, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+    scale = ANALYSIS_SIDE / max(img.shape[:2])
+    small = cv2.resize(img, (max(1, int(img.shape[1] * scale)), max(1, int(img.shape[0] * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1 else img
+
+    sharpness = cv2.Laplacian(small, cv2.CV_64F).var()
+    hist = cv2.calcHist([small], [0], None, [256], [0, 256]).ravel() / small.size
+    brightness = float(np.dot(hist, np.arange(256)))
+    dark = float(hist[:16].sum())
+    bright = float(hist[241:].sum())
+
+    reasons = []
+    if min(h, w) < QUALITY_MIN_SIDE:
+        reasons.append(_reason("low_resolution", f"Image is {w}x{h}; shorter side must be at least "
+                               f"{QUALITY_MIN_SIDE}px", min(h, w), QUALITY_MIN_SIDE))
+    if sharpness < QUALITY_MIN_SHARPNESS:
+        reasons.append(_reason("blurry", "Image is blurry or out of focus", sharpness, QUALITY_MIN_SHARPNESS))
+    if brightness < QUALITY_MIN_BRIGHTNESS or dark > QUALITY_MAX_CLIPPED:
+        reasons.append(_reason("underexposed", "Image is too dark", brightness, QUALITY_MIN_BRIGHTNESS))
+    elif brightness > QUALITY_MAX_BRIGHTNESS or bright > QUALITY_MAX_CLIPPED:
+        reasons.append(_reason("overexposed", "Image is too bright", brightness, QUALITY_MAX_BRIGHTNESS))
+
+    return {
+        "ok": not reasons,
+        "reasons": reasons,
+        "metrics": {
+            "width": w,
+            "height": h,
+            "sharpness": round(float(sharpness), 2),
+            "brightness": round(brightness, 2),
+            "dark_fraction": round(dark, 4),
+            "bright_fraction": round(bright, 4),
+        },
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def describe(result):
+    """品質檢查結果 -> 給使用者看的多行文字"""
+    return "\n".join(f"- {r['message']} ({r['code']})" for r in result["reasons"])
+
+
+if __name__ == "__main__":
+    # 用法：python image_quality.py <image> [...]
+    for path in sys.argv[1:]:
+        print(json.dumps(dict(check(path), image=path)))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+牙菌斑分割推論後端
+run_roboflow 透過此模組取得 polygon_visualization / mask_visualization，
+後端由 INFERENCE_BACKEND 環境變數決定（可用逗號串接，依序嘗試）：
+- roboflow：serverless Roboflow workflow（預設）
+- onnx：本地 ONNX 分割模型（OpenCV DNN，CPU）
+- color：本地顏色閾值分割（適用於牙菌斑顯示劑染色後的照片）
+例如 INFERENCE_BACKEND=roboflow,color 可在離線時自動改用本地分割
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+import requests
+
+import resilience
+import memory_budget
+from plaque_geometry import PLAQUE_COLOR
+
+VISUALIZATION_KEYS = ["polygon_visualization", "mask_visualization"]
+
+OUTLINE_COLOR = (0, 255, 0)
+
+
+class InferenceBackend:
+    """後端介面：infer() 回傳與 Roboflow workflow 結果相同鍵名的 dict"""
+
+    name = "base"
+
+    def infer(self, image_path, data=None):
+        """data：記憶體中的編碼影像（例如 MongoDB 的 BSON Buffer），此時 image_path 只作為名稱"""
+        raise NotImplementedError
+
+
+class RoboflowBackend(InferenceBackend):
+    """Serverless Roboflow workflow；回傳值為 base64 字串"""
+
+    name = "roboflow"
+    api_url = "https://serverless.roboflow.com"
+
+    def __init__(self, api_key=None, workspace=None, workflow_id=None):
+        self.api_key = api_key if api_key is not None else os.getenv("ROBOFLOW_API_KEY", "")
+        self.workspace = workspace if workspace is not None else os.getenv("WORKSPACE_NAME", "")
+        self.workflow_id = workflow_id if workflow_id is not None else os.getenv("WORKFLOW_ID", "")
+
+    def infer(self, image_path, data=None):
+        # 檢查必要的環境變數
+        if not self.api_key:
+            raise ValueError("ROBOFLOW_API_KEY environment variable is not set")
+        if not self.workspace:
+            raise ValueError("WORKSPACE_NAME environment variable is not set")
+        if not self.workflow_id:
+            raise ValueError("WORKFLOW_ID environment variable is not set")
+
+        try:
+            from inference_sdk import InferenceHTTPClient
+        except ImportError:
+            # 如果 inference_sdk 不可用，使用 requests 直接調用 API
+            return self._infer_http(image_path, data)
+
+        try:
+            client = InferenceHTTPClient(api_url=self.api_url, api_key=self.api_key)
+            result = resilience.ROBOFLOW.call(lambda: client.run_workflow(
+                workspace_name=self.workspace,
+                workflow_id=self.workflow_id,
+                images={"image": image_path if data is None else memory_budget.decode_image(
+                    image_path, cv2.IMREAD_COLOR, data)},
+                use_cache=True
+            ))
+            return result[0]
+        except Exception as e:
+            raise Exception(f"Roboflow inference_sdk failed: {str(e)}") from e
+
+    def _infer_http(self, image_path, data=None):
+        try:
+            image_data = memory_budget.b64encode_file(image_path, data)
+
+            url = f"{self.api_url}/workflow/{self.workspace}/{self.workflow_id}"
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            }
+            payload = {
+                "image": f"data:image/jpeg;base64,{image_data}",
+                "use_cache": True
+            }
+
+            response = resilience.ROBOFLOW.post(url, headers=headers, json=payload)
+            response.raise_for_status()
+            result = response.json()
+            if isinstance(result, list) and len(result) > 0:
+                return result[0]
+            return {}
+        except requests.exceptions.RequestException as e:
+            error_msg = f"Roboflow API request failed: {str(e)}"
+            if hasattr(e, 'response') and e.response is not None:
+                try:
+                    error_detail = e.response.json()
+                    error_msg += f" - Response: {error_detail}"
+                except Exception:
+                    error_msg += f" - Status: {e.response.status_code}, Body: {e.response.text[:200]}"
+            raise Exception(error_msg) from e
+
+
+class LocalSegmentationBackend(InferenceBackend):
+    """本地後端共用部分：由二值遮罩產生與 Roboflow 相同的兩張視覺化圖"""
+
+    min_region_area = int(os.getenv("LOCAL_MIN_REGION_AREA", "30"))
+
+    def segment(self, img):
+        """回傳與 img 同尺寸的 uint8 遮罩（255 = 牙菌斑）"""
+        raise NotImplementedError
+
+    def infer(self, image_path, data=None):
+        img = memory_budget.decode_image(image_path, cv2.IMREAD_COLOR, data)
+        if img is None:
+            raise ValueError(f"Could not read image: {image_path}")
+        mask = self.segment(img)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        contours = [c for c in contours if cv2.contourArea(c) >= self.min_region_area]
+        mask = np.zeros_like(mask)
+        cv2.drawContours(mask, contours, -1, 255, thickness=cv2.FILLED)
+        item = render_visualizations(img, mask, contours)
+        # 與 Roboflow 實例分割相同格式的 predictions，供 plaque_geometry 取出結構化資料
+        h, w = mask.shape[:2]
+        item["predictions"] = {
+            "image": {"width": w, "height": h},
+            "predictions": [
+                {
+                    "class": "plaque",
+                    "confidence": 1.0,
+                    "points": [{"x": int(x), "y": int(y)} for x, y in c.reshape(-1, 2)],
+                }
+                for c in contours
+            ],
+        }
+        return item
+
+
+class ColorPlaqueBackend(LocalSegmentationBackend):
+    """
+    顏色閾值分割：牙菌斑顯示劑會將牙菌斑染成洋紅/紫色
+    閾值可用 LOCAL_PLAQUE_HSV_LOW / LOCAL_PLAQUE_HSV_HIGH（"h,s,v"）調整
+    """
+
+    name = "color"
+
+    def __init__(self, hsv_low=None, hsv_high=None):
+        self.hsv_low = np.array(hsv_low or _hsv_env("LOCAL_PLAQUE_HSV_LOW", "125,60,50"), dtype=np.uint8)
+        self.hsv_high = np.array(hsv_high or _hsv_env("LOCAL_PLAQUE_HSV_HIGH", "175,255,255"), dtype=np.uint8)
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+    def segment(self, img):
+        hsv = cv2.cvtColor(cv2.GaussianBlur(img, (5, 5), 0), cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, self.hsv_low, self.hsv_high)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel)
+
+
+class OnnxBackend(LocalSegmentationBackend):
+    """
+    本地 ONNX 語意分割模型（OpenCV DNN，CPU）
+    模型輸入為 RGB、[0,1]、LOCAL_MODEL_INPUT_SIZE 正方形；輸出為單通道牙菌斑機率圖
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_path=None, input_size=None, threshold=None):
+        self.model_path = model_path or os.getenv("LOCAL_MODEL_PATH", "")
+        self.input_size = int(input_size or os.getenv("LOCAL_MODEL_INPUT_SIZE", "640"))
+        self.threshold = float(threshold or os.getenv("LOCAL_MODEL_THRESHOLD", "0.5"))
+        self._net = None
+
+    @property
+    def net(self):
+        # 延遲載入並重用同一個網路物件
+        if self._net is None:
+            if not self.model_path or not os.path.exists(self.model_path):
+                raise ValueError(f"LOCAL_MODEL_PATH not found: {self.model_path or '(not set)'}")
+            self._net = cv2.dnn.readNetFromONNX(self.model_path)
+            self._net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+            self._net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        return self._net
+
+    def segment(self, img):
+        h, w = img.shape[:2]
+        blob = cv2.dnn.blobFromImage(img, 1 / 255.0, (self.input_size, self.input_size), swapRB=True)
+        self.net.setInput(blob)
+        out = np.squeeze(self.net.forward())
+        if out.ndim == 3:
+            # 多類別輸出：取第 1 類（0 為背景）
+            out = out[1] if out.shape[0] > 1 else out[0]
+        if out.min() < 0 or out.max() > 1:
+            out = 1 / (1 + np.exp(-out))
+        prob = cv2.resize(out.astype(np.float32), (w, h), interpolation=cv2.INTER_LINEAR)
+        return np.where(prob >= self.threshold, 255, 0).astype(np.uint8)
+
+
+def render_visualizations(img, mask, contours):
+    """
+    依遮罩繪製兩張視覺化圖（numpy BGR 陣列）
+    mask_visualization 背景轉為灰階，確保只有牙菌斑像素落在紫色範圍
+    """
+    gray = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+    mask_vis = gray
+    mask_vis[mask > 0] = PLAQUE_COLOR
+
+    polygon_vis = img.copy()
+    cv2.drawContours(polygon_vis, contours, -1, OUTLINE_COLOR, thickness=2)
+    return {
+        "polygon_visualization": polygon_vis,
+        "mask_visualization": mask_vis,
+    }
+
+
+def _hsv_env(name, default):
+    return [int(v) for v in os.getenv(name, default).split(",")]
+
+
+BACKENDS = {
+    "roboflow": RoboflowBackend,
+    "color": ColorPlaqueBackend,
+    "onnx": OnnxBackend,
+}
+_instances = {}
+
+
+def get_backend(name):
+    """取得（並快取）指定名稱的後端實例"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name} (choose from {', '.join(BACKENDS)})")
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
+
+
+def backend_chain():
+    names = os.getenv("INFERENCE_BACKEND", "roboflow")
+    return [n.strip() for n in names.split(",") if n.strip()]
+
+
+def run_inference(image_path, data=None):
+    """
+    依 INFERENCE_BACKEND 的順序執行推論，前一個後端失敗才嘗試下一個
+    回傳 (backend_name, item)；item 的值為 base64 字串或 numpy 影像
+    data：記憶體中的編碼影像；沒有來源檔案可放衍生圖，直接使用原圖
+    """
+    import image_derivatives
+    if image_derivatives.INFERENCE_DERIVATIVE and data is None:
+        # 上傳 / 解碼推論尺寸的衍生圖，不必每次都處理最大 10 MB 的原圖
+        image_path = image_derivatives.for_stage(image_path, "inference")
+    chain = backend_chain()
+    if not chain:
+        raise ValueError("No inference backend configured")
+    last_error = None
+    for name in chain:
+        try:
+            return name, get_backend(name).infer(image_path, data)
+        except Exception as e:
+            last_error = e
+            if name != chain[-1]:
+                print(f"[Inference] {name} backend failed, falling back: {e}", file=sys.stderr)
+    raise last_error
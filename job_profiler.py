@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+單一報告工作的效能剖析（預設關閉，關閉時不載入 cProfile / tracemalloc）
+啟用方式：generate_report.py --profile，或 REPORT_PROFILE=1（批次 jobs.jsonl 也可逐筆設定 "profile": true）
+
+每個工作輸出到 <pdf 檔名>_profile/：
+- job.prof         各階段 cProfile 合併後的 pstats（snakeviz / flameprof / gprof2dot 可直接載入）
+- stacks.folded    取樣式剖析的折疊堆疊（flamegraph.pl、speedscope 可直接載入）
+- allocations.txt  tracemalloc 各階段配置最多記憶體的程式行
+- <stage>.prof     個別階段的 pstats
+
+取樣只涵蓋主行程中的執行緒；批次模式送到行程池的 CPU 階段只有 cProfile 與 tracemalloc
+同一行程中剖析的階段逐一執行（一次只能有一個 cProfile），階段耗時會包含排隊時間
+"""
+import os
+import sys
+import time
+import threading
+import multiprocessing
+from collections import Counter
+
+REPORT_PROFILE = os.getenv("REPORT_PROFILE", "0") == "1"
+PROFILE_SAMPLE_MS = float(os.getenv("PROFILE_SAMPLE_MS", "5"))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "25"))
+# 只用到配置所在的那一行，多記錄外層堆疊只會增加剖析成本
+TRACEMALLOC_FRAMES = 1
+
+# 同一行程只能有一個 cProfile 啟用（Python 3.12+ 同時啟用會拋出
+# "Another profiling tool is already active"），剖析中的階段逐一執行
+_profile_lock = threading.Lock()
+
+
+def profile_dir_for(pdf_path):
+    return os.path.splitext(pdf_path)[0] + "_profile"
+
+
+def run_profiled(name, fn, ctx):
+    """以 cProfile + tracemalloc 執行一個階段；回傳 (階段結果, 配置統計)"""
+    import cProfile
+    import tracemalloc
+    with _profile_lock:
+        owned = not tracemalloc.is_tracing()
+        if owned:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        before = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        sampler_key = SAMPLER.attach(ctx["profile_dir"], name)
+        profiler.enable()
+        try:
+            result = fn(ctx)
+        finally:
+            profiler.disable()
+            SAMPLER.detach(sampler_key)
+            os.makedirs(ctx["profile_dir"], exist_ok=True)
+            profiler.dump_stats(os.path.join(ctx["profile_dir"], f"{name}.prof"))
+            # 只比較本階段前後的快照；同行程中並行、未剖析的階段也會計入
+            stats = tracemalloc.take_snapshot().compare_to(before, "lineno")[:PROFILE_TOP_ALLOCATIONS]
+            if owned:
+                tracemalloc.stop()
+    allocations = [
+        {"location": f"{s.traceback[0].filename}:{s.traceback[0].lineno}",
+         "size_kb": round(s.size_diff / 1024, 1), "count": s.count_diff}
+        for s in stats if s.size_diff > 0
+    ]
+    return result, allocations
+
+
+class StackSampler:
+    """
+    背景執行緒定期讀取 sys._current_frames()，只記錄正在執行剖析中階段的執行緒，
+    以 "stage;外層函式;...;內層函式" 折疊堆疊計數，依工作分開
+    """
+
+    def __init__(self, interval_ms):
+        self.interval = interval_ms / 1000.0
+        self._lock = threading.Lock()
+        self._active = {}
+        self._stacks = {}
+        self._thread = None
+
+    def attach(self, profile_dir, stage):
+        # 行程池的 worker 中取樣結果無法帶回主行程，不取樣
+        if multiprocessing.parent_process() is not None:
+            return None
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = (profile_dir, stage)
+            self._stacks.setdefault(profile_dir, Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        return ident
+
+    def detach(self, ident):
+        with self._lock:
+            self._active.pop(ident, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, (profile_dir, stage) in self._active.items():
+                    frame = frames.get(ident)
+                    stack = []
+                    # 執行緒池 / 排程器的外層堆疊對每個階段都一樣，只保留階段函式以內
+                    while frame is not None and frame.f_code is not _RUN_PROFILED_CODE:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    self._stacks[profile_dir][";".join([f"stage:{stage}"] + stack[::-1])] += 1
+
+    def pop(self, profile_dir):
+        with self._lock:
+            return self._stacks.pop(profile_dir, Counter())
+
+
+_RUN_PROFILED_CODE = run_profiled.__code__
+SAMPLER = StackSampler(PROFILE_SAMPLE_MS)
+
+
+def write_job_profile(profile_dir, allocations):
+    """合併各階段的 pstats，寫出折疊堆疊與配置統計；回傳輸出檔案"""
+    import pstats
+    os.makedirs(profile_dir, exist_ok=True)
+    outputs = {}
+    stage_files = sorted(os.path.join(profile_dir, f) for f in os.listdir(profile_dir)
+                         if f.endswith(".prof") and f != "job.prof")
+    if stage_files:
+        outputs["pstats"] = os.path.join(profile_dir, "job.prof")
+        pstats.Stats(*stage_files).dump_stats(outputs["pstats"])
+
+    stacks = SAMPLER.pop(profile_dir)
+    outputs["folded"] = os.path.join(profile_dir, "stacks.folded")
+    with open(outputs["folded"], "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+    outputs["allocations"] = os.path.join(profile_dir, "allocations.txt")
+    with open(outputs["allocations"], "w", encoding="utf-8") as f:
+        for stage, rows in allocations.items():
+            f.write(f"== {stage}\n")
+            for row in rows:
+                f.write(f"{row['size_kb']:>10.1f} KB {row['count']:>8} blocks  {row['location']}\n")
+    return outputs
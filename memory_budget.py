@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+批次處理的記憶體控管
+- 以 mmap 讀取檔案並直接 base64 編碼，不先把整個檔案讀成 Python bytes
+- 已在記憶體中的編碼影像（例如 MongoDB 的 BSON Buffer，見 mongo_photos.py）以 data 參數傳入，不寫暫存檔
+- 全域記憶體預算：各階段執行前先預留預估用量，不足時等待其他工作釋放
+  設定 MEMORY_BUDGET_FILE 後以檔案鎖在多個報告行程之間共用同一份預算；
+  report_pipeline 使用行程池時，未設定也會自動建立暫存狀態檔，讓各 worker 共用預算
+- 回報行程（與行程池 worker）的 RSS 高水位，方便決定 worker 數量
+"""
+import os
+import sys
+import json
+import mmap
+import time
+import base64
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import fcntl
+    import resource
+except ImportError:
+    fcntl = None
+    resource = None
+
+from rate_limiter import image_size_from_header
+
+MB = 1024 * 1024
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))  # 0 = 不限制
+MEMORY_BUDGET_FILE = os.getenv("MEMORY_BUDGET_FILE", "")
+HEADER_BYTES = 64 * 1024
+# collect() 期間的每次預留量，供單一工作的報告使用
+_reserve_sink = contextvars.ContextVar("memory_reserve_sink", default=None)
+
+
+@contextmanager
+def mapped(path):
+    """唯讀 mmap；空檔案回傳 b""（mmap 不接受長度 0）"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def b64encode_file(path, data=None):
+    """以 mmap 直接 base64 編碼檔案內容；有 data 時編碼 data"""
+    if data is not None:
+        return base64.b64encode(data).decode("ascii")
+    with mapped(path) as mm:
+        return base64.b64encode(mm).decode("ascii")
+
+
+def image_dimensions(path, data=None):
+    """只讀檔頭取得 (寬, 高)，無法判斷時回傳 None"""
+    if data is not None:
+        return image_size_from_header(bytes(data[:HEADER_BYTES]))
+    with mapped(path) as mm:
+        return image_size_from_header(bytes(mm[:HEADER_BYTES]))
+
+
+def decode_image(path, flag, data=None):
+    """cv2.imread；有 data 時以 cv2.imdecode 在記憶體中解碼。無法解碼時回傳 None"""
+    import cv2
+    if data is None:
+        return cv2.imread(path, flag)
+    import numpy as np
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+
+
+def estimate_bytes(paths, decoded_copies=2, encoded_factor=1.4):
+    """
+    預估處理這些圖片的峰值記憶體：
+    解碼後的 BGRA 影像 × decoded_copies + 檔案大小 × encoded_factor（base64 / JSON 字串）
+    paths 的項目可以是檔案路徑或記憶體中的編碼影像 (bytes)
+    """
+    total = 0
+    for path in paths:
+        if isinstance(path, (bytes, bytearray, memoryview)):
+            size, dims = len(path), image_dimensions(None, path)
+        elif not path or not os.path.exists(path):
+            continue
+        else:
+            size, dims = os.path.getsize(path), image_dimensions(path)
+        decoded = dims[0] * dims[1] * 4 if dims else size * 10
+        total += decoded * decoded_copies + size * encoded_factor
+    return int(total)
+
+
+class MemoryBudget:
+    """
+    以位元組計的共用預算；reserve() 在額度不足時阻塞
+    單一預留量超過總預算時會等到其他工作全部釋放後單獨執行
+    """
+
+    def __init__(self, limit_mb=0, state_file=""):
+        self.limit = int(limit_mb * MB)
+        self.state_file = state_file if fcntl is not None else ""
+        self._cond = threading.Condition()
+        self._reserved = 0
+        self.peak_reserved = 0
+
+    @property
+    def enabled(self):
+        return self.limit > 0
+
+    def _shared_update(self, delta):
+        """跨行程：狀態檔記錄各 pid 的預留量，並清除已結束行程的紀錄"""
+        with open(self.state_file, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read())
+                except ValueError:
+                    state = {}
+                for pid in list(state):
+                    try:
+                        os.kill(int(pid), 0)
+                    except (OSError, ValueError):
+                        del state[pid]
+                me = str(os.getpid())
+                others = sum(v for k, v in state.items() if k != me)
+                mine = state.get(me, 0)
+                if delta > 0 and others + mine > 0 and others + mine + delta > self.limit:
+                    return False
+                state[me] = max(0, mine + delta)
+                if not state[me]:
+                    del state[me]
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                return True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _try_take(self, nbytes):
+        if self._reserved > 0 and self._reserved + nbytes > self.limit:
+            return False
+        if self.state_file and not self._shared_update(nbytes):
+            return False
+        self._reserved += nbytes
+        self.peak_reserved = max(self.peak_reserved, self._reserved)
+        return True
+
+    @contextmanager
+    def reserve(self, nbytes, label=""):
+        if not self.enabled or nbytes <= 0:
+            yield
+            return
+        nbytes = min(int(nbytes), self.limit)
+        started = time.monotonic()
+        with self._cond:
+            while not self._try_take(nbytes):
+                # 跨行程時無法被通知，定期重試
+                self._cond.wait(timeout=0.2 if self.state_file else None)
+        sink = _reserve_sink.get()
+        if sink is not None:
+            sink.append(nbytes)
+        waited = time.monotonic() - started
+        if waited > 0.05:
+            print(f"[Memory] {label or 'stage'} waited {waited:.1f}s for {nbytes / MB:.0f} MB", file=sys.stderr)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._reserved -= nbytes
+                if self.state_file:
+                    self._shared_update(-nbytes)
+                self._cond.notify_all()
+
+
+def current_rss_mb():
+    """行程目前的 RSS（MB）；只支援 Linux（/proc），其他平台回傳 None"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / MB, 1)
+
+
+def peak_rss_mb():
+    """行程 RSS 高水位（MB）；平台不支援時回傳 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 單位為 KB，macOS 為 bytes
+    return round(peak / (MB if sys.platform == "darwin" else 1024), 1)
+
+
+BUDGET = MemoryBudget(MEMORY_BUDGET_MB, MEMORY_BUDGET_FILE)
+
+
+def share_across_processes():
+    """
+    行程池啟動前呼叫：預算啟用但沒有 MEMORY_BUDGET_FILE 時建立暫存狀態檔，
+    否則各 worker 各自持有一份行程內預算。回傳建立的檔案（需以 unshare 移除）或 None
+    """
+    if not BUDGET.enabled or BUDGET.state_file or fcntl is None:
+        return None
+    fd, path = tempfile.mkstemp(prefix="memory_budget_", suffix=".json")
+    os.close(fd)
+    BUDGET.state_file = path
+    return path
+
+
+def attach(state_file):
+    """行程池 worker 的 initializer：使用主行程的預算狀態檔"""
+    if state_file and fcntl is not None:
+        BUDGET.state_file = state_file
+
+
+def unshare(path):
+    if path and BUDGET.state_file == path:
+        BUDGET.state_file = ""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def collect():
+    """收集此 context 中每次 BUDGET.reserve 的預留量（單一工作），回傳 list"""
+    sink = []
+    token = _reserve_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _reserve_sink.reset(token)
+
+
+def report(reservations=None, rss_mb=None, worker_peak_rss_mb=None):
+    """
+    單一工作的記憶體摘要，供報告 JSON 輸出
+    reservations：collect() 收集的預留量；rss_mb：各階段結束時主行程 RSS 的最大值；
+    worker_peak_rss_mb：行程池 worker 回報的 RSS 高水位；process_peak_rss_mb 為本行程啟動以來的高水位
+    """
+    return {
+        "peak_rss_mb": rss_mb,
+        "worker_peak_rss_mb": worker_peak_rss_mb,
+        "process_peak_rss_mb": peak_rss_mb(),
+        "budget_mb": MEMORY_BUDGET_MB or None,
+        "peak_reserved_mb": round(max(reservations) / MB, 1) if BUDGET.enabled and reservations else None,
+    }
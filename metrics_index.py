@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+牙菌斑指標索引（SQLite）
+generate_report.py 每產生一份報告就寫入一列，研究查詢不必重新產生報告或讀取圖片
+
+用法：
+    python metrics_index.py query [--min-coverage 10 | --above-trigger] [--since 2026-09-01] [--until 2026-10-01]
+                                  [--patient <id>] [--limit N] [--format json|csv]
+    python metrics_index.py stats [--group-by patient|month|day] [同上的篩選條件]
+"""
+import os
+import sys
+import csv
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import datetime, timezone
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+METRICS_DB = os.getenv("METRICS_DB", os.path.join(BASE_DIR, "outputs", "metrics.sqlite3"))
+
+# 與 report_engine.QR_TRIGGER_COVERAGE 相同
+QR_TRIGGER_COVERAGE = 10.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plaque_metrics (
+    record_id      TEXT PRIMARY KEY,
+    patient_id     TEXT,
+    visit_ts       INTEGER NOT NULL,
+    coverage       REAL NOT NULL,
+    plaque_pixels  INTEGER NOT NULL,
+    plaque_index   REAL,
+    coverage_basis TEXT,
+    qr_triggered   INTEGER NOT NULL DEFAULT 0,
+    language       TEXT,
+    generated_at   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_metrics_ts_coverage ON plaque_metrics (visit_ts, coverage);
+CREATE INDEX IF NOT EXISTS idx_metrics_patient_ts ON plaque_metrics (patient_id, visit_ts);
+-- 涵蓋索引：依覆蓋率篩選後的分組統計不必回表
+CREATE INDEX IF NOT EXISTS idx_metrics_coverage ON plaque_metrics (coverage, visit_ts, qr_triggered, patient_id);
+"""
+
+GROUP_EXPR = {
+    "patient": "patient_id",
+    "month": "strftime('%Y-%m', visit_ts, 'unixepoch')",
+    "day": "strftime('%Y-%m-%d', visit_ts, 'unixepoch')",
+}
+
+_local = threading.local()
+
+
+def connect(path=None):
+    """每個執行緒一個連線；WAL 模式讓多個報告行程可同時寫入"""
+    path = path or METRICS_DB
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    if path not in conns:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        conns[path] = conn
+    return conns[path]
+
+
+def _epoch(value):
+    """ISO 字串 / 日期字串 / epoch / None -> epoch 秒"""
+    if value is None or value == "":
+        return int(time.time())
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).replace("Z", "+00:00")
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def record_metrics(record_id, patient_id, visit_time, coverage, plaque_pixels, plaque_index=None,
+                   coverage_basis=None, qr_triggered=False, language=None, path=None):
+    """寫入（或覆寫）一筆記錄的指標"""
+    conn = connect(path)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO plaque_metrics "
+            "(record_id, patient_id, visit_ts, coverage, plaque_pixels, plaque_index, coverage_basis, "
+            " qr_triggered, language, generated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (str(record_id), str(patient_id) if patient_id else None, _epoch(visit_time), float(coverage),
+             int(plaque_pixels), plaque_index, coverage_basis, int(bool(qr_triggered)), language,
+             int(time.time())),
+        )
+
+
+def _where(min_coverage=None, max_coverage=None, since=None, until=None, patient_id=None):
+    clauses, params = [], []
+    if since is not None:
+        clauses.append("visit_ts >= ?")
+        params.append(_epoch(since))
+    if until is not None:
+        clauses.append("visit_ts < ?")
+        params.append(_epoch(until))
+    if min_coverage is not None:
+        clauses.append("coverage >= ?")
+        params.append(float(min_coverage))
+    if max_coverage is not None:
+        clauses.append("coverage < ?")
+        params.append(float(max_coverage))
+    if patient_id is not None:
+        clauses.append("patient_id = ?")
+        params.append(str(patient_id))
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+def query(limit=None, path=None, **filters):
+    """依條件篩選記錄，回傳產生器（逐列讀取，不一次載入全部）"""
+    where, params = _where(**filters)
+    sql = f"SELECT * FROM plaque_metrics{where} ORDER BY visit_ts"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    for row in connect(path).execute(sql, params):
+        yield dict(row)
+
+
+def aggregate(group_by="patient", path=None, **filters):
+    """分組統計：筆數、平均/最大覆蓋率、觸發 QR 次數"""
+    if group_by not in GROUP_EXPR:
+        raise ValueError(f"group_by must be one of: {', '.join(GROUP_EXPR)}")
+    where, params = _where(**filters)
+    expr = GROUP_EXPR[group_by]
+    sql = (
+        f"SELECT {expr} AS grp, COUNT(*) AS records, ROUND(AVG(coverage), 4) AS mean_coverage, "
+        f"MAX(coverage) AS max_coverage, SUM(qr_triggered) AS qr_triggered "
+        f"FROM plaque_metrics{where} GROUP BY grp ORDER BY grp"
+    )
+    return [dict(row) for row in connect(path).execute(sql, params)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the plaque metrics index")
+    parser.add_argument("command", choices=["query", "stats"])
+    parser.add_argument("--db", default=None)
+    parser.add_argument("--min-coverage", type=float)
+    parser.add_argument("--max-coverage", type=float)
+    parser.add_argument("--above-trigger", action="store_true",
+                        help=f"coverage >= QR_TRIGGER_COVERAGE ({QR_TRIGGER_COVERAGE}%%)")
+    parser.add_argument("--since")
+    parser.add_argument("--until")
+    parser.add_argument("--patient")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--group-by", default="patient", choices=list(GROUP_EXPR))
+    parser.add_argument("--format", default="json", choices=["json", "csv"])
+    args = parser.parse_args(argv)
+
+    filters = {
+        "min_coverage": QR_TRIGGER_COVERAGE if args.above_trigger else args.min_coverage,
+        "max_coverage": args.max_coverage,
+        "since": args.since,
+        "until": args.until,
+        "patient_id": args.patient,
+    }
+    if args.command == "query":
+        rows = query(limit=args.limit, path=args.db, **filters)
+    else:
+        rows = aggregate(group_by=args.group_by, path=args.db, **filters)
+
+    if args.format == "csv":
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(sys.stdout, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
+    else:
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+LLM 建議的模型分級路由（成本 / 延遲）
+依量測值、語言與延遲預算決定先呼叫哪一級模型：
+- fast：非推理模型，覆蓋率低且量測明確時使用，延遲與成本都較低
+- reasoning：推理模型，覆蓋率達 QR_TRIGGER_COVERAGE、量測不明確或指定語言時使用
+主要模型超過自己的期限（或回傳錯誤）時，改呼叫另一級模型；原本的請求不會中斷，
+兩者以先成功回覆者為準，全部受 LLM_LATENCY_BUDGET 限制：
+請求在 daemon 執行緒中執行，resilience.GROK 的重試只在剩餘預算內進行，逾時的請求不會讓 CLI 行程多等
+選用的模型與實際延遲記錄在建議的 "route" 欄位（文字模式只寫 stderr）
+"""
+import os
+import sys
+import time
+import queue
+import threading
+import contextvars
+
+import report_engine
+
+# auto（依量測值選擇）/ fast / reasoning（固定一級，仍會退回另一級）/ off（只用 GROK_MODEL，不路由）
+LLM_ROUTING = os.getenv("LLM_ROUTING", "auto")
+LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "grok-4-1-fast-non-reasoning")
+LLM_REASONING_MODEL = os.getenv("LLM_REASONING_MODEL", report_engine.GROK_MODEL)
+# 各級模型的回覆期限（秒），超過即退回另一級
+LLM_FAST_DEADLINE = float(os.getenv("LLM_FAST_DEADLINE", "10"))
+LLM_REASONING_DEADLINE = float(os.getenv("LLM_REASONING_DEADLINE", "40"))
+# 一份報告等待建議的總時間（秒）；剩餘時間不足推理模型期限時直接用 fast
+LLM_LATENCY_BUDGET = float(os.getenv("LLM_LATENCY_BUDGET", "60"))
+# 覆蓋率達此百分比改用推理模型（預設與 QR_TRIGGER_COVERAGE 相同）
+LLM_ROUTE_COVERAGE = float(os.getenv("LLM_ROUTE_COVERAGE", str(report_engine.QR_TRIGGER_COVERAGE)))
+# 一律使用推理模型的語言（逗號分隔，例如 fast 模型品質較差的語言）
+LLM_REASONING_LANGS = {l.strip() for l in os.getenv("LLM_REASONING_LANGS", "").split(",") if l.strip()}
+
+TIERS = {
+    "fast": {"model": LLM_FAST_MODEL, "deadline": LLM_FAST_DEADLINE},
+    "reasoning": {"model": LLM_REASONING_MODEL, "deadline": LLM_REASONING_DEADLINE},
+}
+OTHER_TIER = {"fast": "reasoning", "reasoning": "fast"}
+
+
+def choose_tier(metrics, lang, budget=None):
+    """回傳 (模型等級, 原因)"""
+    budget = LLM_LATENCY_BUDGET if budget is None else budget
+    if LLM_ROUTING in TIERS:
+        return LLM_ROUTING, f"routing={LLM_ROUTING}"
+    if budget < LLM_REASONING_DEADLINE:
+        return "fast", f"budget {budget:g}s < reasoning deadline {LLM_REASONING_DEADLINE:g}s"
+    if not metrics:
+        return "reasoning", "no metrics"
+    if metrics.get("source") != "geometry":
+        return "reasoning", "ambiguous: pixel-threshold estimate"
+    if metrics["coverage_percent"] >= LLM_ROUTE_COVERAGE:
+        return "reasoning", f"coverage {metrics['coverage_percent']:.2f}% >= {LLM_ROUTE_COVERAGE:g}%"
+    if lang in LLM_REASONING_LANGS:
+        return "reasoning", f"lang={lang}"
+    return "fast", f"coverage {metrics['coverage_percent']:.2f}% < {LLM_ROUTE_COVERAGE:g}%"
+
+
+def _failed(advice):
+    return isinstance(advice, str) and advice.startswith(("Error", "Unexpected response format"))
+
+
+def ask(image_files, lang="en", metrics=None, mode=None, budget=None):
+    """路由後呼叫 report_engine.ask_grok；回傳值與 ask_grok 相同"""
+    if LLM_ROUTING == "off":
+        return report_engine.ask_grok(image_files, lang, metrics, mode)
+    budget = LLM_LATENCY_BUDGET if budget is None else budget
+    primary, reason = choose_tier(metrics, lang, budget)
+    started = time.monotonic()
+    end = started + budget
+
+    results = queue.Queue()
+
+    def call(tier):
+        t0 = time.monotonic()
+        # 429 / 5xx 仍依 resilience.GROK 退避重試，但退避會超過預算時不再重試
+        advice = report_engine.ask_grok(image_files, lang, metrics, mode, model=TIERS[tier]["model"],
+                                        deadline=end)
+        results.put((tier, advice, (time.monotonic() - t0) * 1000))
+
+    def start(tier):
+        # 逾時的請求無法取消，以 daemon 執行緒執行，不等待它結束，也不會延後行程結束
+        # 複製 context，用量與網路指標才會計入呼叫端的工作（report_engine.collect_usage）
+        threading.Thread(target=contextvars.copy_context().run, args=(call, tier), name=f"llm-route-{tier}",
+                         daemon=True).start()
+
+    start(primary)
+    tried, running = [primary], 1
+    advice, tier, latency_ms, last_error = None, None, None, None
+    while running:
+        # 主要模型在期限內沒有成功時，加入另一級模型
+        if len(tried) == 1:
+            timeout = min(TIERS[primary]["deadline"], end - time.monotonic())
+        else:
+            timeout = end - time.monotonic()
+        try:
+            t, result, ms = results.get(timeout=max(timeout, 0))
+            running -= 1
+            done = True
+        except queue.Empty:
+            done = False
+        if done:
+            if _failed(result):
+                last_error = result
+                print(f"[Route] {t} ({TIERS[t]['model']}) failed after {ms:.0f}ms: {result[:120]}",
+                      file=sys.stderr)
+            else:
+                advice, tier, latency_ms = result, t, ms
+                break
+        if len(tried) == 1 and time.monotonic() < end:
+            fallback = OTHER_TIER[primary]
+            why = "failed" if last_error else f"exceeded {TIERS[primary]['deadline']:g}s deadline"
+            print(f"[Route] {primary} {why}; falling back to {fallback}", file=sys.stderr)
+            tried.append(fallback)
+            running += 1
+            start(fallback)
+        elif not done:
+            break
+
+    elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+    if advice is None:
+        print(f"[Route] no model answered within {budget:g}s (tried {', '.join(tried)})", file=sys.stderr)
+        return last_error or f"Error: LLM latency budget of {budget:g}s exceeded ({', '.join(tried)})."
+    route = {
+        "tier": tier,
+        "model": TIERS[tier]["model"],
+        "primary": primary,
+        "reason": reason,
+        "fallback": tier != primary,
+        "latency_ms": round(latency_ms, 1),
+        "elapsed_ms": elapsed_ms,
+    }
+    print(f"[Route] tier={tier} model={route['model']} reason=\"{reason}\" "
+          f"fallback={route['fallback']} latency={latency_ms:.0f}ms", file=sys.stderr)
+    if isinstance(advice, dict):
+        advice["route"] = route
+    return advice
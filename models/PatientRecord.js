@@ -121,6 +121,14 @@ const patientRecordSchema = new mongoose.Schema({
   // 檢查清單（可選）
   CheckList: {
     type: mongoose.Schema.Types.Mixed
+  },
+  // 牙菌斑結構化分析結果（可選，由 generate_report.py 產生：RLE 遮罩、多邊形、覆蓋率）
+  PlaqueGeometry: {
+    type: mongoose.Schema.Types.Mixed
+  },
+  // 結構化 AI 建議（可選，LLM_OUTPUT_MODE=structured 時產生：risk_level、summary、key_findings、hygiene_steps）
+  AIAdvice: {
+    type: mongoose.Schema.Types.Mixed
   }
 }, {
   timestamps: true
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+直接從 MongoDB 批次讀取照片做分析（不經過 Node API，也不複製到 temp/）
+- photos 集合（models/Photos.js）：照片為 BSON Buffer，在記憶體中解碼後直接送進 report_pipeline
+- patientrecords 集合（models/PatientRecord.js）：Photos.* 為檔案路徑，直接讀原檔；HRV / GSR 一併帶入
+查詢只投影需要的欄位，游標每次取回 MONGO_BATCH_SIZE 筆，每批交給 report_pipeline.run_jobs 後才取下一批，
+記憶體中最多只有一批照片
+
+用法：
+    python mongo_photos.py photos  [--field FacePhoto] [--loginid ID] [--since 2025-01-01] [--limit N]
+                                   [--advice] [--record] [--pdf-dir DIR] [--out results.jsonl]
+    python mongo_photos.py records [同上]
+    python mongo_photos.py seed <loginid> <image>...   寫入測試用的 Photos 文件
+
+本機測試：mongod --dbpath /tmp/mongo-test，
+MONGODB_URI=mongodb://localhost:27017/ployu_oral_test python mongo_photos.py seed test1 test_images/*.jpg
+後再執行 photos 子命令
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timezone
+
+from bson import Binary, ObjectId
+from pymongo import MongoClient
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 與 Node 端相同的連線字串（env.example 的 MONGODB_URI）
+MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/ployu_oral")
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "16"))
+MONGO_OUT_DIR = os.getenv("MONGO_OUT_DIR", os.path.join(BASE_DIR, "outputs", "mongo"))
+
+# mongoose 預設的集合名稱（model 名稱轉小寫複數）
+PHOTOS_COLLECTION = "photos"
+RECORDS_COLLECTION = "patientrecords"
+PATIENTS_COLLECTION = "patients"
+PHOTO_FIELDS = ("FacePhoto", "TouguePhoto", "TeethEPhoto", "TeethInPhoto1", "TeethInPhoto2", "TeethInPhoto3",
+                "TeethInPhoto4")
+PHYSIO_FIELDS = ("HRV", "HRV2", "GSR", "GSR2")
+
+# 預設只做分析；--advice 加上 AI 建議，--record 寫入指標索引 / 趨勢，--pdf-dir 產生完整報告
+# photos 集合的照片不是就診紀錄，寫入趨勢會多出 photos:<id>:<欄位> 的就診，因此 record 需明確指定
+ANALYSIS_STAGES = ("quality", "inference", "decode", "analyze")
+
+
+def connect(uri=None):
+    client = MongoClient(uri or MONGODB_URI)
+    # 連線字串沒有資料庫名稱時使用 Node 端的預設資料庫
+    return client.get_default_database("ployu_oral")
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    return value
+
+
+def _query(loginid=None, since=None):
+    query = {}
+    if loginid:
+        query["loginid"] = loginid
+    if since:
+        query["UploadDateTime"] = {"$gte": since}
+    return query
+
+
+def _batches(cursor, size):
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _patient_ids(db, loginids):
+    """loginid -> Patient._id（每批一次查詢）；趨勢與指標索引以 patientId 為鍵，與 Node 端產生的報告一致"""
+    cursor = db[PATIENTS_COLLECTION].find({"loginid": {"$in": sorted(loginids)}}, {"loginid": 1})
+    return {doc["loginid"]: str(doc["_id"]) for doc in cursor}
+
+
+def iter_photo_jobs(db, field="FacePhoto", query=None, limit=0, batch_size=None):
+    """
+    photos 集合 -> 每批 [(來源資訊, 工作參數)]
+    照片 bytes 直接作為 image_data，不寫暫存檔
+    """
+    batch_size = batch_size or MONGO_BATCH_SIZE
+    query = dict(query or {}, **{field: {"$exists": True, "$ne": None}})
+    cursor = (db[PHOTOS_COLLECTION]
+              .find(query, {"loginid": 1, "UploadDateTime": 1, field: 1})
+              .sort("_id", 1).limit(limit).batch_size(batch_size))
+    for docs in _batches(cursor, batch_size):
+        patients = _patient_ids(db, {doc["loginid"] for doc in docs})
+        batch = []
+        for doc in docs:
+            doc_id = str(doc["_id"])
+            source = {"collection": PHOTOS_COLLECTION, "id": doc_id, "field": field, "loginid": doc["loginid"]}
+            record = {
+                "patientId": patients.get(doc["loginid"]),
+                "recordId": f"{PHOTOS_COLLECTION}:{doc_id}:{field}",
+                "UploadDateTime": _iso(doc.get("UploadDateTime")),
+            }
+            batch.append((source, {"image": f"mongodb://{PHOTOS_COLLECTION}/{doc_id}/{field}",
+                                   "image_data": bytes(doc[field]), "record": record,
+                                   "patient_id": record["patientId"] or doc["loginid"]}))
+        yield batch
+
+
+def iter_record_jobs(db, field="FacePhoto", query=None, limit=0, batch_size=None):
+    """patientrecords 集合 -> 每批 [(來源資訊, 工作參數)]；照片路徑相對於專案根目錄（與 reportRoutes.js 相同）"""
+    batch_size = batch_size or MONGO_BATCH_SIZE
+    path_field = f"Photos.{field}"
+    query = dict(query or {}, **{path_field: {"$nin": [None, ""]}})
+    projection = {"patientId": 1, "loginid": 1, "UploadDateTime": 1, path_field: 1,
+                  **{name: 1 for name in PHYSIO_FIELDS}}
+    cursor = (db[RECORDS_COLLECTION].find(query, projection)
+              .sort("_id", 1).limit(limit).batch_size(batch_size))
+    for docs in _batches(cursor, batch_size):
+        batch = []
+        for doc in docs:
+            doc_id = str(doc["_id"])
+            source = {"collection": RECORDS_COLLECTION, "id": doc_id, "field": field, "loginid": doc.get("loginid")}
+            photo_path = os.path.join(BASE_DIR, doc["Photos"][field].lstrip("/"))
+            if not os.path.exists(photo_path):
+                print(f"[Mongo] {doc_id}: photo file not found: {photo_path}", file=sys.stderr)
+                source["error"] = f"Photo file not found: {photo_path}"
+                batch.append((source, None))
+                continue
+            record = {
+                "patientId": str(doc["patientId"]) if doc.get("patientId") else None,
+                "recordId": doc_id,
+                "UploadDateTime": _iso(doc.get("UploadDateTime")),
+                **{name: doc[name] for name in PHYSIO_FIELDS if doc.get(name)},
+            }
+            batch.append((source, {"image": photo_path, "record": record, "patient_id": record["patientId"]}))
+        yield batch
+
+
+def run(batches, lang="en", advice=False, pdf_dir=None, out=None, record=False):
+    """逐批執行 report_pipeline；每個結果加上 "source" 後寫成一行 JSON，回傳 (成功, 總數)"""
+    import report_pipeline
+    if pdf_dir:
+        # 完整報告；沒有 --record 時不寫趨勢，報告中也就沒有趨勢圖
+        names = tuple(s.name for s in report_pipeline.REPORT_STAGES if s.name != "record")
+        os.makedirs(pdf_dir, exist_ok=True)
+    else:
+        names = ANALYSIS_STAGES + (("advice",) if advice else ())
+    stages = report_pipeline.stages_for(names + (("record",) if record else ()))
+    ok = total = 0
+    for batch in batches:
+        jobs, results = [], []
+        for source, params in batch:
+            if params is None:
+                results.append(dict({"error": source.pop("error")}, source=source))
+                continue
+            name = f"{source['id']}_{source['field']}"
+            pdf = os.path.join(pdf_dir, f"report_{name}.pdf") if pdf_dir else None
+            jobs.append(report_pipeline.new_job(lang=lang, pdf=pdf, out_dir=os.path.join(MONGO_OUT_DIR, name),
+                                                **params))
+            results.append({"source": source})
+        started = time.perf_counter()
+        outcomes = iter(report_pipeline.run_jobs(jobs, stages=stages) if jobs else [])
+        # 依游標順序輸出；讀不到照片的項目保留原位
+        results = [r if "error" in r else dict(next(outcomes), source=r["source"]) for r in results]
+        for result in results:
+            out.write(json.dumps(result, ensure_ascii=False, default=str) + "\n")
+        out.flush()
+        ok += sum(1 for r in results if "error" not in r)
+        total += len(results)
+        print(f"[Mongo] batch of {len(results)} in {time.perf_counter() - started:.1f}s ({ok}/{total} ok)",
+              file=sys.stderr)
+    return ok, total
+
+
+def seed(db, loginid, paths):
+    """把圖片檔以 BSON Buffer 寫入 photos 集合（FacePhoto），供本機 mongod 測試"""
+    now = datetime.now(timezone.utc)
+    docs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            docs.append({"loginid": loginid, "FacePhoto": Binary(f.read()), "UploadDateTime": now,
+                         "createdAt": now, "updatedAt": now})
+    result = db[PHOTOS_COLLECTION].insert_many(docs)
+    return [str(i) for i in result.inserted_ids]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch photo analysis straight from MongoDB")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("photos", "records"):
+        p = sub.add_parser(name)
+        p.add_argument("--field", default="FacePhoto", choices=PHOTO_FIELDS)
+        p.add_argument("--loginid")
+        p.add_argument("--since", type=lambda s: datetime.fromisoformat(s).replace(tzinfo=timezone.utc),
+                       help="only photos uploaded on or after this ISO date")
+        p.add_argument("--id", action="append", default=[], help="document _id (repeatable)")
+        p.add_argument("--limit", type=int, default=0)
+        p.add_argument("--lang", default=os.getenv("REPORT_LANGUAGE", "en"))
+        p.add_argument("--advice", action="store_true", help="also generate AI advice")
+        p.add_argument("--record", action="store_true", help="also add the results to trends and the metrics index")
+        p.add_argument("--pdf-dir", help="generate full PDF reports into this directory")
+        p.add_argument("--out", help="write JSONL results here instead of stdout")
+    p_seed = sub.add_parser("seed")
+    p_seed.add_argument("loginid")
+    p_seed.add_argument("images", nargs="+")
+    args = parser.parse_args(argv)
+
+    db = connect()
+    if args.command == "seed":
+        print(json.dumps({"inserted": seed(db, args.loginid, args.images)}))
+        return
+    query = _query(args.loginid, args.since)
+    if args.id:
+        query["_id"] = {"$in": [ObjectId(i) for i in args.id]}
+    iterate = iter_photo_jobs if args.command == "photos" else iter_record_jobs
+    batches = iterate(db, args.field, query, args.limit)
+    out = open(args.out, "w", encoding="utf-8") if args.out else sys.stdout
+    try:
+        ok, total = run(batches, args.lang, args.advice, args.pdf_dir, out, args.record)
+    finally:
+        if args.out:
+            out.close()
+    print(f"[Mongo] {ok}/{total} photos analyzed", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
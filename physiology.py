@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+HRV / GSR 生理特徵計算（NumPy 向量化，可一次處理多筆記錄）
+輸入為 PatientRecord 的 HRV / HRV2 / GSR / GSR2 原始陣列，
+長短不一的陣列會以 NaN 補齊成二維矩陣後一次計算
+
+HRV：RMSSD、SDNN、pNN50、SD1、SD2、平均心率（含異常 IBI 剔除）
+GSR：tonic（SCL，移動平均）/ phasic（SCR）分解、SCR 次數與振幅、tonic 斜率
+
+用法（批次回填）：
+    python physiology.py <records.json>
+records.json 為 PatientRecord 物件陣列，輸出每筆記錄的特徵 JSON
+"""
+import os
+import sys
+import json
+import warnings
+from contextlib import contextmanager
+
+import numpy as np
+
+# 異常 IBI 剔除：生理範圍 (ms) 與相對於該筆中位數的最大偏差
+IBI_MIN_MS = float(os.getenv("IBI_MIN_MS", "300"))
+IBI_MAX_MS = float(os.getenv("IBI_MAX_MS", "2000"))
+IBI_MAX_DEVIATION = float(os.getenv("IBI_MAX_DEVIATION", "0.3"))
+
+# GSR：tonic 移動平均視窗（秒）、SCR 門檻（phasic 標準差倍數）、尖波剔除（差分 MAD 倍數）
+GSR_TONIC_WINDOW_S = float(os.getenv("GSR_TONIC_WINDOW_S", "4"))
+GSR_SCR_K = float(os.getenv("GSR_SCR_K", "1.0"))
+GSR_SPIKE_K = float(os.getenv("GSR_SPIKE_K", "8"))
+# RawTime 無法判斷取樣率時的預設值 (Hz)
+GSR_DEFAULT_RATE = float(os.getenv("GSR_DEFAULT_RATE", "4"))
+
+HRV_BLOCKS = ("HRV", "HRV2")
+GSR_BLOCKS = ("GSR", "GSR2")
+
+
+def _pad(arrays):
+    """不等長陣列 -> NaN 補齊的 float64 矩陣"""
+    width = max((len(a) for a in arrays), default=0)
+    out = np.full((len(arrays), max(width, 1)), np.nan)
+    for i, a in enumerate(arrays):
+        if len(a):
+            out[i, :len(a)] = a
+    return out
+
+
+@contextmanager
+def _quiet():
+    """全 NaN 的列是正常情況（資料不足），不輸出警告"""
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        yield
+
+
+def _value(v, digits):
+    return round(float(v), digits) if np.isfinite(v) else None
+
+
+def hrv_features(ibi_batch):
+    """
+    ibi_batch：每筆一個 IBI (ms) 陣列
+    回傳 dict[str, np.ndarray]，每個陣列長度等於筆數（資料不足為 NaN）
+    """
+    ibi = _pad([np.asarray(a, dtype=np.float64) for a in ibi_batch])
+    with _quiet():
+        # 剔除超出生理範圍或偏離中位數過多的 IBI
+        ibi[(ibi < IBI_MIN_MS) | (ibi > IBI_MAX_MS)] = np.nan
+        median = np.nanmedian(ibi, axis=1, keepdims=True)
+        ibi[np.abs(ibi - median) > IBI_MAX_DEVIATION * median] = np.nan
+
+        valid = np.isfinite(ibi)
+        n_valid = valid.sum(axis=1)
+        diff = np.diff(ibi, axis=1)  # 任一端被剔除時為 NaN
+        diff_valid = np.isfinite(diff)
+        n_diff = diff_valid.sum(axis=1)
+
+        sdnn = np.nanstd(ibi, axis=1, ddof=1)
+        rmssd = np.sqrt(np.nanmean(diff ** 2, axis=1))
+        pnn50 = np.where(n_diff > 0, (np.abs(np.nan_to_num(diff)) > 50).sum(axis=1) / n_diff * 100, np.nan)
+        sd_diff = np.nanstd(diff, axis=1, ddof=1)
+        sd1 = np.sqrt(0.5) * sd_diff
+        sd2 = np.sqrt(np.clip(2 * sdnn ** 2 - 0.5 * sd_diff ** 2, 0, None))
+        mean_hr = 60000.0 / np.nanmean(ibi, axis=1)
+
+    too_short = n_valid < 3
+    features = {
+        "RMSSD": rmssd, "SDNN": sdnn, "pNN50": pnn50, "SD1": sd1, "SD2": sd2, "MeanHR": mean_hr,
+    }
+    for values in features.values():
+        values[too_short] = np.nan
+    lengths = np.array([len(a) for a in ibi_batch])
+    features["BeatsUsed"] = n_valid.astype(np.float64)
+    features["ArtifactRate"] = 1 - n_valid / np.maximum(lengths, 1)
+    return features
+
+
+def _moving_average(x, half_windows):
+    """
+    每列使用各自視窗大小的置中移動平均（忽略 NaN）
+    以累加和 + take_along_axis 實作，不需逐列迴圈
+    """
+    rows, cols = x.shape
+    finite = np.isfinite(x)
+    cs = np.concatenate([np.zeros((rows, 1)), np.cumsum(np.where(finite, x, 0), axis=1)], axis=1)
+    cn = np.concatenate([np.zeros((rows, 1)), np.cumsum(finite, axis=1)], axis=1)
+    idx = np.arange(cols)[None, :]
+    lo = np.clip(idx - half_windows[:, None], 0, cols)
+    hi = np.clip(idx + half_windows[:, None] + 1, 0, cols)
+    total = np.take_along_axis(cs, hi, axis=1) - np.take_along_axis(cs, lo, axis=1)
+    count = np.take_along_axis(cn, hi, axis=1) - np.take_along_axis(cn, lo, axis=1)
+    with _quiet():
+        out = total / count
+    out[~finite] = np.nan
+    return out
+
+
+def gsr_features(value_batch, time_batch=None):
+    """
+    value_batch：每筆一個 GSR 原始值陣列；time_batch：對應的 RawTime（秒或毫秒）
+    回傳 dict[str, np.ndarray]
+    """
+    raw = _pad([np.asarray(a, dtype=np.float64) for a in value_batch])
+    rows = raw.shape[0]
+    times = _pad([np.asarray(a, dtype=np.float64) for a in (time_batch or [[]] * rows)])
+
+    with _quiet():
+        # 取樣率：RawTime 差分中位數；數值 > 10 視為毫秒
+        dt = np.nanmedian(np.diff(times, axis=1), axis=1)
+        dt = np.where(dt > 10, dt / 1000.0, dt)
+        rate = np.where(np.isfinite(dt) & (dt > 0), 1.0 / dt, GSR_DEFAULT_RATE)
+
+        # 尖波剔除：差分超過 GSR_SPIKE_K 倍 MAD 的樣本
+        d = np.abs(np.diff(raw, axis=1))
+        mad = np.nanmedian(np.abs(d - np.nanmedian(d, axis=1, keepdims=True)), axis=1, keepdims=True)
+        spike = np.zeros_like(raw, dtype=bool)
+        spike[:, 1:] = d > GSR_SPIKE_K * np.maximum(mad, 1e-9) + np.nanmedian(d, axis=1, keepdims=True)
+        clean = np.where(spike, np.nan, raw)
+
+        half = np.maximum((GSR_TONIC_WINDOW_S * rate / 2).astype(np.int64), 1)
+        tonic = _moving_average(clean, half)
+        phasic = clean - tonic
+
+        threshold = GSR_SCR_K * np.nanstd(phasic, axis=1, keepdims=True)
+        mid = phasic[:, 1:-1]
+        peaks = (mid > phasic[:, :-2]) & (mid >= phasic[:, 2:]) & (mid > threshold)
+        scr_count = peaks.sum(axis=1)
+        scr_amp = np.where(scr_count > 0, np.where(peaks, mid, 0).sum(axis=1) / np.maximum(scr_count, 1), np.nan)
+
+        n = np.isfinite(clean).sum(axis=1)
+        duration = n / rate
+        # tonic 斜率（每分鐘）：以樣本索引做最小平方法
+        t = np.arange(raw.shape[1])[None, :] / rate[:, None]
+        t = np.where(np.isfinite(tonic), t, np.nan)
+        t_c = t - np.nanmean(t, axis=1, keepdims=True)
+        y_c = tonic - np.nanmean(tonic, axis=1, keepdims=True)
+        slope = np.nansum(t_c * y_c, axis=1) / np.nansum(t_c ** 2, axis=1) * 60
+
+        features = {
+            "SCLMean": np.nanmean(tonic, axis=1),
+            "SCLSlopePerMin": slope,
+            "SCRCount": scr_count.astype(np.float64),
+            "SCRPerMin": np.where(duration > 0, scr_count / duration * 60, np.nan),
+            "SCRMeanAmplitude": scr_amp,
+            "PhasicStd": np.nanstd(phasic, axis=1),
+            "ArtifactRate": spike.sum(axis=1) / np.maximum(np.isfinite(raw).sum(axis=1), 1),
+        }
+    too_short = n < 3
+    for values in features.values():
+        values[too_short] = np.nan
+    return features
+
+
+def _ibi_of(block):
+    """IBIms 優先；沒有時由 HeartBeat (bpm) 換算"""
+    if not block:
+        return []
+    if block.get("IBIms"):
+        return block["IBIms"]
+    if block.get("HeartBeat"):
+        hb = np.asarray(block["HeartBeat"], dtype=np.float64)
+        return (60000.0 / hb[hb > 0]).tolist()
+    return []
+
+
+def extract_features(records):
+    """
+    批次計算多筆 PatientRecord 的生理特徵
+    同一種區塊（HRV/HRV2、GSR/GSR2）的所有記錄合併為一次向量化計算
+    回傳 list[dict]，與 records 順序相同；沒有資料的區塊不會出現
+    """
+    results = [{} for _ in records]
+
+    hrv_jobs = [(i, name, _ibi_of(r.get(name))) for i, r in enumerate(records) for name in HRV_BLOCKS]
+    hrv_jobs = [job for job in hrv_jobs if len(job[2])]
+    if hrv_jobs:
+        feats = hrv_features([job[2] for job in hrv_jobs])
+        for k, (i, name, _) in enumerate(hrv_jobs):
+            results[i][name] = {key: _value(values[k], 3) for key, values in feats.items()}
+
+    gsr_jobs = [(i, name, r.get(name) or {}) for i, r in enumerate(records) for name in GSR_BLOCKS]
+    gsr_jobs = [job for job in gsr_jobs if job[2].get("RawValue")]
+    if gsr_jobs:
+        feats = gsr_features([job[2]["RawValue"] for job in gsr_jobs],
+                             [job[2].get("RawTime") or [] for job in gsr_jobs])
+        for k, (i, name, _) in enumerate(gsr_jobs):
+            results[i][name] = {key: _value(values[k], 4) for key, values in feats.items()}
+
+    return results
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(json.dumps({"error": "Missing arguments", "usage": "python physiology.py <records.json>"}))
+        sys.exit(1)
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        records = json.load(f)
+    if isinstance(records, dict):
+        records = [records]
+    print(json.dumps(extract_features(records), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+牙菌斑結構化幾何資料
+從推論結果的 predictions 取出多邊形，轉成 RLE 遮罩與各區域面積，
+讓覆蓋率可以精確計算、存入資料庫，並在需要時重新繪製而不必解碼圖片
+
+geometry 格式（可直接 json.dumps）：
+{
+  "width": W, "height": H,
+  "regions": [{"class": "plaque", "confidence": 0.9, "polygon": [[x, y], ...], "area": 123}],
+  "mask_rle": {"size": [H, W], "counts": [...]},   # COCO 未壓縮 RLE（column-major）
+  "plaque_pixels": N,
+  "basis_pixels": M,          # 覆蓋率分母：有牙齒區域時為牙齒面積，否則為整張圖
+  "coverage_basis": "teeth" | "image",
+  "coverage": 12.34           # 百分比
+}
+"""
+import os
+
+import cv2
+import numpy as np
+
+# 覆蓋率分母（coverage_basis）；metrics_index、報告與建議庫共用同一組值
+COVERAGE_BASIS_TEETH = "teeth"
+COVERAGE_BASIS_IMAGE = "image"
+
+# 類別名稱包含這些字時視為牙齒（覆蓋率分母），其餘視為牙菌斑
+TOOTH_CLASS_KEYWORDS = tuple(
+    k.strip().lower() for k in os.getenv("TOOTH_CLASS_KEYWORDS", "tooth,teeth").split(",") if k.strip()
+)
+
+# mask_visualization 以此顏色標示牙菌斑（BGR；HSV 色相約 144，落在 calculate_plaque_area 的紫色範圍內）
+PLAQUE_COLOR = (200, 0, 160)
+
+
+def rle_encode(mask):
+    """二值遮罩 -> COCO 未壓縮 RLE（column-major，第一段為 0 的長度）"""
+    h, w = mask.shape[:2]
+    flat = (np.asarray(mask).ravel(order="F") > 0).astype(np.int8)
+    change = np.flatnonzero(np.diff(flat)) + 1
+    bounds = np.concatenate(([0], change, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat.size and flat[0] == 1:
+        counts.insert(0, 0)
+    return {"size": [h, w], "counts": counts}
+
+
+def rle_decode(rle):
+    """COCO 未壓縮 RLE -> uint8 遮罩（255 = 前景）"""
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(counts.size, dtype=np.uint8)
+    values[1::2] = 255
+    flat = np.repeat(values, counts)
+    return flat.reshape((w, h)).T.copy()
+
+
+def rle_area(rle):
+    """不解碼即可取得前景像素數"""
+    return int(sum(rle["counts"][1::2]))
+
+
+def _find_predictions(obj, depth=0):
+    """在 workflow 輸出中尋找 {"image": {...}, "predictions": [...]} 結構"""
+    if depth > 4:
+        return None
+    if isinstance(obj, dict):
+        preds = obj.get("predictions")
+        if isinstance(preds, list) and (not preds or isinstance(preds[0], dict)):
+            return obj
+        for value in obj.values():
+            found = _find_predictions(value, depth + 1)
+            if found is not None:
+                return found
+    elif isinstance(obj, list):
+        for value in obj:
+            found = _find_predictions(value, depth + 1)
+            if found is not None:
+                return found
+    return None
+
+
+def is_tooth(class_name):
+    name = (class_name or "").lower()
+    return any(k in name for k in TOOTH_CLASS_KEYWORDS)
+
+
+def extract_geometry(item, image_size=None):
+    """
+    從推論結果（Roboflow workflow 的 result[0] 或本地後端輸出）取出幾何資料
+    找不到 predictions，或 predictions 都沒有多邊形（例如只有 bounding box）時回傳 None，
+    呼叫端應退回 calculate_plaque_area 的像素閾值法
+    """
+    found = _find_predictions(item)
+    if found is None:
+        return None
+    image = found.get("image") or {}
+    width = int(image.get("width") or (image_size or (0, 0))[0])
+    height = int(image.get("height") or (image_size or (0, 0))[1])
+    if not width or not height:
+        return None
+
+    plaque = np.zeros((height, width), dtype=np.uint8)
+    teeth = np.zeros((height, width), dtype=np.uint8)
+    regions = []
+    for pred in found["predictions"]:
+        points = pred.get("points") or []
+        if len(points) < 3:
+            continue
+        polygon = np.array([[round(p["x"]), round(p["y"])] for p in points], dtype=np.int32)
+        polygon = np.clip(polygon, 0, [width - 1, height - 1]).astype(np.int32)
+        # 只在多邊形外接矩形內繪製，避免每個區域都配置整張圖大小的遮罩
+        x, y, w, h = cv2.boundingRect(polygon)
+        region_mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.fillPoly(region_mask, [polygon - [x, y]], 255)
+        target = teeth if is_tooth(pred.get("class")) else plaque
+        roi = target[y:y + h, x:x + w]
+        cv2.bitwise_or(roi, region_mask, dst=roi)
+        regions.append({
+            "class": pred.get("class", "plaque"),
+            "confidence": round(float(pred.get("confidence", 1.0)), 4),
+            "polygon": polygon.tolist(),
+            "area": int(cv2.countNonZero(region_mask)),
+        })
+
+    if found["predictions"] and not regions:
+        # 沒有畫出任何多邊形，覆蓋率 0 不代表沒有牙菌斑
+        return None
+
+    if cv2.countNonZero(teeth):
+        # 只計算落在牙齒上的牙菌斑
+        cv2.bitwise_and(plaque, teeth, dst=plaque)
+        basis, basis_name = int(cv2.countNonZero(teeth)), COVERAGE_BASIS_TEETH
+    else:
+        basis, basis_name = width * height, COVERAGE_BASIS_IMAGE
+
+    plaque_pixels = int(cv2.countNonZero(plaque))
+    return {
+        "width": width,
+        "height": height,
+        "regions": regions,
+        "mask_rle": rle_encode(plaque),
+        "plaque_pixels": plaque_pixels,
+        "basis_pixels": basis,
+        "coverage_basis": basis_name,
+        "coverage": round(plaque_pixels / basis * 100, 4) if basis else 0.0,
+    }
+
+
+def plaque_mask(geometry):
+    """由 geometry 還原牙菌斑遮罩"""
+    return rle_decode(geometry["mask_rle"])
+
+
+def render_mask(geometry, background=None, color=PLAQUE_COLOR):
+    """
+    依 geometry 重新繪製 mask_visualization
+    background 為原圖（BGR）時以其灰階為底，否則使用黑色底
+    """
+    mask = plaque_mask(geometry)
+    if background is None:
+        canvas = np.zeros((geometry["height"], geometry["width"], 3), dtype=np.uint8)
+    else:
+        canvas = cv2.cvtColor(cv2.cvtColor(background, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+    canvas[mask > 0] = color
+    return canvas
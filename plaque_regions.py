@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+分區牙菌斑指數（每個六分區 / 每顆牙）
+將標籤圖（每個像素的值 = 區域編號，0 = 忽略）套用到牙菌斑遮罩，
+以 np.bincount 一次計算所有區域的覆蓋率
+
+區域來源由 REGION_MODE 決定：
+- auto（預設）：有牙齒多邊形時逐顆牙計分，否則用 REGION_MAP，再否則用網格
+- teeth：plaque_geometry 中的牙齒多邊形，每顆牙一個區域
+- map：REGION_MAP 指定的標籤 PNG（可搭配 REGION_MAP_NAMES 的 JSON 名稱清單）
+- grid：REGION_GRID（"列x欄"，預設 2x3 即上下顎各三個六分區）
+"""
+import os
+import json
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+import plaque_geometry
+
+REGION_MODE = os.getenv("REGION_MODE", "auto")
+REGION_GRID = os.getenv("REGION_GRID", "2x3")
+REGION_MAP = os.getenv("REGION_MAP", "")
+REGION_MAP_NAMES = os.getenv("REGION_MAP_NAMES", "")
+
+# 正面照中病人右側位於影像左側
+SEXTANT_NAMES = [
+    "upper_right", "upper_anterior", "upper_left",
+    "lower_right", "lower_anterior", "lower_left",
+]
+
+# 覆蓋率 -> 0~3 分（上限為百分比，依序比較）
+SCORE_BANDS = [(1.0, 0), (100 / 3, 1), (200 / 3, 2), (float("inf"), 3)]
+
+# 與 calculate_plaque_area 相同的紫色範圍
+PURPLE_HSV_LOW = np.array([120, 40, 40])
+PURPLE_HSV_HIGH = np.array([160, 255, 255])
+
+
+def mask_from_visualization(mask_path):
+    """沒有 geometry 時，從 mask_visualization 以紫色閾值取得遮罩"""
+    img = cv2.imread(mask_path)
+    if img is None:
+        return None
+    return cv2.inRange(cv2.cvtColor(img, cv2.COLOR_BGR2HSV), PURPLE_HSV_LOW, PURPLE_HSV_HIGH)
+
+
+@lru_cache(maxsize=16)
+def grid_labels(height, width, grid=REGION_GRID):
+    """網格標籤圖；同尺寸重複使用（批次回填時大多為同一尺寸）"""
+    rows, cols = (int(v) for v in grid.lower().split("x"))
+    row_idx = np.minimum(np.arange(height) * rows // height, rows - 1)
+    col_idx = np.minimum(np.arange(width) * cols // width, cols - 1)
+    labels = (row_idx[:, None] * cols + col_idx[None, :] + 1).astype(np.int32)
+    labels.setflags(write=False)
+    if (rows, cols) == (2, 3):
+        names = list(SEXTANT_NAMES)
+    else:
+        names = [f"r{r + 1}c{c + 1}" for r in range(rows) for c in range(cols)]
+    return labels, tuple(names)
+
+
+@lru_cache(maxsize=4)
+def _load_map(path, names_path):
+    labels = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if labels is None:
+        raise ValueError(f"Could not read REGION_MAP: {path}")
+    if labels.ndim == 3:
+        labels = labels[:, :, 0]
+    labels = labels.astype(np.int32)
+    count = int(labels.max())
+    names = [f"region_{i}" for i in range(1, count + 1)]
+    if names_path:
+        with open(names_path, "r", encoding="utf-8") as f:
+            names = json.load(f)
+    return labels, tuple(names)
+
+
+def map_labels(height, width):
+    """標籤 PNG；尺寸不同時以最近鄰縮放"""
+    labels, names = _load_map(REGION_MAP, REGION_MAP_NAMES)
+    if labels.shape != (height, width):
+        labels = cv2.resize(labels, (width, height), interpolation=cv2.INTER_NEAREST)
+    return labels, names
+
+
+def tooth_labels(geometry):
+    """由 geometry 中的牙齒多邊形建立標籤圖，每顆牙一個編號"""
+    teeth = [r for r in geometry.get("regions", []) if plaque_geometry.is_tooth(r.get("class"))]
+    if not teeth:
+        return None
+    labels = np.zeros((geometry["height"], geometry["width"]), dtype=np.int32)
+    names = []
+    for i, region in enumerate(teeth, start=1):
+        cv2.fillPoly(labels, [np.asarray(region["polygon"], dtype=np.int32)], i)
+        names.append(region.get("class") if region.get("class") not in ("tooth", "teeth") else f"tooth_{i}")
+    return labels, tuple(names)
+
+
+def _labels_for(height, width, geometry):
+    mode = REGION_MODE
+    if mode in ("auto", "teeth") and geometry is not None:
+        found = tooth_labels(geometry)
+        if found is not None:
+            return "teeth", found
+    if mode == "teeth":
+        mode = "auto"
+    if mode == "map" or (mode == "auto" and REGION_MAP):
+        return "map", map_labels(height, width)
+    return "grid", grid_labels(height, width)
+
+
+def score(coverage):
+    for upper, value in SCORE_BANDS:
+        if coverage < upper:
+            return value
+    return SCORE_BANDS[-1][1]
+
+
+def region_coverage(mask, labels, names):
+    """
+    一次 bincount 計算所有區域的像素數與牙菌斑像素數
+    回傳 [{"region", "pixels", "plaque_pixels", "coverage", "score"}]
+    """
+    n = len(names) + 1
+    # 編碼為 label * 2 + 是否牙菌斑，單次 bincount 同時得到總數與牙菌斑數
+    combined = labels.ravel() * 2 + (mask.ravel() > 0)
+    counts = np.bincount(combined, minlength=2 * n)[:2 * n].reshape(n, 2)
+    totals = counts.sum(axis=1)
+    plaque = counts[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coverage = np.where(totals > 0, plaque / totals * 100, 0.0)
+    return [
+        {
+            "region": names[i - 1],
+            "pixels": int(totals[i]),
+            "plaque_pixels": int(plaque[i]),
+            "coverage": round(float(coverage[i]), 2),
+            "score": score(coverage[i]),
+        }
+        for i in range(1, n)
+    ]
+
+
+def score_regions(mask_path=None, geometry=None):
+    """
+    計算分區牙菌斑指數；geometry 優先，否則讀取 mask_visualization
+    回傳 {"mode", "regions": [...], "plaque_index"}，無法取得遮罩時回傳 None
+    """
+    if geometry is not None:
+        mask = plaque_geometry.plaque_mask(geometry)
+    elif mask_path:
+        mask = mask_from_visualization(mask_path)
+    else:
+        mask = None
+    if mask is None:
+        return None
+
+    height, width = mask.shape[:2]
+    mode, (labels, names) = _labels_for(height, width, geometry)
+    regions = region_coverage(mask, labels, names)
+    scored = [r["score"] for r in regions if r["pixels"] > 0]
+    return {
+        "mode": mode,
+        "regions": regions,
+        "plaque_index": round(sum(scored) / len(scored), 2) if scored else 0.0,
+    }
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+每位病人的牙菌斑長期趨勢
+每次產生報告時將該次的指標追加到 <TRENDS_DIR>/<patientId>.jsonl，
+並以增量方式更新 <patientId>.summary.json（次數、平均、最小、最大、首次、最近）
+繪製趨勢頁只需讀取該病人的歷次記錄（O(visits)），不必重新處理任何圖片
+"""
+import os
+import json
+import time
+import threading
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TRENDS_DIR = os.getenv("TRENDS_DIR", os.path.join(BASE_DIR, "outputs", "trends"))
+
+_lock = threading.Lock()
+
+
+def _paths(patient_id):
+    safe = "".join(ch for ch in str(patient_id) if ch.isalnum() or ch in "-_")
+    if not safe:
+        raise ValueError(f"Invalid patient id: {patient_id!r}")
+    return (os.path.join(TRENDS_DIR, f"{safe}.jsonl"),
+            os.path.join(TRENDS_DIR, f"{safe}.summary.json"))
+
+
+def _parse_time(value):
+    """ISO 字串（含 Z 結尾）/ epoch 秒 -> UTC datetime；沒有時區的時間視為 UTC（與 metrics_index 相同）"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc)
+    text = str(value).strip()
+    try:
+        return datetime.fromtimestamp(float(text), timezone.utc)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _timestamp(value):
+    """ISO 字串 / epoch 秒 / None -> ISO 字串（UTC）；無法解析時拋出 ValueError"""
+    if value is None or value == "":
+        return datetime.now(timezone.utc).isoformat()
+    return _parse_time(value).isoformat()
+
+
+def _update_summary(summary, visit):
+    coverage = visit["coverage"]
+    count = summary.get("count", 0) + 1
+    summary.update({
+        "count": count,
+        "coverage_sum": summary.get("coverage_sum", 0.0) + coverage,
+        "coverage_min": min(summary.get("coverage_min", coverage), coverage),
+        "coverage_max": max(summary.get("coverage_max", coverage), coverage),
+        "first": summary.get("first", visit["timestamp"]),
+        "last": visit["timestamp"],
+        "last_coverage": coverage,
+    })
+    summary["coverage_mean"] = round(summary["coverage_sum"] / count, 4)
+    return summary
+
+
+def append_visit(patient_id, record_id, timestamp, coverage, plaque_pixels, plaque_index=None):
+    """
+    追加一次就診的指標並更新摘要；同一 record_id 重複產生報告時以最後一次為準
+    回傳該病人的完整歷史（依時間排序）
+    """
+    os.makedirs(TRENDS_DIR, exist_ok=True)
+    history_path, summary_path = _paths(patient_id)
+    visit = {
+        "record_id": str(record_id),
+        "timestamp": _timestamp(timestamp),
+        "coverage": round(float(coverage), 4),
+        "plaque_pixels": int(plaque_pixels),
+        "plaque_index": plaque_index,
+        "generated_at": time.time(),
+    }
+    with _lock, open(summary_path, "a+", encoding="utf-8") as sf:
+        if fcntl is not None:
+            fcntl.flock(sf, fcntl.LOCK_EX)
+        try:
+            history = load_history(patient_id)
+            repeat = any(v["record_id"] == visit["record_id"] for v in history)
+            with open(history_path, "a", encoding="utf-8") as hf:
+                hf.write(json.dumps(visit) + "\n")
+            sf.seek(0)
+            try:
+                summary = json.loads(sf.read())
+            except ValueError:
+                summary = {}
+            if repeat:
+                # 重新產生的報告會取代舊值，摘要改由歷史重算
+                summary = {}
+                for v in _dedupe(history + [visit]):
+                    _update_summary(summary, v)
+            else:
+                _update_summary(summary, visit)
+            sf.seek(0)
+            sf.truncate()
+            sf.write(json.dumps(summary))
+        finally:
+            if fcntl is not None:
+                fcntl.flock(sf, fcntl.LOCK_UN)
+    return _dedupe(history + [visit])
+
+
+def _dedupe(visits):
+    latest = {}
+    for v in visits:
+        latest[v["record_id"]] = v
+    return sorted(latest.values(), key=_sort_key)
+
+
+def _sort_key(visit):
+    # 以時間排序而非字串排序；舊資料中無法解析的時間排在最後
+    try:
+        return _parse_time(visit["timestamp"]).timestamp()
+    except (TypeError, ValueError, OverflowError):
+        return float("inf")
+
+
+def load_history(patient_id):
+    history_path, _ = _paths(patient_id)
+    if not os.path.exists(history_path):
+        return []
+    visits = []
+    with open(history_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    visit = json.loads(line)
+                except ValueError:
+                    continue
+                try:
+                    # 舊版直接存入原始字串，讀取時統一成 UTC ISO 字串
+                    visit["timestamp"] = _timestamp(visit.get("timestamp"))
+                except (TypeError, ValueError, OverflowError):
+                    pass
+                visits.append(visit)
+    return _dedupe(visits)
+
+
+def load_summary(patient_id):
+    _, summary_path = _paths(patient_id)
+    if not os.path.exists(summary_path):
+        return {}
+    with open(summary_path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def draw_trend_chart(pdf, history, threshold=None, width=170, height=80):
+    """
+    以 FPDF 線條直接繪製覆蓋率趨勢圖（不需 matplotlib）
+    圖從目前游標位置開始，繪製後游標移到圖的下方
+    """
+    if not history:
+        return
+    font = pdf.font_family
+    left = pdf.l_margin + 12
+    top = pdf.get_y() + 4
+    plot_w = width - 12
+    plot_h = height
+
+    values = [v["coverage"] for v in history]
+    y_max = max(values + ([threshold] if threshold else []))
+    y_max = max(5.0, y_max * 1.15)
+
+    def point(i, value):
+        x = left + (plot_w * i / (len(history) - 1) if len(history) > 1 else plot_w / 2)
+        y = top + plot_h - plot_h * value / y_max
+        return x, y
+
+    # 座標軸與刻度
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_line_width(0.3)
+    pdf.line(left, top, left, top + plot_h)
+    pdf.line(left, top + plot_h, left + plot_w, top + plot_h)
+    pdf.set_font(font, "", 8)
+    for k in range(5):
+        value = y_max * k / 4
+        y = top + plot_h - plot_h * k / 4
+        pdf.line(left - 1.5, y, left, y)
+        pdf.set_xy(pdf.l_margin, y - 2)
+        pdf.cell(10, 4, f"{value:.0f}%", align="R")
+
+    # 門檻線（QR 觸發覆蓋率）
+    if threshold:
+        pdf.set_draw_color(220, 60, 60)
+        pdf.set_line_width(0.2)
+        _, y = point(0, threshold)
+        pdf.dashed_line(left, y, left + plot_w, y, 2, 1.5)
+
+    # 折線與資料點
+    pdf.set_draw_color(120, 40, 160)
+    pdf.set_fill_color(120, 40, 160)
+    pdf.set_line_width(0.6)
+    points = [point(i, v) for i, v in enumerate(values)]
+    for (x1, y1), (x2, y2) in zip(points, points[1:]):
+        pdf.line(x1, y1, x2, y2)
+    for x, y in points:
+        pdf.ellipse(x - 1, y - 1, 2, 2, style="F")
+
+    # X 軸日期標籤（最多約 8 個）
+    step = max(1, len(history) // 8)
+    for i in range(0, len(history), step):
+        x, _ = point(i, 0)
+        pdf.set_xy(x - 10, top + plot_h + 1)
+        pdf.cell(20, 4, history[i]["timestamp"][:10], align="C")
+
+    pdf.set_draw_color(0, 0, 0)
+    pdf.set_line_width(0.2)
+    pdf.set_xy(pdf.l_margin, top + plot_h + 8)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Grok (x.ai) 用戶端速率限制
+- 每分鐘請求數 (RPM) 與每分鐘 token 數 (TPM) 兩個 token bucket
+- 預估 prompt token（含圖片），額度不足時排隊等待而非讓請求失敗
+- 同一個 worker 內跨執行緒共用；設定 GROK_RATE_LIMIT_FILE 後以檔案鎖跨行程協調
+"""
+import os
+import sys
+import json
+import time
+import base64
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 沒有 fcntl，只做行程內限制
+    fcntl = None
+
+# 圖片 token 估算（OpenAI 相容的 tile 計算方式）
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+DEFAULT_IMAGE_SIZE = (1024, 1024)
+DEFAULT_COMPLETION_TOKENS = 1024
+
+
+def image_size_from_header(head):
+    """從 PNG/JPEG 檔頭位元組讀取 (寬, 高)，無法判斷時回傳 None"""
+    if head[:8] == b"\x89PNG\r\n\x1a\n" and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if head[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(head):
+            if head[i] != 0xFF:
+                i += 1
+                continue
+            marker = head[i + 1]
+            if marker in (0xC0, 0xC1, 0xC2):
+                h, w = struct.unpack(">HH", head[i + 5:i + 9])
+                return w, h
+            seg_len = struct.unpack(">H", head[i + 2:i + 4])[0]
+            i += 2 + seg_len
+    return None
+
+
+def _image_size(data_url):
+    """從 data URL 的檔頭讀取 PNG/JPEG 寬高，不解碼整張圖"""
+    try:
+        b64 = data_url.split(",", 1)[-1]
+        head = base64.b64decode(b64[:87384] + "=" * (-len(b64[:87384]) % 4))
+    except Exception:
+        return DEFAULT_IMAGE_SIZE
+    return image_size_from_header(head) or DEFAULT_IMAGE_SIZE
+
+
+def _image_tokens(width, height):
+    # 先縮放至 2048 內，再將短邊縮至 768，最後以 512px tile 計數
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // IMAGE_TILE_SIZE) * -(-int(height) // IMAGE_TILE_SIZE)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """預估一次 chat/completions 請求會消耗的 token（prompt + completion 上限）"""
+    total = 0
+    for message in messages:
+        content = message.get("content", "")
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        total += 4
+        for part in parts:
+            if part.get("type") == "text":
+                # 約 4 個字元 1 token；CJK 字元約 1 字 1 token
+                text = part.get("text", "")
+                wide = sum(1 for ch in text if ord(ch) > 0x2E7F)
+                total += (len(text) - wide) // 4 + wide + 1
+            elif part.get("type") == "image_url":
+                total += _image_tokens(*_image_size(part["image_url"]["url"]))
+    return total + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+class RateLimiter:
+    """RPM / TPM 雙 token bucket；acquire() 會阻塞直到兩者皆有額度；rpm / tpm 為 0 表示該項不限制"""
+
+    def __init__(self, rpm, tpm, state_file=None):
+        self.rpm = max(0.0, float(rpm))
+        self.tpm = max(0.0, float(tpm))
+        self.state_file = state_file if fcntl is not None else None
+        self._lock = threading.Lock()
+        self._state = {"requests": self.rpm, "tokens": self.tpm, "ts": time.time()}
+
+    # ---- 狀態存取（行程內或檔案） ----
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state["ts"])
+        # 限制為 0 時 bucket 恆為 0，acquire 不檢查該項
+        state["requests"] = min(self.rpm, state["requests"] + elapsed * self.rpm / 60.0)
+        state["tokens"] = min(self.tpm, state["tokens"] + elapsed * self.tpm / 60.0)
+        state["ts"] = now
+        return state
+
+    def _update(self, fn):
+        """在鎖內讀取、修改並寫回 bucket 狀態"""
+        with self._lock:
+            if not self.state_file:
+                return fn(self._state)
+            with open(self.state_file, "a+", encoding="utf-8") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = {"requests": self.rpm, "tokens": self.tpm, "ts": time.time()}
+                    result = fn(state)
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                    return result
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # ---- 公開介面 ----
+
+    def acquire(self, tokens=0):
+        """取得一個請求與 tokens 的額度；不足時排隊等待，回傳等待秒數"""
+        if not self.rpm and not self.tpm:
+            return 0.0
+        requests = 1 if self.rpm else 0
+        tokens = min(float(tokens), self.tpm)
+
+        def take(state):
+            self._refill(state, time.time())
+            if state["requests"] >= requests and state["tokens"] >= tokens:
+                state["requests"] -= requests
+                state["tokens"] -= tokens
+                return 0.0
+            need_req = max(0.0, requests - state["requests"]) * 60.0 / self.rpm if self.rpm else 0.0
+            need_tok = max(0.0, tokens - state["tokens"]) * 60.0 / self.tpm if self.tpm else 0.0
+            return max(need_req, need_tok, 0.01)
+
+        waited = 0.0
+        while True:
+            delay = self._update(take)
+            if delay == 0.0:
+                if waited:
+                    print(f"[RateLimit] queued {waited:.1f}s for {int(tokens)} tokens", file=sys.stderr)
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    def settle(self, estimated, actual):
+        """以回應中的實際 usage 修正預估值（多扣的退回，少扣的補扣）"""
+        if actual is None or not self.tpm:
+            return
+
+        def adjust(state):
+            self._refill(state, time.time())
+            state["tokens"] = min(self.tpm, state["tokens"] + float(estimated) - float(actual))
+
+        self._update(adjust)
+
+
+GROK_LIMITER = RateLimiter(
+    rpm=os.getenv("GROK_RPM", "60"),
+    tpm=os.getenv("GROK_TPM", "100000"),
+    state_file=os.getenv("GROK_RATE_LIMIT_FILE") or None,
+)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+預先產生的建議庫（依覆蓋率區間 × 語言）
+大部分報告落在少數幾個覆蓋率區間，同一區間、同一語言的 AI 建議幾乎相同；
+離線以 report_engine.ask_grok 為每個區間產生一次結構化建議，經臨床人員核可後存成本地 JSON，
+產生報告時直接選用並填入本次量測值，不需要網路
+
+用法：
+    python recommendation_library.py build [--langs en,zh,...] [--bands minimal,light,...] [--force]
+    python recommendation_library.py list
+    python recommendation_library.py show <band> <lang>
+    python recommendation_library.py approve (<band> <lang> | --all) --by <name>
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ADVICE_LIBRARY = os.getenv("ADVICE_LIBRARY", os.path.join(BASE_DIR, "advice_library.json"))
+# 未核可的建議預設不會用於報告
+ADVICE_ALLOW_UNAPPROVED = os.getenv("ADVICE_ALLOW_UNAPPROVED", "0") == "1"
+
+# 覆蓋率 (%) 區間上限，最後一個區間沒有上限
+ADVICE_BAND_EDGES = [float(x) for x in os.getenv("ADVICE_BANDS", "2,5,10,20").split(",") if x.strip()]
+DEFAULT_BAND_NAMES = ["minimal", "light", "moderate", "heavy", "severe"]
+BAND_NAMES = (DEFAULT_BAND_NAMES if len(ADVICE_BAND_EDGES) == 4
+              else [f"band_{i}" for i in range(len(ADVICE_BAND_EDGES) + 1)])
+
+_lock = threading.Lock()
+_cache = {"mtime": None, "library": None}
+
+
+def band_for(coverage):
+    """覆蓋率 -> 區間名稱"""
+    for edge, name in zip(ADVICE_BAND_EDGES, BAND_NAMES):
+        if coverage < edge:
+            return name
+    return BAND_NAMES[-1]
+
+
+def band_range(name):
+    """區間名稱 -> (下限, 上限)；上限 None 表示沒有上限"""
+    i = BAND_NAMES.index(name)
+    low = ADVICE_BAND_EDGES[i - 1] if i > 0 else 0.0
+    high = ADVICE_BAND_EDGES[i] if i < len(ADVICE_BAND_EDGES) else None
+    return low, high
+
+
+def load(path=None):
+    """讀取建議庫；檔案未變更時使用快取"""
+    path = path or ADVICE_LIBRARY
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {"bands": ADVICE_BAND_EDGES, "entries": {}}
+    with _lock:
+        if _cache["mtime"] != (path, mtime):
+            with open(path, "r", encoding="utf-8") as f:
+                _cache["library"] = json.load(f)
+            _cache["mtime"] = (path, mtime)
+        return _cache["library"]
+
+
+def save(library, path=None):
+    """寫入暫存檔後改名，讀取端不會看到寫到一半的檔案"""
+    path = path or ADVICE_LIBRARY
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(library, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _personalize(entry, metrics, lang):
+    """在庫存建議前加上本次量測值（覆蓋率、分區指數）"""
+    import report_engine
+    advice = {key: entry[key] for key in ("risk_level", "summary", "key_findings", "hygiene_steps")}
+    measured = [f"{report_engine.t('coverage', lang)}: {metrics['coverage_percent']:.2f}%"]
+    if metrics.get("plaque_index") is not None:
+        measured.append(f"{report_engine.t('regional_index', lang)}: {metrics['plaque_index']:.2f} / 3")
+    advice["key_findings"] = measured + list(advice["key_findings"])
+    return advice
+
+
+def select(metrics, lang="en", path=None):
+    """
+    依覆蓋率區間與語言選出建議並填入量測值；沒有可用（已核可）的項目時回傳 None
+    量測值只是顏色門檻估計（不明確）時也回傳 None，交由 LLM 看圖判斷
+    """
+    if not metrics or metrics.get("source") != "geometry":
+        return None
+    library = load(path)
+    if library.get("bands") != ADVICE_BAND_EDGES:
+        print("[Advice] Library was built with different ADVICE_BANDS; ignoring it", file=sys.stderr)
+        return None
+    band = band_for(metrics["coverage_percent"])
+    entry = library["entries"].get(band, {}).get(lang)
+    if not entry or not (entry.get("approved") or ADVICE_ALLOW_UNAPPROVED):
+        return None
+    advice = _personalize(entry, metrics, lang)
+    advice["source"] = f"library:{band}"
+    return advice
+
+
+def build(langs=None, bands=None, force=False, path=None):
+    """離線為每個區間 × 語言呼叫一次 ask_grok（純文字量測值，不附圖），新項目標記為未核可"""
+    import report_engine
+    from plaque_geometry import COVERAGE_BASIS_TEETH
+    path = path or ADVICE_LIBRARY
+    library = load(path)
+    if library.get("bands") != ADVICE_BAND_EDGES:
+        library = {"bands": ADVICE_BAND_EDGES, "entries": {}}
+    langs = langs or list(report_engine.LANGUAGES)
+    bands = bands or BAND_NAMES
+    built = 0
+    for band in bands:
+        low, high = band_range(band)
+        # 以區間中點（最後一個區間取下限的 1.5 倍）作為代表值
+        coverage = (low + high) / 2 if high is not None else low * 1.5
+        metrics = {"coverage_percent": round(coverage, 2), "plaque_pixels": 0,
+                   "coverage_basis": COVERAGE_BASIS_TEETH, "source": "geometry"}
+        for lang in langs:
+            if not force and library["entries"].get(band, {}).get(lang):
+                continue
+            advice = report_engine.ask_grok([], lang, metrics, mode="structured")
+            if not isinstance(advice, dict):
+                print(f"[Advice] {band}/{lang} failed: {str(advice)[:200]}", file=sys.stderr)
+                continue
+            advice.update({
+                "coverage_range": [low, high],
+                "coverage_basis": metrics["coverage_basis"],
+                "model": report_engine.GROK_MODEL,
+                "generated_at": int(time.time()),
+                "approved": False,
+                "approved_by": None,
+            })
+            library["entries"].setdefault(band, {})[lang] = advice
+            built += 1
+            # 每筆完成即寫檔，中斷後重新執行會接續未完成的項目
+            save(library, path)
+            print(f"[Advice] Built {band}/{lang}", file=sys.stderr)
+    return built
+
+
+def approve(band=None, lang=None, by=None, path=None):
+    """標記為臨床核可；band / lang 為 None 時核可全部"""
+    path = path or ADVICE_LIBRARY
+    library = load(path)
+    count = 0
+    for b, per_lang in library["entries"].items():
+        for lg, entry in per_lang.items():
+            if band not in (None, b) or lang not in (None, lg):
+                continue
+            entry["approved"] = True
+            entry["approved_by"] = by
+            entry["approved_at"] = int(time.time())
+            count += 1
+    save(library, path)
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generated recommendation library")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build")
+    p_build.add_argument("--langs")
+    p_build.add_argument("--bands")
+    p_build.add_argument("--force", action="store_true")
+    sub.add_parser("list")
+    p_show = sub.add_parser("show")
+    p_show.add_argument("band")
+    p_show.add_argument("lang")
+    p_approve = sub.add_parser("approve")
+    p_approve.add_argument("band", nargs="?")
+    p_approve.add_argument("lang", nargs="?")
+    p_approve.add_argument("--all", action="store_true")
+    p_approve.add_argument("--by", required=True)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        built = build(args.langs.split(",") if args.langs else None,
+                      args.bands.split(",") if args.bands else None, args.force)
+        print(json.dumps({"built": built, "library": ADVICE_LIBRARY}))
+    elif args.command == "list":
+        for band, per_lang in load()["entries"].items():
+            for lang, entry in per_lang.items():
+                print(json.dumps({"band": band, "lang": lang, "risk_level": entry["risk_level"],
+                                  "approved": entry.get("approved", False),
+                                  "approved_by": entry.get("approved_by")}, ensure_ascii=False))
+    elif args.command == "show":
+        entry = load()["entries"].get(args.band, {}).get(args.lang)
+        print(json.dumps(entry, ensure_ascii=False, indent=2))
+    else:
+        if not args.all and not (args.band and args.lang):
+            parser.error("approve needs <band> <lang> or --all")
+        count = approve(None if args.all else args.band, None if args.all else args.lang, args.by)
+        print(json.dumps({"approved": count}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1112 @@
+#!/usr/bin/env python3
+"""
+口腔健康分析 / 報告引擎
+GUI（grok.py）與伺服器端報告（generate_report.py）共用的單一實作：
+- decode_and_save / run_roboflow / calculate_plaque_area：推論與牙菌斑面積
+- ask_grok：LLM 建議（速率限制、重試、記憶體預算）
+- get_or_make_qr / create_pdf：多語系 PDF 報告
+語言一律以參數傳入，不依賴呼叫端的全域狀態；
+cv2 / numpy / fpdf / requests 只在使用時才載入，維持 CLI 的啟動預算
+"""
+import os
+import sys
+import json
+import time
+import base64
+import threading
+import contextvars
+from contextlib import contextmanager
+import memory_budget
+import plaque_trends
+from rate_limiter import GROK_LIMITER, estimate_tokens
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_FOLDER = os.path.join(BASE_DIR, "outputs")
+FONTS_DIR = os.getenv("FONTS_DIR", os.path.join(BASE_DIR, "fonts"))
+
+# Grok API 設定（使用 x.ai）
+GROK_API_KEY = os.getenv("GROK_API_KEY", os.getenv("CHATGPT_API_KEY", ""))  # 支援舊的環境變數名稱
+GROK_ENDPOINT = os.getenv("GROK_ENDPOINT", "https://api.x.ai/v1/chat/completions")
+GROK_MODEL = os.getenv("GROK_MODEL", "grok-4-1-fast-reasoning")
+# structured：JSON schema 結構化建議；text：舊版自由文字
+LLM_OUTPUT_MODE = os.getenv("LLM_OUTPUT_MODE", "structured")
+# 回覆 token 上限（控制延遲與成本）
+GROK_MAX_TOKENS = int(os.getenv("GROK_MAX_TOKENS", "800"))
+# 送出前把圖片長邊縮到此像素（0 = 原圖）
+GROK_IMAGE_MAX_SIDE = int(os.getenv("GROK_IMAGE_MAX_SIDE", "768"))
+# 每次呼叫的 token 用量追加到此 JSONL（空字串 = 不寫檔）
+LLM_USAGE_LOG = os.getenv("LLM_USAGE_LOG", "")
+# 附圖策略：auto（覆蓋率偏高或量測不明確時才附圖）/ always / never
+LLM_IMAGE_POLICY = os.getenv("LLM_IMAGE_POLICY", "auto")
+# auto 模式下，覆蓋率達此百分比即附圖（預設與 QR_TRIGGER_COVERAGE 相同）
+LLM_IMAGE_COVERAGE = float(os.getenv("LLM_IMAGE_COVERAGE", "10"))
+# 行程內只保留累計值（長時間執行的 watcher / queue worker 不會無限增長）；
+# 單一工作的用量由 collect_usage() 在該工作的階段中收集
+_usage_lock = threading.Lock()
+_usage_totals = None
+_usage_sink = contextvars.ContextVar("llm_usage_sink", default=None)
+
+# 建議來源：library（建議庫優先，沒有時呼叫 LLM）/ offline（只用建議庫）/ llm
+ADVICE_SOURCE = os.getenv("ADVICE_SOURCE", "library")
+
+RISK_LEVELS = ("low", "moderate", "high")
+ADVICE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "risk_level": {"type": "string", "enum": list(RISK_LEVELS)},
+        "summary": {"type": "string"},
+        "key_findings": {"type": "array", "items": {"type": "string"}},
+        "hygiene_steps": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["risk_level", "summary", "key_findings", "hygiene_steps"],
+    "additionalProperties": False
+}
+
+# 覆蓋率或像素數超過門檻時在報告中附上刷牙教學 QR
+QR_TRIGGER_COVERAGE = 10.0
+QR_TRIGGER_PIXELS = 100
+QR_IMAGE_PATH = os.path.join(BASE_DIR, "QR.png")
+QR_DATA = "Brush Your Teeth Properly!"
+
+FONT_URLS = {
+    "NotoSans": "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/hinted/ttf/NotoSans/NotoSans-Regular.ttf",
+    "NotoSansSC": "https://raw.githubusercontent.com/googlefonts/noto-cjk/main/Sans/OTF/SimplifiedChinese/NotoSansSC-Regular.otf",
+    "NotoSansTC": "https://raw.githubusercontent.com/googlefonts/noto-cjk/main/Sans/OTF/TraditionalChinese/NotoSansTC-Regular.otf",
+    "NotoSansJP": "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/unhinted/ttf/NotoSansJP/NotoSansJP-Regular.ttf",
+    "NotoNaskhArabic": "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/unhinted/ttf/NotoNaskhArabic/NotoNaskhArabic-Regular.ttf",
+    "NotoSansDevanagari": "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/unhinted/ttf/NotoSansDevanagari/NotoSansDevanagari-Regular.ttf",
+    "NotoSansThai": "https://raw.githubusercontent.com/googlefonts/noto-fonts/main/unhinted/ttf/NotoSansThai/NotoSansThai-Regular.ttf"
+}
+
+# 需要 HarfBuzz 字形排版的語言（連寫字母 / 組合字元）；其中 ar、ur 為右至左
+SHAPED_LANGUAGES = {"ar", "ur", "hi", "ne", "th"}
+RTL_LANGUAGES = {"ar", "ur"}
+
+# 語言 -> 字型
+LANGUAGE_FONTS = {
+    "zh": "NotoSansSC",
+    "zh_tw": "NotoSansTC",
+    "ja": "NotoSansJP",
+    "ar": "NotoNaskhArabic",
+    "ur": "NotoNaskhArabic",
+    "hi": "NotoSansDevanagari",
+    "ne": "NotoSansDevanagari",
+    "th": "NotoSansThai",
+    "en": "NotoSans",
+    "es": "NotoSans",
+    "de": "NotoSans",
+    "tl": "NotoSans"
+}
+
+LANGUAGES = {
+    "en": "English",
+    "zh": "中文 (简体)",
+    "zh_tw": "中文 (繁體)",
+    "ja": "日本語",
+    "es": "Español",
+    "ar": "العربية",
+    "de": "Deutsch",
+    "hi": "हिन्दी",
+    "ur": "اردو",
+    "ne": "नेपाली",
+    "tl": "Filipino",
+    "th": "ไทย"
+}
+
+translations = {
+    "title": {
+        "en": "Oral Health Assistant",
+        "zh": "口腔健康助手",
+        "zh_tw": "口腔健康助理",
+        "ja": "口腔ヘルスアシスタント",
+        "es": "Asistente de Salud Oral",
+        "ar": "مساعد صحة الفم",
+        "de": "Mundgesundheitsassistent",
+        "hi": "मौखिक स्वास्थ्य सहायक",
+        "ur": "منہ की صحت کا معاون",
+        "ne": "मुख स्वास्थ्य सहायक",
+        "tl": "Katulong sa Kalusugan ng Bibig",
+        "th": "ผู้ช่วยสุขภาพช่องปาก"
+    },
+    "roboflow_btn": {
+        "en": "Dental Plaque Detection",
+        "zh": "牙菌斑检测",
+        "zh_tw": "牙菌斑檢測",
+        "ja": "歯垢検出",
+        "es": "Detección de placa dental",
+        "ar": "كشف اللويحة السنية",
+        "de": "Plaque-Erkennung",
+        "hi": "दंत पट्टिका का पता लगाना",
+        "ur": "دانتوں की تختी की نشاندाही",
+        "ne": "दन्त पट्टिका पत्ता लगाउने",
+        "tl": "Pagtukoy ng Plaka sa Ngipin",
+        "th": "ตรวจหาคราบจุลินทรีย์"
+    },
+    "chatgpt_btn": {
+        "en": "Generate Report",
+        "zh": "生成报告",
+        "zh_tw": "生成報告",
+        "ja": "レポート生成",
+        "es": "Generar informe",
+        "ar": "إنشاء تقرير",
+        "de": "Bericht erstellen",
+        "hi": "रिपोर्ट तैयार करें",
+        "ur": "رپورٹ تیار کریں",
+        "ne": "रिपोर्ट तयार गर्नुहोस्",
+        "tl": "Gumawa ng Ulat",
+        "th": "สร้างรายงาน"
+    },
+    "roboflow_done": {
+        "en": "Analysis complete.\nSaved:",
+        "zh": "分析完成。\n保存到：",
+        "zh_tw": "分析完成。\n已儲存：",
+        "ja": "分析完了。\n保存先:",
+        "es": "Análisis completo.\nGuardado en:",
+        "ar": "اكتمل التحليل.\nتم الحفظ:",
+        "de": "Analyse abgeschlossen.\nGespeichert:",
+        "hi": "विश्लेषण पूरा हुआ।\nसहेजा गया:",
+        "ur": "تجزیہ مکمل۔\nمحفوظ کیا گیا:",
+        "ne": "विश्लेषण पूरा भयो।\nसञ्चय गरिएको:",
+        "tl": "Tapos na ang pagsusuri.\nNai-save:",
+        "th": "การวิเคราะห์เสร็จสิ้น\nบันทึกไว้ที่:"
+    },
+    "roboflow_error": {
+        "en": "Please run Roboflow first.",
+        "zh": "请先运行 Roboflow。",
+        "zh_tw": "請先執行 Roboflow。",
+        "ja": "先に Roboflow を実行してください。",
+        "es": "Ejecute Roboflow primero.",
+        "ar": "يرجى تشغيل Roboflow أولاً.",
+        "de": "Bitte zuerst Roboflow ausführen.",
+        "hi": "कृपया पहले Roboflow चलाएँ।",
+        "ur": "براہ کرم پہلے روبوفلو چلائیں۔",
+        "ne": "कृपया पहिले Roboflow चलाउनुहोस्।",
+        "tl": "Pakibuksan muna ang Roboflow.",
+        "th": "กรุณาเรียกใช้ Roboflow ก่อน"
+    },
+    "report_saved": {
+        "en": "Report saved to",
+        "zh": "报告已保存到",
+        "zh_tw": "報告已儲存到",
+        "ja": "レポートを保存しました:",
+        "es": "Informe guardado en",
+        "ar": "تم حفظ التقرير في",
+        "de": "Bericht gespeichert unter",
+        "hi": "रिपोर्ट सहेजी गई",
+        "ur": "رپورٹ محفوظ کی گئی",
+        "ne": "रिपोर्ट यो स्थानमा सुरक्षित गरियो",
+        "tl": "Nai-save ang ulat sa",
+        "th": "บันทึกรายงานไว้ที่"
+    },
+    "report_title": {
+        "en": "Oral Health Report",
+        "zh": "口腔健康报告",
+        "zh_tw": "口腔健康報告",
+        "ja": "口腔健康レポート",
+        "es": "Informe de Salud Oral",
+        "ar": "تقرير صحة الفم",
+        "de": "Bericht zur Mundgesundheit",
+        "hi": "मौखिक स्वास्थ्य रिपोर्ट",
+        "ur": "منہ کی صحت کی رپورٹ",
+        "ne": "मुख स्वास्थ्य प्रतिवेदन",
+        "tl": "Ulat sa Kalusugan ng Bibig",
+        "th": "รายงานสุขภาพช่องปาก"
+    },
+    "analysis_images": {
+        "en": "Roboflow Analysis Images:",
+        "zh": "Roboflow 分析图像：",
+        "zh_tw": "Roboflow 分析圖像：",
+        "ja": "Roboflow解析画像:",
+        "es": "Imágenes de análisis de Roboflow:",
+        "ar": "صور تحليل Roboflow:",
+        "de": "Roboflow-Analysebilder:",
+        "hi": "Roboflow विश्लेषण छवियाँ:",
+        "ur": "روبوفلو تجزیہ تصاویر:",
+        "ne": "Roboflow विश्लेषण छविहरू:",
+        "tl": "Mga Larawan ng Pagsusuri ng Roboflow:",
+        "th": "ภาพวิเคราะห์ของ Roboflow:"
+    },
+    "plaque_area": {
+        "en": "Plaque Area:",
+        "zh": "牙菌斑面积：",
+        "zh_tw": "牙菌斑面積：",
+        "ja": "歯垢エリア:",
+        "es": "Área de placa:",
+        "ar": "منطقة اللويحة:",
+        "de": "Plaquebereich:",
+        "hi": "पट्टिका क्षेत्र:",
+        "ur": "پلاک کا رقبہ:",
+        "ne": "पट्टिका क्षेत्र:",
+        "tl": "Lugar ng Plaka:",
+        "th": "พื้นที่คราบจุลินทรีย์:"
+    },
+    "pixels": {
+        "en": "Pixels",
+        "th": "พิกเซล",
+        "zh": "像素",
+        "zh_tw": "像素",
+        "ja": "ピクセル",
+        "es": "Píxeles",
+        "ar": "بكسل",
+        "de": "Pixel",
+        "hi": "पिक्सेल",
+        "ur": "پکسل",
+        "ne": "पिक्सेल",
+        "tl": "Mga Pixel"
+    },
+    "coverage": {
+        "en": "Coverage",
+        "th": "การครอบคลุม",
+        "zh": "覆盖率",
+        "zh_tw": "覆蓋率",
+        "ja": "カバー率",
+        "es": "Cobertura",
+        "ar": "التغطية",
+        "de": "Abdeckung",
+        "hi": "कवरेज",
+        "ur": "کوریج",
+        "ne": "कभर",
+        "tl": "Saklaw"
+    },
+    "recommendations": {
+        "en": "AI Recommendations:",
+        "zh": "AI 建议：",
+        "zh_tw": "AI 建議：",
+        "ja": "AI 推奨事項:",
+        "es": "Recomendaciones de IA:",
+        "ar": "توصيات الذكاء الاصطناعي:",
+        "de": "KI-Empfehlungen:",
+        "hi": "AI सिफारिशें:",
+        "ur": "AI سفارشات:",
+        "ne": "AI सिफारिसहरू:",
+        "tl": "Mga Rekomendasyon ng AI:",
+        "th": "คำแนะนำจาก AI:"
+    },
+    "language": LANGUAGES
+}
+
+
+translations.setdefault("qr_section_title", {
+    "en": "Next Steps",
+    "zh": "下一步",
+    "zh_tw": "下一步",
+    "ja": "次のステップ",
+    "es": "Próximos pasos",
+    "ar": "الخطوات التالية",
+    "de": "Nächste Schritte",
+    "hi": "अगले कदम",
+    "ur": "اگلے اقدامات",
+    "ne": "अर्को चरण",
+    "tl": "Susunod na mga Hakbang",
+    "th": "ขั้นตอนถัดไป"
+})
+translations.setdefault("qr_caption", {
+    "en": "Scan this QR to check how to brush teeth in a proper way!",
+    "zh": "扫描此二维码查看正确的刷牙方法。",
+    "zh_tw": "掃描此 QR 碼查看正確的刷牙方式。",
+    "ja": "このQRをスキャンして正しい歯みがき方法を確認しましょう。",
+    "es": "Escanee este código para ver cómo cepillarse los dientes correctamente.",
+    "ar": "امسح رمز الاستجابة السريعة لمشاهدة الطريقة الصحيحة لتنظيف الأسنان بالفرشاة.",
+    "de": "Scannen Sie diesen QR, um die richtige Zahnputztechnik zu sehen.",
+    "hi": "इस QR को स्कैन कर दाँत सही तरीके से ब्रश करना देखें।",
+    "ur": "اس QR کو اسکین کر کے دانت صحیح طریقے سے برش کرنے کا طریقہ دیکھیں۔",
+    "ne": "यो QR स्क्यान गरी दाँत सही तरिकाले ब्रस गर्ने तरिका हेर्नुहोस्।",
+    "tl": "I-scan ang QR para makita ang tamang paraan ng pagsesepilyo.",
+    "th": "สแกน QR นี้เพื่อดูวิธีแปรงฟันที่ถูกต้อง"
+})
+
+# 伺服器端報告的額外段落
+translations.setdefault("regional_index", {
+    "en": "Regional Plaque Index",
+    "zh": "分区牙菌斑指数",
+    "zh_tw": "分區牙菌斑指數",
+    "ja": "部位別歯垢指数",
+    "es": "Índice de placa por región",
+    "ar": "مؤشر اللويحة حسب المنطقة",
+    "de": "Regionaler Plaque-Index",
+    "hi": "क्षेत्रीय पट्टिका सूचकांक",
+    "ur": "علاقائی پلاک انڈیکس",
+    "ne": "क्षेत्रीय पट्टिका सूचकांक",
+    "tl": "Panrehiyong Indeks ng Plaka",
+    "th": "ดัชนีคราบจุลินทรีย์รายบริเวณ"
+})
+translations.setdefault("trend_title", {
+    "en": "Plaque Coverage Trend:",
+    "zh": "牙菌斑覆盖率趋势：",
+    "zh_tw": "牙菌斑覆蓋率趨勢：",
+    "ja": "歯垢カバー率の推移:",
+    "es": "Tendencia de cobertura de placa:",
+    "ar": "اتجاه تغطية اللويحة:",
+    "de": "Verlauf der Plaqueabdeckung:",
+    "hi": "पट्टिका कवरेज प्रवृत्ति:",
+    "ur": "پلاک کوریج کا رجحان:",
+    "ne": "पट्टिका कभर प्रवृत्ति:",
+    "tl": "Takbo ng Saklaw ng Plaka:",
+    "th": "แนวโน้มการครอบคลุมของคราบจุลินทรีย์:"
+})
+translations.setdefault("physio_title", {
+    "en": "Physiological Metrics:",
+    "zh": "生理指标：",
+    "zh_tw": "生理指標：",
+    "ja": "生理指標:",
+    "es": "Métricas fisiológicas:",
+    "ar": "المؤشرات الفسيولوجية:",
+    "de": "Physiologische Messwerte:",
+    "hi": "शारीरिक माप:",
+    "ur": "جسمانی پیمائشیں:",
+    "ne": "शारीरिक मापन:",
+    "tl": "Mga Sukatang Pisyolohikal:",
+    "th": "ตัวชี้วัดทางสรีรวิทยา:"
+})
+translations.setdefault("score", {
+    "en": "Score",
+    "zh": "评分",
+    "zh_tw": "評分",
+    "ja": "スコア",
+    "es": "Puntuación",
+    "ar": "الدرجة",
+    "de": "Wert",
+    "hi": "स्कोर",
+    "ur": "اسکور",
+    "ne": "अङ्क",
+    "tl": "Iskor",
+    "th": "คะแนน"
+})
+
+# 結構化建議（LLM_OUTPUT_MODE=structured）
+translations.setdefault("risk_level", {
+    "en": "Risk level",
+    "zh": "风险等级",
+    "zh_tw": "風險等級",
+    "ja": "リスクレベル",
+    "es": "Nivel de riesgo",
+    "ar": "مستوى الخطورة",
+    "de": "Risikostufe",
+    "hi": "जोखिम स्तर",
+    "ur": "خطرے کی سطح",
+    "ne": "जोखिम स्तर",
+    "tl": "Antas ng Panganib",
+    "th": "ระดับความเสี่ยง"
+})
+translations.setdefault("risk_low", {
+    "en": "Low",
+    "zh": "低",
+    "zh_tw": "低",
+    "ja": "低",
+    "es": "Bajo",
+    "ar": "منخفض",
+    "de": "Niedrig",
+    "hi": "कम",
+    "ur": "کم",
+    "ne": "कम",
+    "tl": "Mababa",
+    "th": "ต่ำ"
+})
+translations.setdefault("risk_moderate", {
+    "en": "Moderate",
+    "zh": "中",
+    "zh_tw": "中",
+    "ja": "中",
+    "es": "Moderado",
+    "ar": "متوسط",
+    "de": "Mittel",
+    "hi": "मध्यम",
+    "ur": "درمیانہ",
+    "ne": "मध्यम",
+    "tl": "Katamtaman",
+    "th": "ปานกลาง"
+})
+translations.setdefault("risk_high", {
+    "en": "High",
+    "zh": "高",
+    "zh_tw": "高",
+    "ja": "高",
+    "es": "Alto",
+    "ar": "مرتفع",
+    "de": "Hoch",
+    "hi": "उच्च",
+    "ur": "زیادہ",
+    "ne": "उच्च",
+    "tl": "Mataas",
+    "th": "สูง"
+})
+translations.setdefault("key_findings", {
+    "en": "Key findings:",
+    "zh": "主要发现：",
+    "zh_tw": "主要發現：",
+    "ja": "主な所見:",
+    "es": "Hallazgos principales:",
+    "ar": "النتائج الرئيسية:",
+    "de": "Wichtigste Befunde:",
+    "hi": "मुख्य निष्कर्ष:",
+    "ur": "اہم نتائج:",
+    "ne": "मुख्य निष्कर्षहरू:",
+    "tl": "Mahahalagang Natuklasan:",
+    "th": "ข้อค้นพบสำคัญ:"
+})
+translations.setdefault("hygiene_steps", {
+    "en": "Oral hygiene steps:",
+    "zh": "口腔清洁步骤：",
+    "zh_tw": "口腔清潔步驟：",
+    "ja": "口腔ケアの手順:",
+    "es": "Pasos de higiene oral:",
+    "ar": "خطوات نظافة الفم:",
+    "de": "Schritte zur Mundhygiene:",
+    "hi": "मौखिक स्वच्छता के चरण:",
+    "ur": "منہ کی صفائی کے اقدامات:",
+    "ne": "मुख सरसफाइका चरणहरू:",
+    "tl": "Mga Hakbang sa Kalinisan ng Bibig:",
+    "th": "ขั้นตอนการดูแลสุขภาพช่องปาก:"
+})
+
+
+def t(key, lang="en"):
+    """翻譯字串；該語言沒有翻譯時退回英文，再退回 key 本身"""
+    entry = translations.get(key, {})
+    return entry.get(lang) or entry.get("en", key)
+
+
+def font_path(name):
+    return os.path.join(FONTS_DIR, os.path.basename(FONT_URLS[name]))
+
+
+def ensure_fonts(names=None):
+    """下載缺少的字型（GUI 啟動時使用；伺服器端請預先放好 FONTS_DIR）"""
+    import requests
+    os.makedirs(FONTS_DIR, exist_ok=True)
+    for name in names or FONT_URLS:
+        filename = font_path(name)
+        if os.path.exists(filename):
+            continue
+        url = FONT_URLS[name]
+        print(f"[Font] Downloading {name} from {url}", file=sys.stderr)
+        try:
+            r = requests.get(url, timeout=30)
+            r.raise_for_status()
+            with open(filename, "wb") as f:
+                f.write(r.content)
+            print(f"[Font] Saved {filename}", file=sys.stderr)
+        except Exception as e:
+            print(f"[Font] Failed to download {name}: {e}", file=sys.stderr)
+
+
+def _add_font(pdf, name):
+    """以 fpdf2 的公開 API 加入字型（字型檔已快取在 FONTS_DIR，不必每次下載）"""
+    if name.lower() not in pdf.fonts:
+        pdf.add_font(name, "", font_path(name))
+
+
+def set_unicode_font(pdf, lang="en"):
+    """
+    設定該語言的 Noto 字型並回傳字型名稱；字型檔不存在時退回內建 Helvetica
+    - 非拉丁字型以 NotoSans 作為缺字備援（檔名、英文數字）
+    - 阿拉伯文 / 烏爾都文（RTL 與字母連寫）、天城文、泰文需要 HarfBuzz 字形排版
+    """
+    name = LANGUAGE_FONTS.get(lang, "NotoSans")
+    if not os.path.exists(font_path(name)):
+        print(f"[Font] {font_path(name)} not found; falling back to Helvetica", file=sys.stderr)
+        pdf.set_font("helvetica", "", 12)
+        return "helvetica"
+    _add_font(pdf, name)
+    if name != "NotoSans" and os.path.exists(font_path("NotoSans")):
+        _add_font(pdf, "NotoSans")
+        pdf.set_fallback_fonts(["NotoSans"])
+    if lang in SHAPED_LANGUAGES:
+        try:
+            # 段落方向由 bidi 演算法自動判斷，混合的拉丁文字與數字仍維持正確順序
+            pdf.set_text_shaping(use_shaping_engine=True)
+        except Exception as e:
+            print(f"[Font] Text shaping unavailable for {lang} ({e}); install uharfbuzz", file=sys.stderr)
+    pdf.set_font(name, "", 12)
+    return name
+
+
+def decode_and_save(image_data, name, out_dir=None):
+    """解碼 Base64 圖片並儲存（本地推論後端直接傳入 numpy 影像）"""
+    import cv2
+    import numpy as np
+    out_dir = out_dir or OUTPUT_FOLDER
+    os.makedirs(out_dir, exist_ok=True)
+    if isinstance(image_data, np.ndarray):
+        img = image_data
+    else:
+        img_bytes = base64.b64decode(image_data.split(",")[-1])
+        img_arr = np.frombuffer(img_bytes, dtype=np.uint8)
+        img = cv2.imdecode(img_arr, cv2.IMREAD_UNCHANGED)
+    filename = os.path.join(out_dir, f"{name}.png")
+    cv2.imwrite(filename, img)
+    return filename
+
+
+def save_visualizations(item, out_dir=None):
+    """推論結果 -> (已儲存的視覺化圖檔, plaque_geometry)；CPU 密集，與網路呼叫分開以便排程"""
+    import inference_backends
+    import plaque_geometry
+    saved_files = []
+    for key in inference_backends.VISUALIZATION_KEYS:
+        if key in item:
+            saved_files.append(decode_and_save(item[key], key, out_dir))
+    geometry = plaque_geometry.extract_geometry(item)
+    if geometry is None:
+        print("[INFO] No prediction polygons in result; falling back to pixel thresholding", file=sys.stderr)
+    return saved_files, geometry
+
+
+def run_roboflow(image_path, return_geometry=False, out_dir=None):
+    """
+    執行牙菌斑分析（後端由 INFERENCE_BACKEND 決定，預設 Roboflow）
+    return_geometry=True 時同時回傳 plaque_geometry 結構化資料（無 predictions 時為 None）
+    後端未設定時拋出 ValueError
+    """
+    import inference_backends
+    backend, item = inference_backends.run_inference(image_path)
+    print(f"[INFO] Inference backend: {backend}", file=sys.stderr)
+    saved_files, geometry = save_visualizations(item, out_dir)
+    if not return_geometry:
+        return saved_files
+    return saved_files, geometry
+
+
+def calculate_plaque_area(mask_path, geometry=None):
+    """計算牙菌斑面積（有 geometry 時直接使用精確值，不解碼圖片）"""
+    if geometry is not None:
+        return geometry["plaque_pixels"], geometry["coverage"]
+    import cv2
+    import numpy as np
+    mask = cv2.imread(mask_path)
+    if mask is None:
+        return 0, 0.0
+    hsv = cv2.cvtColor(mask, cv2.COLOR_BGR2HSV)
+    purple_mask = cv2.inRange(hsv, np.array([120,40,40]), np.array([160,255,255]))
+    plaque_area = cv2.countNonZero(purple_mask)
+    total_area = mask.shape[0] * mask.shape[1]
+    return plaque_area, (plaque_area / total_area) * 100
+
+
+def qr_triggered(px, pc):
+    return (pc >= QR_TRIGGER_COVERAGE) or (px >= QR_TRIGGER_PIXELS)
+
+
+def plaque_summary(image_files, geometry=None):
+    """各遮罩圖的牙菌斑面積與是否附上 QR（PDF 與 report_view 共用同一判斷）"""
+    rows = []
+    for img in image_files:
+        if "mask_visualization" in img and os.path.exists(img):
+            px, pc = calculate_plaque_area(img, geometry)
+            rows.append({"image": img, "plaque_pixels": px, "coverage": pc})
+    return {
+        "rows": rows,
+        "max_pixels": max((r["plaque_pixels"] for r in rows), default=0),
+        "max_coverage": max((r["coverage"] for r in rows), default=0.0),
+        "qr": any(qr_triggered(r["plaque_pixels"], r["coverage"]) for r in rows),
+    }
+
+
+def plaque_metrics(image_files, geometry=None, region_scores=None):
+    """整理要以文字傳給 LLM 的量測值（覆蓋率、像素數、分區指數）"""
+    mask_file = next((f for f in image_files if "mask_visualization" in f and os.path.exists(f)), None)
+    if mask_file is None:
+        return None
+    px, pc = calculate_plaque_area(mask_file, geometry)
+    metrics = {
+        "coverage_percent": round(pc, 2),
+        "plaque_pixels": int(px),
+        "coverage_basis": geometry["coverage_basis"] if geometry else "image",
+        # geometry：由預測多邊形精確計算；pixels：遮罩圖顏色門檻估計
+        "source": "geometry" if geometry else "pixels",
+    }
+    if region_scores:
+        metrics["plaque_index"] = region_scores["plaque_index"]
+        metrics["regions"] = [
+            {"region": r["region"], "coverage_percent": r["coverage"], "score": r["score"]}
+            for r in region_scores["regions"]
+        ]
+    return metrics
+
+
+def _metrics_text(metrics):
+    """量測值 -> 精簡的提示文字"""
+    lines = [
+        f"Plaque coverage: {metrics['coverage_percent']:.2f}% of {metrics['coverage_basis']} area "
+        f"({metrics['plaque_pixels']} px)."
+    ]
+    if metrics.get("plaque_index") is not None:
+        lines.append(f"Plaque index (0-3): {metrics['plaque_index']:.2f}.")
+    if metrics.get("regions"):
+        lines.append("Regions: " + "; ".join(
+            f"{r['region']} {r['coverage_percent']:.1f}% (score {r['score']})" for r in metrics["regions"]
+        ) + ".")
+    return " ".join(lines)
+
+
+def image_decision(metrics, policy=None):
+    """
+    決定這次呼叫是否需要附圖，回傳 (是否附圖, 原因)
+    auto：量測值明確且覆蓋率低於 LLM_IMAGE_COVERAGE 時只送文字；
+          沒有量測值、只有顏色門檻估計（source=pixels）或覆蓋率偏高時附圖
+    """
+    policy = policy or LLM_IMAGE_POLICY
+    if policy == "always":
+        return True, "policy=always"
+    if policy == "never":
+        return False, "policy=never"
+    if not metrics:
+        return True, "no metrics"
+    if metrics.get("source") != "geometry":
+        return True, "ambiguous: pixel-threshold estimate"
+    if metrics["coverage_percent"] >= LLM_IMAGE_COVERAGE:
+        return True, f"coverage {metrics['coverage_percent']:.2f}% >= {LLM_IMAGE_COVERAGE:g}%"
+    return False, f"coverage {metrics['coverage_percent']:.2f}% < {LLM_IMAGE_COVERAGE:g}%"
+
+
+def _image_url(path, max_side):
+    """圖片 -> data URL；超過 max_side 時先縮小並轉成 JPEG，減少圖片 token"""
+    dims = memory_budget.image_dimensions(path)
+    if max_side and dims and max(dims) > max_side:
+        import cv2
+        img = cv2.imread(path)
+        if img is not None:
+            scale = max_side / max(img.shape[:2])
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+            if ok:
+                return "data:image/jpeg;base64," + base64.b64encode(buf.tobytes()).decode("ascii")
+    return f"data:image/png;base64,{memory_budget.b64encode_file(path)}"
+
+
+def _log_usage(mode, model, usage, latency_ms, images, request_bytes):
+    """每次呼叫的 token 用量與延遲：stderr、行程內累計，設定 LLM_USAGE_LOG 時追加 JSONL"""
+    entry = {
+        "ts": round(time.time(), 3),
+        "mode": mode,
+        "model": model,
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "total_tokens": usage.get("total_tokens"),
+        "latency_ms": round(latency_ms, 1),
+        "images": images,
+        "request_bytes": request_bytes,
+    }
+    global _usage_totals
+    with _usage_lock:
+        _usage_totals = _add_usage(_usage_totals, entry)
+    sink = _usage_sink.get()
+    if sink is not None:
+        sink.append(entry)
+    print(f"[LLM] mode={mode} model={model} prompt={entry['prompt_tokens']} "
+          f"completion={entry['completion_tokens']} latency={latency_ms:.0f}ms images={images} "
+          f"request={request_bytes / 1024:.1f}KB", file=sys.stderr)
+    if LLM_USAGE_LOG:
+        try:
+            with open(LLM_USAGE_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"[LLM] Could not write usage log: {e}", file=sys.stderr)
+
+
+def _add_usage(total, entry):
+    total = dict(total or {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0.0,
+                           "images": 0, "request_bytes": 0})
+    total["calls"] += 1
+    total["images"] += entry["images"]
+    total["request_bytes"] += entry["request_bytes"]
+    total["prompt_tokens"] += entry["prompt_tokens"] or 0
+    total["completion_tokens"] += entry["completion_tokens"] or 0
+    total["latency_ms"] = round(total["latency_ms"] + entry["latency_ms"], 1)
+    return total
+
+
+@contextmanager
+def collect_usage():
+    """收集此 context 中（含 model_router 的路由執行緒）每次 LLM 呼叫的用量，回傳 list"""
+    sink = []
+    token = _usage_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _usage_sink.reset(token)
+
+
+def usage_summary(entries=None):
+    """
+    LLM 呼叫的 token 合計，供報告 JSON 輸出
+    entries 為 collect_usage() 收集的單一工作用量；None 時回傳本行程的累計值
+    """
+    if entries is None:
+        with _usage_lock:
+            return dict(_usage_totals) if _usage_totals else None
+    total = None
+    for entry in entries:
+        total = _add_usage(total, entry)
+    return total
+
+
+def _parse_advice(text):
+    """解析 JSON 建議；格式不符時回傳 None（呼叫端改以純文字處理）"""
+    try:
+        advice = json.loads(text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(advice, dict) or not advice.get("hygiene_steps"):
+        return None
+    if advice.get("risk_level") not in RISK_LEVELS:
+        advice["risk_level"] = "moderate"
+    for key in ("key_findings", "hygiene_steps"):
+        advice[key] = [str(item) for item in advice.get(key) or []]
+    advice["summary"] = str(advice.get("summary", ""))
+    return advice
+
+
+def format_advice(advice, lang="en"):
+    """結構化建議 -> 純文字（GUI 訊息、舊流程使用）；字串原樣回傳"""
+    if isinstance(advice, str):
+        return advice
+    lines = [f"{t('risk_level', lang)}: {t('risk_' + advice['risk_level'], lang)}", "", advice["summary"], ""]
+    if advice["key_findings"]:
+        lines.append(t("key_findings", lang))
+        lines += [f"- {item}" for item in advice["key_findings"]]
+        lines.append("")
+    lines.append(t("hygiene_steps", lang))
+    lines += [f"{i}. {step}" for i, step in enumerate(advice["hygiene_steps"], 1)]
+    return "\n".join(lines)
+
+
+def ask_grok(image_files, lang="en", metrics=None, mode=None, model=None, deadline=None):
+    """
+    呼叫 Grok API 生成建議（OpenAI-compatible chat/completions）
+    model 預設為 GROK_MODEL；報告流程經由 model_router 依量測值選擇模型
+    deadline（time.monotonic 時間）：超過時 resilience.GROK 不再重試（model_router 的延遲預算）
+    - mode="structured"（預設，LLM_OUTPUT_MODE）：JSON schema 輸出，回傳 dict
+      （risk_level / summary / key_findings / hygiene_steps）；量測值以文字傳入，只附遮罩圖
+    - mode="text"：原本的自由文字，回傳 str
+    是否附圖由 image_decision() 依量測值決定（LLM_IMAGE_POLICY），不附圖時只送文字量測值
+    失敗時回傳以 "Error" 開頭的字串，不拋出例外
+    """
+    if not GROK_API_KEY:
+        return "Error: GROK_API_KEY not set. Please set GROK_API_KEY environment variable."
+
+    import requests
+    import resilience
+    mode = mode or LLM_OUTPUT_MODE
+    model = model or GROK_MODEL
+    structured = mode == "structured"
+    lang_name = LANGUAGES.get(lang, "English")
+    headers = {
+        "Authorization": f"Bearer {GROK_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    send_images, reason = image_decision(metrics)
+    if not metrics and not send_images:
+        # 沒有量測值時只送文字沒有意義
+        send_images, reason = True, "no metrics"
+    if send_images and not image_files:
+        send_images, reason = False, "no images"
+    facts = _metrics_text(metrics) + " " if metrics else ""
+    if structured:
+        prompt = (
+            "You are a professional dentist. "
+            + ("The image is an AI plaque segmentation: purple marks dental plaque. " if send_images
+               else "An AI plaque segmentation of the patient's teeth measured: ")
+            + facts
+            + "Assess the patient's plaque risk, list the key findings and give numbered, practical oral hygiene steps. "
+            f"Be concise. Write all text in {lang_name}."
+        )
+        # 量測值已在文字中，只附遮罩圖即可
+        images = [f for f in image_files if "mask_visualization" in f] or list(image_files)
+    elif send_images:
+        prompt = (
+            "You are a professional dentist. "
+            "The attached images are AI-analyzed outputs from Roboflow: the purple mask highlights areas of dental plaque. "
+            "Based on these plaque areas, explain to the patient what this means for their oral health and provide clear, "
+            "step-by-step instructions on how to maintain proper oral hygiene. "
+            f"Write your response in {lang_name}."
+        )
+        images = list(image_files)
+    else:
+        prompt = (
+            "You are a professional dentist. "
+            "An AI plaque analysis of the patient's teeth measured: " + facts
+            + "Explain to the patient what this means for their oral health and provide clear, "
+            "step-by-step instructions on how to maintain proper oral hygiene. "
+            f"Write your response in {lang_name}."
+        )
+    if not send_images:
+        images = []
+    print(f"[LLM] images={'yes' if send_images else 'no'} ({reason})", file=sys.stderr)
+
+    content = [{"type": "text", "text": prompt}]
+    for img in images:
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": _image_url(img, GROK_IMAGE_MAX_SIDE)}
+        })
+
+    data = {
+        "model": model,
+        "messages": [
+            {"role": "user", "content": content}
+        ],
+        # Optional: keep responses consistent
+        "temperature": 0.4,
+        "max_tokens": GROK_MAX_TOKENS
+    }
+    if structured:
+        data["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "oral_health_advice", "strict": True, "schema": ADVICE_SCHEMA}
+        }
+
+    try:
+        estimated = estimate_tokens(data["messages"], GROK_MAX_TOKENS)
+        request_bytes = len(json.dumps(data))
+        started = time.perf_counter()
+
+        def send():
+            # 每次嘗試（含重試與對沖）都先取得額度，額度不足時在此排隊，避免 429
+            GROK_LIMITER.acquire(estimated)
+            return resilience.GROK.session.post(GROK_ENDPOINT, headers=headers, json=data,
+                                                timeout=resilience.GROK.timeout)
+
+        r = resilience.GROK.call(send, deadline)
+
+        if r.status_code != 200:
+            # show server error body to help debug auth/endpoint/model issues
+            return f"Error {r.status_code}: {r.text}"
+
+        j = r.json()
+        usage = j.get("usage") or {}
+        GROK_LIMITER.settle(estimated, usage.get("total_tokens"))
+        _log_usage(mode, j.get("model", model), usage, (time.perf_counter() - started) * 1000, len(images),
+                   request_bytes)
+
+        # OpenAI-compatible shape:
+        # {"choices":[{"message":{"content":"..."}}]}
+        try:
+            text = j["choices"][0]["message"]["content"]
+        except Exception:
+            return f"Unexpected response format: {j}"
+        if not structured:
+            return text
+        advice = _parse_advice(text)
+        if advice is None:
+            print("[LLM] Response is not valid advice JSON; using it as plain text", file=sys.stderr)
+            return text
+        return advice
+
+    except requests.exceptions.Timeout:
+        return "Error: Request timeout. The Grok API took too long to respond."
+    except Exception as e:
+        return f"Error calling Grok API: {str(e)}"
+
+
+def get_advice(image_files, lang="en", metrics=None, source=None):
+    """
+    取得報告建議（ADVICE_SOURCE）：
+    - library（預設）：先查已核可的建議庫，沒有對應項目時才呼叫 LLM
+    - offline：只用建議庫，完全不連網；沒有項目時回傳錯誤字串
+    - llm：每次都呼叫 LLM
+    """
+    source = source or ADVICE_SOURCE
+    if source in ("library", "offline"):
+        import recommendation_library
+        advice = recommendation_library.select(metrics, lang)
+        if advice is not None:
+            print(f"[Advice] Using {advice['source']} ({lang})", file=sys.stderr)
+            return advice
+        if source == "offline":
+            return f"Error: No approved library advice for this report (lang={lang}) and ADVICE_SOURCE=offline"
+    import model_router
+    advice = model_router.ask(image_files, lang, metrics)
+    if isinstance(advice, dict):
+        advice["source"] = "llm"
+    return advice
+
+
+def get_or_make_qr():
+    """
+    取得 QR 圖片路徑：
+    - QR_IMAGE_PATH 存在時直接使用
+    - 否則以 qrcode 套件由 QR_DATA 產生
+    - 都不可行時回傳 None
+    """
+    if QR_IMAGE_PATH and os.path.exists(QR_IMAGE_PATH):
+        return QR_IMAGE_PATH
+    try:
+        import qrcode
+        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+        img = qrcode.make(QR_DATA)
+        out_path = os.path.join(OUTPUT_FOLDER, "qr_generated.png")
+        img.save(out_path)
+        print(f"[QR] Generated {out_path} for data: {QR_DATA}", file=sys.stderr)
+        return out_path
+    except Exception as e:
+        print(f"[QR] Could not generate QR (install 'qrcode' or provide QR_IMAGE_PATH): {e}", file=sys.stderr)
+        return None
+
+
+def _render_advice(pdf, advice, lang, font, align):
+    """結構化建議：風險等級、摘要、主要發現與編號的清潔步驟"""
+    from fpdf.enums import XPos, YPos
+    pdf.set_font(font, "", 12)
+    pdf.cell(0, 9, f"{t('risk_level', lang)}: {t('risk_' + advice['risk_level'], lang)}",
+             new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+    pdf.set_font(font, "", 11)
+    if advice["summary"]:
+        pdf.multi_cell(0, 7, advice["summary"], align=align, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.ln(3)
+    if advice["key_findings"]:
+        pdf.set_font(font, "", 12)
+        pdf.cell(0, 9, t("key_findings", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+        pdf.set_font(font, "", 11)
+        for item in advice["key_findings"]:
+            pdf.multi_cell(0, 7, f"- {item}", align=align, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.ln(3)
+    pdf.set_font(font, "", 12)
+    pdf.cell(0, 9, t("hygiene_steps", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+    pdf.set_font(font, "", 11)
+    for i, step in enumerate(advice["hygiene_steps"], 1):
+        pdf.multi_cell(0, 7, f"{i}. {step}", align=align, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+
+def _advice_strings(advice):
+    if isinstance(advice, dict):
+        return [advice["summary"] or "", *advice["key_findings"], *advice["hygiene_steps"]]
+    return [advice or ""]
+
+
+def _latin1(texts):
+    try:
+        for text in texts:
+            text.encode("latin-1")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def create_pdf(image_files, grok_text, save_path, lang="en", geometry=None, region_scores=None,
+               physio=None, trend=None):
+    """
+    生成 PDF 報告
+    grok_text 可為自由文字或 ask_grok 的結構化建議 (dict)
+    geometry / region_scores / physio / trend 皆為可選，沒有時略過對應段落
+    """
+    from fpdf import FPDF
+    from fpdf.enums import XPos, YPos
+    pdf = FPDF()
+    pdf.add_page()
+    font = set_unicode_font(pdf, lang)
+    if font == "helvetica":
+        # 內建字型只支援 Latin-1，標題改用英文；建議內容無法改寫，含非 Latin-1 字元時直接報錯
+        if not _latin1(_advice_strings(grok_text)):
+            raise ValueError(f"Font {font_path(LANGUAGE_FONTS.get(lang, 'NotoSans'))} is missing and the "
+                             f"{lang} advice cannot be rendered with the built-in Helvetica font; "
+                             f"install the font or generate the report in English")
+        lang = "en"
+    # 右至左語言的段落靠右對齊
+    align = "R" if lang in RTL_LANGUAGES else "L"
+
+    pdf.set_font(font, "", 16)
+    pdf.cell(0, 10, t("report_title", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align="C")
+
+    pdf.set_font(font, "", 12)
+    pdf.cell(0, 10, t("analysis_images", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+
+    for img in image_files:
+        if os.path.exists(img):
+            pdf.image(img, w=150)
+            pdf.ln(10)
+
+    pdf.add_page()
+    pdf.set_font(font, "", 12)
+    pdf.cell(0, 10, t("plaque_area", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+
+    summary = plaque_summary(image_files, geometry)
+    for row in summary["rows"]:
+        pdf.multi_cell(
+            0, 10,
+            f"{os.path.basename(row['image'])}:\n"
+            f"- {t('pixels', lang)}: {row['plaque_pixels']}\n"
+            f"- {t('coverage', lang)}: {row['coverage']:.2f}%"
+        )
+
+    if region_scores:
+        pdf.ln(4)
+        pdf.cell(
+            0, 10,
+            f"{t('regional_index', lang)} ({region_scores['mode']}): {region_scores['plaque_index']:.2f} / 3",
+            new_x=XPos.LMARGIN, new_y=YPos.NEXT
+        )
+        pdf.set_font(font, "", 10)
+        for region in region_scores["regions"]:
+            pdf.cell(60, 7, region["region"])
+            pdf.cell(40, 7, f"{region['coverage']:.2f}%")
+            pdf.cell(0, 7, f"{t('score', lang)} {region['score']}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    if trend and len(trend) >= 2:
+        pdf.add_page()
+        pdf.set_font(font, "", 12)
+        pdf.cell(0, 10, t("trend_title", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+        plaque_trends.draw_trend_chart(pdf, trend, threshold=QR_TRIGGER_COVERAGE)
+        pdf.set_font(font, "", 10)
+        for visit in trend[-12:]:
+            pdf.cell(50, 6, visit["timestamp"][:10])
+            pdf.cell(0, 6, f"{visit['coverage']:.2f}%  ({visit['plaque_pixels']} px)",
+                     new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    if physio:
+        pdf.add_page()
+        pdf.set_font(font, "", 12)
+        pdf.cell(0, 10, t("physio_title", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+        for block, metrics in physio.items():
+            pdf.set_font(font, "", 11)
+            pdf.cell(0, 8, f"{block}:", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            pdf.set_font(font, "", 10)
+            for name, value in metrics.items():
+                pdf.cell(10, 6, "")
+                pdf.cell(60, 6, name)
+                pdf.cell(0, 6, "-" if value is None else f"{value:g}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+
+    pdf.add_page()
+    pdf.set_font(font, "", 12)
+    pdf.cell(0, 10, t("recommendations", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+    if isinstance(grok_text, dict):
+        _render_advice(pdf, grok_text, lang, font, align)
+    else:
+        pdf.multi_cell(0, 10, grok_text, align=align)
+
+    if summary["qr"]:
+        qr_path = get_or_make_qr()
+        if qr_path and os.path.exists(qr_path):
+            pdf.add_page()
+            pdf.set_font(font, "", 14)
+            pdf.cell(0, 10, t("qr_section_title", lang), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align=align)
+            pdf.set_font(font, "", 12)
+            pdf.multi_cell(0, 8, t("qr_caption", lang), align=align)
+
+            qr_w = 70  # mm
+            page_w = pdf.w - 2 * pdf.l_margin
+            x = pdf.l_margin + (page_w - qr_w) / 2
+            y = pdf.get_y() + 8
+            pdf.image(qr_path, x=x, y=y, w=qr_w)
+
+            pdf.set_xy(x, y + qr_w + 6)
+            if QR_DATA.startswith(("http://", "https://")):
+                pdf.set_text_color(0, 0, 255)
+                pdf.cell(0, 10, QR_DATA, link=QR_DATA)
+                pdf.set_text_color(0, 0, 0)
+            else:
+                pdf.cell(0, 10, QR_DATA)
+
+            pdf.ln(14)
+            pdf.set_font(font, "", 11)
+            pdf.multi_cell(
+                0, 7,
+                f"(QR shown because max coverage={summary['max_coverage']:.2f}% "
+                f"or max pixels={summary['max_pixels']} "
+                f"exceeded thresholds {QR_TRIGGER_COVERAGE:.1f}% / {QR_TRIGGER_PIXELS} px.)"
+            )
+
+    pdf.output(save_path)
+    print(f"[PDF] Saved {save_path}", file=sys.stderr)
+    return save_path
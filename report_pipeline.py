@@ -0,0 +1,491 @@
+#!/usr/bin/env python3
+"""
+報告產生流程的階段圖 (DAG) 排程器
+每份報告拆成數個階段，依相依關係排程；不同報告的階段可以交錯執行：
+
+    quality (CPU) -> inference (I/O) -> decode (CPU) -> analyze (CPU) -> record (I/O) ─┬-> pdf (CPU)
+                                                                      └-> advice (I/O) ─┴-> view (I/O)
+
+- I/O 階段（推論 API、LLM、SQLite / 趨勢檔）在執行緒池執行，等待網路時不佔 CPU
+- CPU 階段（解碼、面積 / 分區計算、PDF）在行程池執行，不受 GIL 限制
+- 每個階段可限制同時執行數（STAGE_LIMITS），例如限制同時呼叫推論 API 的數量
+
+用法（批次，單機；多台機器分散處理見 batch_queue.py）：
+    python report_pipeline.py <jobs.jsonl>
+jobs.jsonl 每行一個工作：{"image": ..., "pdf": ..., "lang": "en", "record": "<record.json>", "profile": false}
+（加上 "view": "<name>.html" 時另外輸出網頁預覽，見 report_view.py）
+每個工作輸出一行與 generate_report.py 相同格式的 JSON
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import memory_budget
+
+PIPELINE_IO_WORKERS = int(os.getenv("PIPELINE_IO_WORKERS", "8"))
+PIPELINE_CPU_WORKERS = int(os.getenv("PIPELINE_CPU_WORKERS", str(os.cpu_count() or 2)))
+# auto：多個工作時 CPU 階段用行程池，單一工作（CLI）時用執行緒，省去建立行程的成本
+PIPELINE_CPU_EXECUTOR = os.getenv("PIPELINE_CPU_EXECUTOR", "auto")
+# 各階段同時執行上限，例如 "inference=4,pdf=2"；未列出的階段只受執行緒 / 行程池大小限制
+STAGE_LIMITS = os.getenv("STAGE_LIMITS", "")
+
+
+class StageError(Exception):
+    """階段的預期失敗，訊息直接作為報告 JSON 的 error；details 會併入 JSON（機器可讀的原因）"""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or {}
+
+
+class Stage:
+    def __init__(self, name, fn, deps=(), kind="io"):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.kind = kind
+
+
+def parse_limits(text):
+    limits = {}
+    for part in text.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = max(1, int(value))
+    return limits
+
+
+def _run_stage(name, fn, ctx):
+    """
+    在執行緒或行程池中執行一個階段，回傳 (新增的 context, 耗時 ms, 階段統計)
+    階段統計只屬於這個工作：LLM 用量、網路嘗試、記憶體預留、RSS 與剖析的記憶體配置
+    """
+    import resilience
+    import report_engine
+    started = time.perf_counter()
+    stats = {"allocations": None}
+    with report_engine.collect_usage() as usage, resilience.collect() as attempts, \
+            memory_budget.collect() as reservations:
+        if ctx.get("profile_dir"):
+            import job_profiler
+            result, stats["allocations"] = job_profiler.run_profiled(name, fn, ctx)
+        else:
+            result = fn(ctx)
+    result = result or {}
+    stats.update(llm_usage=usage, network=attempts, reservations=reservations)
+    # 行程池 worker 的 RSS 只能由階段帶回；主行程記錄階段結束時的 RSS
+    if multiprocessing.parent_process() is not None:
+        stats["worker_rss_mb"] = memory_budget.peak_rss_mb()
+    else:
+        stats["rss_mb"] = memory_budget.current_rss_mb()
+    return result, (time.perf_counter() - started) * 1000, stats
+
+
+class Scheduler:
+    """
+    依相依關係派送各工作的階段；每個階段一個等待佇列，
+    完成時的 callback 只做簿記並派送下一個可執行的階段，不會阻塞執行緒池
+    """
+
+    def __init__(self, stages, io_workers=None, cpu_workers=None, limits=None, cpu_executor="process"):
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = [stage.name for stage in stages]
+        self.limits = limits if limits is not None else parse_limits(STAGE_LIMITS)
+        self.io = ThreadPoolExecutor(io_workers or PIPELINE_IO_WORKERS, thread_name_prefix="stage-io")
+        cpu_workers = cpu_workers or PIPELINE_CPU_WORKERS
+        self._budget_file = None
+        if cpu_executor == "process":
+            # worker 各自的行程內預算互不相知，改以狀態檔共用同一份預算
+            self._budget_file = memory_budget.share_across_processes()
+            self.cpu = ProcessPoolExecutor(cpu_workers, initializer=memory_budget.attach,
+                                           initargs=(memory_budget.BUDGET.state_file,))
+        else:
+            self.cpu = ThreadPoolExecutor(cpu_workers, thread_name_prefix="stage-cpu")
+        self._cond = threading.Condition()
+        self._running = {name: 0 for name in self.order}
+        self._waiting = {name: deque() for name in self.order}
+
+    def close(self):
+        self.io.shutdown()
+        self.cpu.shutdown()
+        if self._budget_file:
+            memory_budget.unshare(self._budget_file)
+
+    # ---- 內部簿記（皆在 self._cond 內呼叫） ----
+
+    def _ready(self, job):
+        for name in self.order:
+            if name in job["started"]:
+                continue
+            if all(dep in job["done"] for dep in self.stages[name].deps):
+                job["started"].add(name)
+                self._waiting[name].append(job)
+
+    def _dispatch(self):
+        for name in self.order:
+            limit = self.limits.get(name)
+            queue = self._waiting[name]
+            while queue and (limit is None or self._running[name] < limit):
+                job = queue.popleft()
+                if job["error"] is not None:
+                    continue
+                stage = self.stages[name]
+                executor = self.cpu if stage.kind == "cpu" else self.io
+                self._running[name] += 1
+                job["inflight"] += 1
+                future = executor.submit(_run_stage, name, stage.fn, job["ctx"])
+                future.add_done_callback(lambda f, job=job, name=name: self._on_done(job, name, f))
+
+    def _on_done(self, job, name, future):
+        with self._cond:
+            self._running[name] -= 1
+            job["inflight"] -= 1
+            try:
+                result, elapsed, stats = future.result()
+                ctx = job["ctx"]
+                ctx.update(result)
+                ctx["timings"][name] = round(elapsed, 1)
+                if stats["allocations"] is not None:
+                    ctx.setdefault("allocations", {})[name] = stats["allocations"]
+                for key in ("llm_usage", "network", "reservations"):
+                    ctx["stats"][key].extend(stats[key])
+                for key in ("rss_mb", "worker_rss_mb"):
+                    if stats.get(key) is not None:
+                        ctx["stats"][key] = max(stats[key], ctx["stats"][key] or 0)
+                job["done"].add(name)
+            except Exception as e:
+                job["error"] = e
+                job["failed_stage"] = name
+            if job["error"] is None:
+                self._ready(job)
+            self._dispatch()
+            self._cond.notify_all()
+
+    def _finished(self, job):
+        # 失敗的工作不再派送新階段，等已送出的階段結束即可
+        if job["error"] is not None:
+            return job["inflight"] == 0
+        return len(job["done"]) == len(self.order)
+
+    # ---- 公開介面 ----
+
+    def run(self, contexts):
+        """執行所有工作，依輸入順序回傳 [(ctx, error, failed_stage)]"""
+        jobs = []
+        for ctx in contexts:
+            ctx.setdefault("timings", {})
+            ctx.setdefault("stats", {"llm_usage": [], "network": [], "reservations": [], "rss_mb": None,
+                                     "worker_rss_mb": None})
+            jobs.append({"ctx": ctx, "started": set(), "done": set(), "error": None, "failed_stage": None,
+                         "inflight": 0})
+        with self._cond:
+            for job in jobs:
+                self._ready(job)
+            self._dispatch()
+            while not all(self._finished(job) for job in jobs):
+                self._cond.wait()
+        return [(job["ctx"], job["error"], job["failed_stage"]) for job in jobs]
+
+
+# ---- 報告的各個階段（模組層級函式，才能送進行程池） ----
+
+def stage_quality(ctx):
+    """推論前的品質檢查；QUALITY_GATE=reject 時不合格的照片直接結束，不呼叫付費 API"""
+    import image_quality
+    if image_quality.QUALITY_GATE == "off":
+        return {"quality": None}
+    result = image_quality.check(ctx["image"], ctx.get("image_data"))
+    if not result["ok"]:
+        codes = ", ".join(r["code"] for r in result["reasons"])
+        print(f"[Quality] {os.path.basename(ctx['image'])}: {codes} ({result['elapsed_ms']}ms)", file=sys.stderr)
+        if image_quality.QUALITY_GATE == "reject":
+            raise StageError(f"Image quality check failed: {codes}", {"quality": result})
+    return {"quality": result}
+
+
+def _dedup_lookup(patient_id, image_path, data=None):
+    """同一病人的近似重複照片查詢；失敗時不影響報告，照常推論"""
+    import image_dedup
+    if not (image_dedup.DEDUP_ENABLED and patient_id):
+        return None
+    try:
+        return image_dedup.lookup(patient_id, image_path, data)
+    except Exception as e:
+        print(f"[WARN] Near-duplicate lookup failed: {e}", file=sys.stderr)
+        return None
+
+
+def stage_inference(ctx):
+    import inference_backends
+    record = {}
+    if isinstance(ctx.get("record"), dict):
+        record = ctx["record"]
+    elif ctx.get("record") and os.path.exists(ctx["record"]):
+        with open(ctx["record"], "r", encoding="utf-8") as f:
+            record = json.load(f)
+    patient_id = record.get("patientId") or ctx.get("patient_id")
+    data = ctx.get("image_data")
+
+    dedup = _dedup_lookup(patient_id, ctx["image"], data)
+    if dedup and dedup["reused"]:
+        item = dedup.pop("item")
+    else:
+        try:
+            with memory_budget.BUDGET.reserve(
+                    memory_budget.estimate_bytes([ctx["image"] if data is None else data], decoded_copies=3),
+                    "roboflow"):
+                backend, item = inference_backends.run_inference(ctx["image"], data)
+        except Exception as e:
+            print(f"[ERROR] Roboflow analysis failed: {e}", file=sys.stderr)
+            raise StageError(f"Roboflow analysis failed: {e}")
+        print(f"[INFO] Inference backend: {backend}", file=sys.stderr)
+        if dedup:
+            import image_dedup
+            dedup.pop("item")
+            dedup["key"] = image_dedup.remember(patient_id, dedup["hash"], item, ctx["image"], record.get("recordId"))
+    # 記憶體中的原圖之後用不到，不再於階段間傳遞
+    return {"item": item, "record_data": record, "patient_id": patient_id, "dedup": dedup, "image_data": None}
+
+
+def stage_decode(ctx):
+    import report_engine
+    image_files, geometry = report_engine.save_visualizations(ctx["item"], ctx.get("out_dir"))
+    if not image_files:
+        raise StageError("No analysis results from Roboflow")
+    # 原始推論結果（base64 圖片）之後用不到，不再於階段間傳遞
+    return {"item": None, "image_files": image_files, "geometry": geometry}
+
+
+def stage_analyze(ctx):
+    """分區牙菌斑指數、覆蓋率與 HRV / GSR 生理特徵"""
+    import report_engine
+    import plaque_regions
+    image_files, geometry = ctx["image_files"], ctx["geometry"]
+    mask_file = next((f for f in image_files if "mask_visualization" in f), None)
+    region_scores = plaque_regions.score_regions(mask_file, geometry)
+
+    record, physio = ctx["record_data"], None
+    if record:
+        import physiology
+        physio = physiology.extract_features([record])[0] or None
+
+    plaque = report_engine.calculate_plaque_area(mask_file, geometry) if mask_file else None
+    return {
+        "plaque": plaque,
+        "region_scores": region_scores,
+        "physio": physio,
+        "metrics": report_engine.plaque_metrics(image_files, geometry, region_scores),
+    }
+
+
+def _record_key(ctx, record):
+    """
+    指標索引的主鍵：PatientRecord 的 recordId；沒有時以病人 + 照片內容雜湊產生，
+    不同病人的同名檔案（例如 IMG_0001.jpg）不會互相覆蓋
+    """
+    if record.get("recordId"):
+        return record["recordId"]
+    patient = record.get("patientId") or ctx.get("patient_id") or "anonymous"
+    if ctx.get("image_data") is not None:
+        digest = hashlib.sha1(ctx["image_data"]).hexdigest()
+    else:
+        with memory_budget.mapped(ctx["image"]) as mm:
+            digest = hashlib.sha1(mm).hexdigest()
+    return f"{patient}:{os.path.basename(ctx['image'])}:{digest[:16]}"
+
+
+def stage_record(ctx):
+    """寫入指標索引與病人趨勢（失敗不影響報告）"""
+    import report_engine
+    import metrics_index
+    import plaque_trends
+    if not ctx["plaque"]:
+        return {"trend": None}
+    px, pc = ctx["plaque"]
+    geometry, record = ctx["geometry"], ctx["record_data"]
+    plaque_index = ctx["region_scores"]["plaque_index"] if ctx["region_scores"] else None
+    record_id = _record_key(ctx, record)
+    try:
+        metrics_index.record_metrics(
+            record_id, record.get("patientId"), record.get("UploadDateTime"), pc, px, plaque_index,
+            coverage_basis=geometry["coverage_basis"] if geometry else "image",
+            qr_triggered=report_engine.qr_triggered(px, pc),
+            language=ctx["lang"]
+        )
+    except Exception as e:
+        print(f"[WARN] Could not write metrics index: {e}", file=sys.stderr)
+    trend = None
+    if record.get("patientId"):
+        try:
+            trend = plaque_trends.append_visit(
+                record["patientId"], record_id, record.get("UploadDateTime"), pc, px, plaque_index
+            )
+        except Exception as e:
+            print(f"[WARN] Could not update plaque trend: {e}", file=sys.stderr)
+    return {"trend": trend}
+
+
+def stage_advice(ctx):
+    import report_engine
+    dedup, lang = ctx["dedup"], ctx["lang"]
+    if dedup and dedup["reused"]:
+        import image_dedup
+        # 沿用近似重複照片的推論結果時，量測值相同，同語言的建議也可直接沿用
+        advice = image_dedup.load_result(ctx["patient_id"], dedup["key"])["advice"].get(lang)
+        if advice is not None:
+            print(f"[Dedup] Reusing {lang} advice from {dedup['matched_image']}", file=sys.stderr)
+            return {"advice": advice}
+    with memory_budget.BUDGET.reserve(memory_budget.estimate_bytes(ctx["image_files"], decoded_copies=0), "grok"):
+        advice = report_engine.get_advice(ctx["image_files"], lang, ctx["metrics"])
+    if isinstance(advice, str) and advice.startswith("Error"):
+        print(f"[ERROR] {advice}", file=sys.stderr)
+        raise StageError(advice)
+    from_library = isinstance(advice, dict) and str(advice.get("source", "")).startswith("library")
+    if dedup and dedup["key"] and not from_library:
+        import image_dedup
+        image_dedup.remember_advice(ctx["patient_id"], dedup["key"], lang, advice)
+    return {"advice": advice}
+
+
+def stage_pdf(ctx):
+    import report_engine
+    with memory_budget.BUDGET.reserve(memory_budget.estimate_bytes(ctx["image_files"]), "pdf"):
+        pdf_path = report_engine.create_pdf(
+            ctx["image_files"], ctx["advice"], ctx["pdf"], ctx["lang"], ctx["geometry"],
+            ctx["region_scores"], ctx["physio"], ctx.get("trend")
+        )
+    return {"pdf_path": pdf_path}
+
+
+def stage_view(ctx):
+    """網頁預覽（HTML 片段 + JSON 報告模型）；工作沒有指定 view 時略過"""
+    if not ctx.get("view"):
+        return {"view_files": None}
+    import report_view
+    model = report_view.build_model(
+        ctx["image_files"], ctx["advice"], os.path.dirname(os.path.abspath(ctx["view"])), ctx["lang"],
+        ctx["geometry"], ctx["region_scores"], ctx["physio"], ctx.get("trend")
+    )
+    return {"view_files": report_view.write_view(model, ctx["view"])}
+
+
+REPORT_STAGES = [
+    Stage("quality", stage_quality, (), "cpu"),
+    Stage("inference", stage_inference, ("quality",), "io"),
+    Stage("decode", stage_decode, ("inference",), "cpu"),
+    Stage("analyze", stage_analyze, ("decode",), "cpu"),
+    Stage("record", stage_record, ("analyze",), "io"),
+    Stage("advice", stage_advice, ("analyze",), "io"),
+    Stage("pdf", stage_pdf, ("analyze", "record", "advice"), "cpu"),
+    Stage("view", stage_view, ("analyze", "record", "advice"), "io"),
+]
+
+
+# 只做分析與建議、不寫指標也不產生 PDF（上傳時預先執行，結果存在近似重複照片的快取中）
+PREPARE_STAGES = ("quality", "inference", "decode", "analyze", "advice")
+# 只輸出網頁預覽，不產生 PDF（列印或下載時才以完整流程產生）
+VIEW_STAGES = ("quality", "inference", "decode", "analyze", "record", "advice", "view")
+
+
+def stages_for(names):
+    """REPORT_STAGES 的子集合；不在子集合中的相依階段一併移除"""
+    return [Stage(s.name, s.fn, [d for d in s.deps if d in names], s.kind) for s in REPORT_STAGES if s.name in names]
+
+
+def new_job(image, pdf=None, lang="en", record=None, out_dir=None, profile=False, patient_id=None, view=None,
+            image_data=None):
+    """
+    image 為照片路徑；image_data 為記憶體中的編碼影像時 image 只作為名稱（見 mongo_photos.py）
+    record 為 PatientRecord JSON 檔的路徑或已載入的 dict
+    """
+    import job_profiler
+    report_path = pdf or view
+    profile_dir = (job_profiler.profile_dir_for(report_path)
+                   if report_path and (profile or job_profiler.REPORT_PROFILE) else None)
+    return {"image": image, "pdf": pdf, "lang": lang, "record": record, "out_dir": out_dir,
+            "profile_dir": profile_dir, "patient_id": patient_id, "view": view, "image_data": image_data}
+
+
+def _job_result(ctx, error=None, failed_stage=None):
+    if error is not None:
+        if isinstance(error, StageError):
+            return dict({"error": str(error)}, **error.details)
+        return {"error": str(error), "type": type(error).__name__, "stage": failed_stage}
+    import report_engine
+    import resilience
+    advice = ctx.get("advice")
+    trend = ctx.get("trend")
+    stats = ctx["stats"]
+    return {
+        "success": True,
+        "pdf_path": ctx.get("pdf_path"),
+        "view": ctx.get("view_files"),
+        "analysis_files": ctx["image_files"],
+        "plaque_geometry": ctx["geometry"],
+        "region_scores": ctx["region_scores"],
+        "physiology": ctx["physio"],
+        "trend_visits": len(trend) if trend else 0,
+        "quality": ctx["quality"],
+        "near_duplicate": ctx["dedup"],
+        "advice": advice if isinstance(advice, dict) else None,
+        # 只計入這個工作的階段（批次、watcher、queue worker 中不會累計前面的工作）
+        "llm_usage": report_engine.usage_summary(stats["llm_usage"]),
+        "network": resilience.metrics_summary(stats["network"]),
+        "memory": memory_budget.report(stats["reservations"], stats["rss_mb"], stats["worker_rss_mb"]),
+        "timings_ms": ctx["timings"],
+    }
+
+
+def job_result(ctx, error=None, failed_stage=None):
+    """工作結果 -> 與 generate_report.py 相同格式的 dict；剖析模式下（失敗的工作也）附上剖析檔"""
+    result = _job_result(ctx, error, failed_stage)
+    if ctx.get("profile_dir"):
+        import job_profiler
+        result["profile"] = job_profiler.write_job_profile(ctx["profile_dir"], ctx.get("allocations", {}))
+    return result
+
+
+def run_jobs(jobs, cpu_executor=None, stages=None):
+    """執行多個報告工作，依輸入順序回傳結果 dict；stages 預設為完整的 REPORT_STAGES"""
+    cpu_executor = cpu_executor or PIPELINE_CPU_EXECUTOR
+    if cpu_executor == "auto":
+        cpu_executor = "process" if len(jobs) > 1 else "thread"
+    scheduler = Scheduler(stages or REPORT_STAGES, cpu_executor=cpu_executor)
+    try:
+        return [job_result(*outcome) for outcome in scheduler.run(jobs)]
+    finally:
+        scheduler.close()
+
+
+def job_from_spec(spec):
+    """jobs.jsonl 的一行 -> new_job"""
+    pdf = spec["pdf"]
+    # 每個工作的分析圖存到各自的資料夾，避免同名檔案互相覆蓋
+    out_dir = spec.get("out_dir") or os.path.splitext(pdf)[0] + "_analysis"
+    return new_job(spec["image"], pdf, spec.get("lang", "en"), spec.get("record"), out_dir,
+                   spec.get("profile", False), view=spec.get("view"))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(json.dumps({"error": "Missing arguments", "usage": "python report_pipeline.py <jobs.jsonl>"}))
+        sys.exit(1)
+    jobs = []
+    with open(sys.argv[1], "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                jobs.append(job_from_spec(json.loads(line)))
+    started = time.perf_counter()
+    for result in run_jobs(jobs):
+        print(json.dumps(result, ensure_ascii=False))
+    print(f"[Pipeline] {len(jobs)} jobs in {time.perf_counter() - started:.2f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
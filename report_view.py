@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+報告的網頁預覽：與 create_pdf 相同的資料（分析圖、牙菌斑量測、分區指數、趨勢、生理指標、建議、QR 判斷）
+輸出成 JSON 報告模型與 HTML 片段，只做字串處理（不嵌入字型與圖片），數毫秒內完成；
+圖片以 URL 引用，內容不變時 etag 不變，可直接快取。PDF 只在列印或下載時才產生
+
+輸出：
+- <name>.json  報告模型（含 labels 翻譯，前端可自行排版）
+- <name>.html  HTML 片段（<section class="oral-report">，不含 <html>/<head>）
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+from html import escape
+
+import report_engine
+from report_engine import t
+
+# 圖片 src 的前綴（例如 API 提供檔案的路徑）；未設定時為相對於 HTML 檔的路徑
+VIEW_IMAGE_BASE = os.getenv("VIEW_IMAGE_BASE", "")
+MODEL_VERSION = 1
+# 每次重新產生都會改變的計時欄位（例如建議的 route.latency_ms），不納入 etag
+TIMING_KEYS = {"latency_ms", "elapsed_ms"}
+
+LABEL_KEYS = (
+    "report_title", "analysis_images", "plaque_area", "pixels", "coverage", "regional_index", "score",
+    "trend_title", "physio_title", "recommendations", "risk_level", "key_findings", "hygiene_steps",
+    "qr_section_title", "qr_caption",
+)
+
+
+def _src(path, view_dir, image_base):
+    rel = os.path.relpath(path, view_dir).replace(os.sep, "/")
+    return image_base + rel if image_base else rel
+
+
+def build_model(image_files, advice, view_dir, lang="en", geometry=None, region_scores=None,
+                physio=None, trend=None, image_base=None):
+    """報告資料 -> 可序列化的報告模型；QR 判斷與 create_pdf 相同（report_engine.plaque_summary）"""
+    image_base = VIEW_IMAGE_BASE if image_base is None else image_base
+    images = [f for f in image_files if os.path.exists(f)]
+    summary = report_engine.plaque_summary(images, geometry)
+    qr = {
+        "shown": summary["qr"],
+        "data": report_engine.QR_DATA,
+        "max_coverage": round(summary["max_coverage"], 2),
+        "max_pixels": int(summary["max_pixels"]),
+        "thresholds": {"coverage": report_engine.QR_TRIGGER_COVERAGE, "pixels": report_engine.QR_TRIGGER_PIXELS},
+        "src": None,
+    }
+    if qr["shown"]:
+        # 複製到預覽目錄，與分析圖一起以同一個前綴提供；已有時不再產生
+        local = os.path.join(view_dir, "qr.png")
+        qr_path = local if os.path.exists(local) else report_engine.get_or_make_qr()
+        if qr_path:
+            if qr_path != local:
+                os.makedirs(view_dir, exist_ok=True)
+                shutil.copyfile(qr_path, local)
+            qr["src"] = _src(local, view_dir, image_base)
+    labels = {key: t(key, lang) for key in LABEL_KEYS}
+    if isinstance(advice, dict):
+        labels["risk"] = t("risk_" + advice["risk_level"], lang)
+    model = {
+        "version": MODEL_VERSION,
+        "lang": lang,
+        "dir": "rtl" if lang in report_engine.RTL_LANGUAGES else "ltr",
+        "labels": labels,
+        "images": [{"name": os.path.basename(f), "src": _src(f, view_dir, image_base)} for f in images],
+        "plaque": [
+            {"image": os.path.basename(r["image"]), "plaque_pixels": int(r["plaque_pixels"]),
+             "coverage": round(r["coverage"], 2)}
+            for r in summary["rows"]
+        ],
+        "region_scores": region_scores,
+        "physiology": physio,
+        # 與 PDF 相同：至少兩次就診才顯示趨勢，最多列出最近 12 次
+        "trend": trend[-12:] if trend and len(trend) >= 2 else None,
+        "advice": advice if isinstance(advice, dict) else {"text": advice},
+        "qr": qr,
+    }
+    # etag 只取決於內容（不含計時欄位），內容不變時前端與代理伺服器可沿用快取
+    canonical = json.dumps(_without_timings(model), sort_keys=True, ensure_ascii=False, default=str)
+    model["etag"] = hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+    return model
+
+
+def _without_timings(value):
+    if isinstance(value, dict):
+        return {k: _without_timings(v) for k, v in value.items() if k not in TIMING_KEYS}
+    if isinstance(value, list):
+        return [_without_timings(v) for v in value]
+    return value
+
+
+def _table(rows, cls):
+    body = "".join("<tr>" + "".join(f"<td>{escape(str(c))}</td>" for c in row) + "</tr>" for row in rows)
+    return f'<table class="{cls}">{body}</table>'
+
+
+def render_html(model):
+    """報告模型 -> HTML 片段（所有文字皆經過 escape）"""
+    labels = model["labels"]
+    parts = [
+        f'<section class="oral-report" lang="{escape(model["lang"])}" dir="{model["dir"]}" '
+        f'data-etag="{model["etag"]}">',
+        f"<h2>{escape(labels['report_title'])}</h2>",
+        f"<h3>{escape(labels['analysis_images'])}</h3>",
+        '<div class="report-images">',
+    ]
+    for img in model["images"]:
+        parts.append(f'<figure><img src="{escape(img["src"])}" alt="{escape(img["name"])}" loading="lazy">'
+                     f'<figcaption>{escape(img["name"])}</figcaption></figure>')
+    parts.append("</div>")
+
+    parts.append(f"<h3>{escape(labels['plaque_area'])}</h3>")
+    parts.append(_table(
+        [[row["image"], f"{labels['pixels']}: {row['plaque_pixels']}", f"{labels['coverage']}: {row['coverage']:.2f}%"]
+         for row in model["plaque"]], "report-plaque"))
+
+    regions = model["region_scores"]
+    if regions:
+        parts.append(f"<h4>{escape(labels['regional_index'])} ({escape(regions['mode'])}): "
+                     f"{regions['plaque_index']:.2f} / 3</h4>")
+        parts.append(_table(
+            [[r["region"], f"{r['coverage']:.2f}%", f"{labels['score']} {r['score']}"] for r in regions["regions"]],
+            "report-regions"))
+
+    if model["trend"]:
+        parts.append(f"<h3>{escape(labels['trend_title'])}</h3>")
+        parts.append(_table(
+            [[v["timestamp"][:10], f"{v['coverage']:.2f}%", f"{v['plaque_pixels']} px"] for v in model["trend"]],
+            "report-trend"))
+
+    if model["physiology"]:
+        parts.append(f"<h3>{escape(labels['physio_title'])}</h3>")
+        for block, metrics in model["physiology"].items():
+            parts.append(f"<h4>{escape(block)}</h4>")
+            parts.append(_table(
+                [[name, "-" if value is None else f"{value:g}"] for name, value in metrics.items()],
+                "report-physio"))
+
+    advice = model["advice"]
+    parts.append(f'<div class="report-advice"><h3>{escape(labels["recommendations"])}</h3>')
+    if "text" in advice:
+        parts.append(f'<p style="white-space: pre-line">{escape(advice["text"] or "")}</p>')
+    else:
+        parts.append(f'<p class="risk risk-{escape(advice["risk_level"])}">'
+                     f"{escape(labels['risk_level'])}: {escape(labels['risk'])}</p>")
+        if advice["summary"]:
+            parts.append(f"<p>{escape(advice['summary'])}</p>")
+        if advice["key_findings"]:
+            parts.append(f"<h4>{escape(labels['key_findings'])}</h4><ul>")
+            parts += [f"<li>{escape(item)}</li>" for item in advice["key_findings"]]
+            parts.append("</ul>")
+        parts.append(f"<h4>{escape(labels['hygiene_steps'])}</h4><ol>")
+        parts += [f"<li>{escape(step)}</li>" for step in advice["hygiene_steps"]]
+        parts.append("</ol>")
+    parts.append("</div>")
+
+    qr = model["qr"]
+    if qr["shown"]:
+        parts.append(f'<div class="report-qr"><h3>{escape(labels["qr_section_title"])}</h3>'
+                     f"<p>{escape(labels['qr_caption'])}</p>")
+        if qr["src"]:
+            parts.append(f'<img src="{escape(qr["src"])}" alt="QR" width="200" height="200">')
+        parts.append(f"<p>{escape(qr['data'])}</p></div>")
+    parts.append("</section>")
+    return "\n".join(parts)
+
+
+def write_view(model, html_path):
+    """寫出 <name>.html 與 <name>.json；回傳兩者路徑與 etag"""
+    base = os.path.splitext(html_path)[0]
+    outputs = {"html": base + ".html", "json": base + ".json", "etag": model["etag"]}
+    os.makedirs(os.path.dirname(os.path.abspath(html_path)), exist_ok=True)
+    for path, text in ((outputs["html"], render_html(model)),
+                       (outputs["json"], json.dumps(model, ensure_ascii=False, default=str))):
+        # 先寫暫存檔再取代，讀取端不會讀到寫一半的快取
+        tmp = f"{path}.tmp{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    print(f"[View] Saved {outputs['html']} (etag {model['etag'][:12]})", file=sys.stderr)
+    return outputs
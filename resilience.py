@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+共用網路韌性層：Roboflow 與 Grok 呼叫共用
+- 可設定的 connect / read timeout
+- 帶抖動 (jitter) 的指數退避重試，並遵守 Retry-After
+- 可選的對沖請求 (hedged request)，截斷尾端延遲
+- 斷路器：上游故障時快速失敗
+- 記錄每次嘗試的指標
+"""
+import os
+import sys
+import time
+import random
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+
+import requests
+
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# 沒有 HTTP 狀態碼時，只有連線錯誤與逾時視為暫時性故障
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+METRICS_HISTORY = 200
+# collect() 期間的每次嘗試另外記到此 list，供單一工作的報告使用
+_attempt_sink = contextvars.ContextVar("resilience_attempt_sink", default=None)
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """斷路器開啟中，直接拒絕請求"""
+
+
+class CircuitBreaker:
+    """連續失敗達門檻即開啟；冷卻後放行一個試探請求 (half-open)"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """試探請求結束（不論結果）；避免未記錄成功或失敗時永遠停在 half-open"""
+        with self._lock:
+            self._probing = False
+
+
+class Upstream:
+    """
+    單一上游服務的韌性設定
+    設定值讀取 <PREFIX>_XXX 環境變數，未設定時退回 HTTP_XXX，再退回預設值
+    retry_read_timeouts=False：讀取逾時不重試（非冪等、依量計費的請求，例如 LLM）
+    """
+
+    def __init__(self, name, env_prefix, read_timeout=60, retry_read_timeouts=True):
+        def setting(key, default):
+            return _env_float(f"{env_prefix}_{key}", os.getenv(f"HTTP_{key}", default))
+
+        self.name = name
+        self.connect_timeout = setting("CONNECT_TIMEOUT", 10)
+        self.read_timeout = setting("READ_TIMEOUT", read_timeout)
+        self.retry_read_timeouts = retry_read_timeouts
+        self.max_retries = int(setting("MAX_RETRIES", 3))
+        self.backoff_base = setting("BACKOFF_BASE", 1.0)
+        self.backoff_max = setting("BACKOFF_MAX", 30.0)
+        # 0 表示不啟用對沖；>0 表示首個請求超過此秒數仍未回應即送出第二個
+        self.hedge_delay = setting("HEDGE_DELAY", 0)
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(setting("BREAKER_THRESHOLD", 5)),
+            reset_timeout=setting("BREAKER_RESET", 30.0),
+        )
+        self.session = requests.Session()
+        self._metrics = deque(maxlen=METRICS_HISTORY)
+        self._metrics_lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    # ---- 指標 ----
+
+    def _record(self, attempt, hedged, started, status=None, error=None):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        entry = {
+            "upstream": self.name,
+            "attempt": attempt,
+            "hedged": hedged,
+            "status": status,
+            "error": error,
+            "elapsed_ms": round(elapsed_ms, 1),
+        }
+        with self._metrics_lock:
+            self._metrics.append(entry)
+        sink = _attempt_sink.get()
+        if sink is not None:
+            sink.append(entry)
+        outcome = status if error is None else error
+        print(f"[NET] {self.name} attempt={attempt}{' (hedge)' if hedged else ''} "
+              f"-> {outcome} in {elapsed_ms:.0f}ms", file=sys.stderr)
+
+    def metrics(self):
+        with self._metrics_lock:
+            return list(self._metrics)
+
+    def summary(self, entries=None):
+        """最近 METRICS_HISTORY 次嘗試（或指定的 entries）的摘要"""
+        entries = self.metrics() if entries is None else entries
+        ok = [e for e in entries if e["error"] is None and e["status"] not in RETRYABLE_STATUS]
+        return {
+            "attempts": len(entries),
+            "succeeded": len(ok),
+            "hedged": sum(1 for e in entries if e["hedged"]),
+            "breaker": self.breaker.state,
+            "last_ms": entries[-1]["elapsed_ms"] if entries else None,
+        }
+
+    # ---- 重試 / 對沖 ----
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # full jitter: [0, base * 2^(attempt-1)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1))))
+
+    def _attempt(self, fn, attempt):
+        """執行單次嘗試；若設定 hedge_delay 則在延遲後送出對沖請求，取先完成者"""
+        if self.hedge_delay <= 0:
+            return self._timed(fn, attempt, hedged=False)
+
+        pool = ThreadPoolExecutor(max_workers=2)
+        context = contextvars.copy_context()
+        try:
+            # 在呼叫端的 context 中執行，collect() 才收得到對沖請求的指標
+            first = pool.submit(context.copy().run, self._timed, fn, attempt, False)
+            done, _ = wait([first], timeout=self.hedge_delay)
+            if done:
+                return first.result()
+            second = pool.submit(context.copy().run, self._timed, fn, attempt, True)
+            pending = {first, second}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None or not pending:
+                        return fut.result()
+        finally:
+            # 不等待落後的請求，讓它在背景結束
+            pool.shutdown(wait=False)
+
+    def _timed(self, fn, attempt, hedged):
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            self._record(attempt, hedged, started, status=_status_of(e), error=type(e).__name__)
+            raise
+        self._record(attempt, hedged, started, status=_status_of(result))
+        return result
+
+    def _retry_delay(self, attempt, retry_after, deadline):
+        """下次重試前的等待秒數；等待後會超過 deadline 時回傳 None（不再重試）"""
+        delay = self._backoff(attempt, retry_after)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def call(self, fn, deadline=None):
+        """
+        以重試、對沖與斷路器包裝任意單次呼叫
+        fn 回傳 requests.Response 時依狀態碼判斷是否重試；
+        拋出例外時，連線錯誤、逾時或可重試狀態碼會重試；其他例外直接拋出
+        最後一次仍為可重試狀態碼時回傳該 Response，交由呼叫端處理
+        deadline（time.monotonic 時間）：退避等待會超過此時間時不再重試
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name} circuit breaker is open; failing fast")
+            try:
+                result = self._attempt(fn, attempt)
+            except Exception as e:
+                status = _status_of(e)
+                if status is None and not isinstance(e, TRANSIENT_ERRORS):
+                    # 本地錯誤（ValueError、檔案不存在、JSON 解析等）：不重試，也不算上游故障
+                    raise
+                retryable = status is None or status in RETRYABLE_STATUS
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    # 上游有回應（例如 401），不算故障
+                    self.breaker.record_success()
+                if isinstance(e, requests.exceptions.ReadTimeout) and not self.retry_read_timeouts:
+                    # 請求可能已送達並計費，重送會重複計費
+                    raise
+                if not retryable or attempt > self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, _retry_after(getattr(e, "response", None)), deadline)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                self.breaker.release()
+
+            status = _status_of(result)
+            if status in RETRYABLE_STATUS:
+                self.breaker.record_failure()
+                if attempt > self.max_retries:
+                    return result
+                delay = self._retry_delay(attempt, _retry_after(result), deadline)
+                if delay is None:
+                    return result
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+    def post(self, url, deadline=None, **kwargs):
+        """requests.post 的韌性版本；預設套用 (connect, read) timeout"""
+        kwargs.setdefault("timeout", self.timeout)
+        return self.call(lambda: self.session.post(url, **kwargs), deadline)
+
+
+def _status_of(obj):
+    """從 Response 或例外中取出 HTTP 狀態碼（取不到則為 None）"""
+    if isinstance(obj, requests.Response):
+        return obj.status_code
+    status = getattr(obj, "status_code", None)
+    if status is None:
+        response = getattr(obj, "response", None)
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after(response):
+    """解析 Retry-After（秒數或 HTTP 日期）"""
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+ROBOFLOW = Upstream("roboflow", "ROBOFLOW")
+# LLM 推理可能超過一分鐘；chat completion 非冪等且依 token 計費，讀取逾時不重送
+GROK = Upstream("grok", "GROK", read_timeout=120, retry_read_timeouts=False)
+
+
+@contextmanager
+def collect():
+    """收集此 context 中的每次嘗試（單一工作的網路指標），回傳 list"""
+    sink = []
+    token = _attempt_sink.set(sink)
+    try:
+        yield sink
+    finally:
+        _attempt_sink.reset(token)
+
+
+def metrics_summary(entries=None):
+    """
+    所有上游的指標摘要，供報告 JSON 輸出
+    entries 為 collect() 收集的單一工作嘗試；None 時為各上游最近的嘗試
+    """
+    if entries is None:
+        return {u.name: u.summary() for u in (ROBOFLOW, GROK)}
+    return {u.name: u.summary([e for e in entries if e["upstream"] == u.name]) for u in (ROBOFLOW, GROK)}
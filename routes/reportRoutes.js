@@ -13,6 +13,45 @@ const execAsync = promisify(exec);
 const TEMP_FOLDER = path.join(__dirname, '..', 'temp');
 const OUTPUT_FOLDER = path.join(__dirname, '..', 'outputs');
 
+// 網頁預覽快取（每份記錄、每種語言一個資料夾：report.html / report.json 與分析圖）
+const VIEW_FOLDER = path.join(OUTPUT_FOLDER, 'views');
+
+// 使用虛擬環境中的 Python（如果存在），否則使用系統 Python
+function resolvePythonCmd() {
+  const venvPython = path.join(__dirname, '..', 'venv', 'bin', 'python3');
+  return require('fs').existsSync(venvPython) ? venvPython : 'python3';
+}
+
+// 從 process.env 傳遞給 Python 腳本的環境變數
+function buildPythonEnv(language, extra = {}) {
+  return {
+    ...process.env,
+    ROBOFLOW_API_KEY: process.env.ROBOFLOW_API_KEY || '',
+    WORKSPACE_NAME: process.env.WORKSPACE_NAME || '',
+    WORKFLOW_ID: process.env.WORKFLOW_ID || '',
+    GROK_API_KEY: process.env.GROK_API_KEY || process.env.CHATGPT_API_KEY || '',
+    GROK_ENDPOINT: process.env.GROK_ENDPOINT || 'https://api.x.ai/v1/chat/completions',
+    GROK_MODEL: process.env.GROK_MODEL || 'grok-4-1-fast-reasoning',
+    REPORT_LANGUAGE: language,
+    ...extra
+  };
+}
+
+// 記錄資訊與生理數據（HRV / GSR 原始陣列）寫入臨時 JSON，供 Python 計算特徵與長期趨勢
+async function writeRecordJson(patientId, recordId, record) {
+  const tempRecordPath = path.join(TEMP_FOLDER, `record_${recordId}_${Date.now()}.json`);
+  await fs.writeFile(tempRecordPath, JSON.stringify({
+    patientId: patientId,
+    recordId: recordId,
+    UploadDateTime: record.UploadDateTime,
+    HRV: record.HRV,
+    HRV2: record.HRV2,
+    GSR: record.GSR,
+    GSR2: record.GSR2
+  }));
+  return tempRecordPath;
+}
+
 // 確保資料夾存在
 (async () => {
   try {
@@ -65,9 +104,9 @@ router.get('/:patientId/:recordId', async (req, res) => {
       });
     }
 
-    // 複製到臨時資料夾（Python 腳本需要）
-    const tempImagePath = path.join(TEMP_FOLDER, `face_${recordId}_${Date.now()}${path.extname(photoPath)}`);
-    await fs.copyFile(photoPath, tempImagePath);
+    // Python 腳本直接讀取原圖（唯讀），同目錄 derivatives/ 下的衍生圖可跨報告重用
+
+    const tempRecordPath = await writeRecordJson(patientId, recordId, record);
 
     // 4. 生成 PDF 檔案路徑
     const pdfFileName = `report_${patientId}_${recordId}_${Date.now()}.pdf`;
@@ -75,34 +114,18 @@ router.get('/:patientId/:recordId', async (req, res) => {
 
     // 5. 呼叫 Python 腳本生成 PDF
     const pythonScript = path.join(__dirname, '..', 'generate_report.py');
-    // 使用虛擬環境中的 Python（如果存在），否則使用系統 Python
-    const venvPython = path.join(__dirname, '..', 'venv', 'bin', 'python3');
-    const pythonCmd = require('fs').existsSync(venvPython) ? venvPython : 'python3';
-    
-    // 設置環境變數（從 process.env 傳遞給 Python 腳本）
-    const roboflowApiKey = process.env.ROBOFLOW_API_KEY || '';
-    const workspaceName = process.env.WORKSPACE_NAME || '';
-    const workflowId = process.env.WORKFLOW_ID || '';
-    
+    const pythonCmd = resolvePythonCmd();
+    const env = buildPythonEnv(language);
+
     // 調試：檢查環境變數（不顯示完整 key）
+    const roboflowApiKey = env.ROBOFLOW_API_KEY;
     const maskedKey = roboflowApiKey ? `${roboflowApiKey.substring(0, 4)}...${roboflowApiKey.substring(roboflowApiKey.length - 4)}` : 'NOT SET';
     console.log(`[Report] Environment variables check:`);
     console.log(`[Report]   ROBOFLOW_API_KEY: ${maskedKey}`);
-    console.log(`[Report]   WORKSPACE_NAME: ${workspaceName}`);
-    console.log(`[Report]   WORKFLOW_ID: ${workflowId}`);
+    console.log(`[Report]   WORKSPACE_NAME: ${env.WORKSPACE_NAME}`);
+    console.log(`[Report]   WORKFLOW_ID: ${env.WORKFLOW_ID}`);
     
-    const env = {
-      ...process.env,
-      ROBOFLOW_API_KEY: roboflowApiKey,
-      WORKSPACE_NAME: workspaceName,
-      WORKFLOW_ID: workflowId,
-      GROK_API_KEY: process.env.GROK_API_KEY || process.env.CHATGPT_API_KEY || '',
-      GROK_ENDPOINT: process.env.GROK_ENDPOINT || 'https://api.x.ai/v1/chat/completions',
-      GROK_MODEL: process.env.GROK_MODEL || 'grok-4-1-fast-reasoning',
-      REPORT_LANGUAGE: language
-    };
-    
-    const command = `"${pythonCmd}" "${pythonScript}" "${tempImagePath}" "${pdfPath}" "${language}"`;
+    const command = `"${pythonCmd}" "${pythonScript}" "${photoPath}" "${pdfPath}" "${language}" "${tempRecordPath}"`;
 
     console.log(`[Report] Executing: ${command}`);
 
@@ -137,7 +160,7 @@ router.get('/:patientId/:recordId', async (req, res) => {
       if (result.error) {
         // 清理臨時檔案
         try {
-          await fs.unlink(tempImagePath);
+          await fs.unlink(tempRecordPath);
         } catch (e) {}
 
         return res.status(500).json({
@@ -152,7 +175,7 @@ router.get('/:patientId/:recordId', async (req, res) => {
       } catch (error) {
         // 清理臨時檔案
         try {
-          await fs.unlink(tempImagePath);
+          await fs.unlink(tempRecordPath);
         } catch (e) {}
 
         return res.status(500).json({
@@ -161,12 +184,28 @@ router.get('/:patientId/:recordId', async (req, res) => {
         });
       }
 
+      // 儲存牙菌斑結構化分析結果，之後可直接查詢覆蓋率或重新繪製遮罩
+      // 結構化 AI 建議（風險等級、發現、清潔步驟）也一併保存，供後續查詢與重用
+      const analysisUpdate = {};
+      if (result.plaque_geometry) analysisUpdate.PlaqueGeometry = result.plaque_geometry;
+      if (result.advice) analysisUpdate.AIAdvice = result.advice;
+      if (Object.keys(analysisUpdate).length > 0) {
+        try {
+          await PatientRecord.updateOne(
+            { _id: recordId },
+            { $set: analysisUpdate }
+          );
+        } catch (e) {
+          console.warn('[Report] Failed to save analysis results:', e);
+        }
+      }
+
       // 7. 讀取 PDF 檔案
       const pdfBuffer = await fs.readFile(pdfPath);
 
       // 8. 清理臨時檔案
       try {
-        await fs.unlink(tempImagePath);
+        await fs.unlink(tempRecordPath);
         // 可選：也可以刪除 PDF 檔案（如果不需要保留）
         // await fs.unlink(pdfPath);
       } catch (e) {
@@ -181,7 +220,7 @@ router.get('/:patientId/:recordId', async (req, res) => {
     } catch (execError) {
       // 清理臨時檔案
       try {
-        await fs.unlink(tempImagePath);
+        await fs.unlink(tempRecordPath);
       } catch (e) {}
 
       console.error('[Report] Python execution error:', execError);
@@ -202,6 +241,121 @@ router.get('/:patientId/:recordId', async (req, res) => {
   }
 });
 
+// 網頁預覽：HTML 片段（預設）或 JSON 報告模型（?format=json），不產生 PDF
+// 照片未變更時直接回傳快取（以 ETag 支援 304）；列印或下載時再呼叫上面的 PDF 路由
+router.get('/:patientId/:recordId/view', async (req, res) => {
+  try {
+    const { patientId, recordId } = req.params;
+    const { language = 'en', format = 'html' } = req.query;
+    if (!/^[a-z_]+$/i.test(language)) {
+      return res.status(400).json({ error: 'Invalid language' });
+    }
+
+    const record = await PatientRecord.findOne({
+      _id: recordId,
+      patientId: patientId
+    });
+    if (!record) {
+      return res.status(404).json({
+        error: 'Record not found',
+        message: '找不到指定的病人記錄'
+      });
+    }
+    if (!record.Photos || !record.Photos.FacePhoto) {
+      return res.status(400).json({
+        error: 'FacePhoto not found',
+        message: '此記錄中沒有 FacePhoto'
+      });
+    }
+
+    const photoPath = path.join(__dirname, '..', record.Photos.FacePhoto);
+    let photoStat;
+    try {
+      photoStat = await fs.stat(photoPath);
+    } catch (error) {
+      return res.status(404).json({
+        error: 'Photo file not found',
+        message: '圖片檔案不存在',
+        path: photoPath
+      });
+    }
+
+    const viewDir = path.join(VIEW_FOLDER, `${recordId}_${language}`);
+    const htmlPath = path.join(viewDir, 'report.html');
+    const jsonPath = path.join(viewDir, 'report.json');
+
+    // 快取比照片新時直接使用
+    let fresh = false;
+    try {
+      fresh = (await fs.stat(jsonPath)).mtimeMs >= photoStat.mtimeMs;
+    } catch (e) {}
+
+    if (!fresh) {
+      await fs.mkdir(viewDir, { recursive: true });
+      const tempRecordPath = await writeRecordJson(patientId, recordId, record);
+      const pythonScript = path.join(__dirname, '..', 'generate_report.py');
+      const env = buildPythonEnv(language, {
+        VIEW_IMAGE_BASE: `${req.baseUrl}/${patientId}/${recordId}/view/files/${language}/`
+      });
+      const command = `"${resolvePythonCmd()}" "${pythonScript}" "${photoPath}" "${htmlPath}" "${language}" "${tempRecordPath}" --view`;
+      try {
+        const { stdout } = await execAsync(command, {
+          timeout: 300000,
+          maxBuffer: 10 * 1024 * 1024,
+          env: env
+        });
+        const result = JSON.parse(stdout.trim());
+        if (result.error) {
+          return res.status(500).json({
+            error: 'Report view generation failed',
+            message: result.error
+          });
+        }
+      } catch (execError) {
+        console.error('[Report] Python execution error:', execError);
+        return res.status(500).json({
+          error: 'Python script execution failed',
+          message: execError.message,
+          details: execError.stderr || execError.stdout
+        });
+      } finally {
+        try {
+          await fs.unlink(tempRecordPath);
+        } catch (e) {}
+      }
+    }
+
+    const model = JSON.parse(await fs.readFile(jsonPath, 'utf8'));
+    const etag = `"${model.etag}"`;
+    res.setHeader('ETag', etag);
+    res.setHeader('Cache-Control', 'private, no-cache');
+    if (req.headers['if-none-match'] === etag) {
+      return res.status(304).end();
+    }
+    if (format === 'json') {
+      return res.json(model);
+    }
+    res.type('html').send(await fs.readFile(htmlPath, 'utf8'));
+  } catch (error) {
+    console.error('[Report] Error:', error);
+    res.status(500).json({
+      error: 'Internal server error',
+      message: error.message
+    });
+  }
+});
+
+// 網頁預覽引用的分析圖與 QR（只提供預覽資料夾中的檔案）
+router.get('/:patientId/:recordId/view/files/:language/:name', async (req, res) => {
+  const { recordId, language, name } = req.params;
+  const viewDir = path.join(VIEW_FOLDER, `${path.basename(recordId)}_${path.basename(language)}`);
+  res.sendFile(path.join(viewDir, path.basename(name)), { maxAge: '1h' }, (error) => {
+    if (error && !res.headersSent) {
+      res.status(404).json({ error: 'File not found' });
+    }
+  });
+});
+
 // 取得報告狀態（檢查記錄是否存在）
 router.get('/:patientId/:recordId/status', async (req, res) => {
   try {
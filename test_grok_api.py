@@ -109,6 +109,7 @@ def test_api():
             elif r.status_code == 429:
                 print("1. 請求過於頻繁，請稍後再試")
                 print("2. 檢查 API 使用配額")
+                print("3. 調低 GROK_RPM / GROK_TPM，讓報告產生器在用戶端排隊限速")
             else:
                 print("1. 檢查網路連接")
                 print("2. 稍後再試")
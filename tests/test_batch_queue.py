@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+import batch_queue
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = batch_queue.connect(str(tmp_path / "queue.sqlite3"))
+    yield conn
+    conn.close()
+
+
+def expire_leases(conn):
+    conn.execute("UPDATE jobs SET lease_expires = ? WHERE status = 'leased'", (time.time() - 1,))
+
+
+def test_claim_respects_limit_and_order(conn):
+    batch_queue.enqueue(conn, [{"n": i} for i in range(5)])
+    first = batch_queue.claim(conn, "a", 3)
+    second = batch_queue.claim(conn, "b", 3)
+    assert [spec["n"] for _, spec in first] == [0, 1, 2]
+    assert [spec["n"] for _, spec in second] == [3, 4]
+    assert batch_queue.claim(conn, "c", 3) == []
+    # 已領取但尚未完成的工作仍算未完成
+    assert batch_queue.pending_count(conn) == 5
+    for owner, jobs in (("a", first), ("b", second)):
+        for job_id, _ in jobs:
+            assert batch_queue.complete(conn, owner, job_id, {})
+    assert batch_queue.pending_count(conn) == 0
+
+
+def test_complete_records_done_and_failed(conn):
+    batch_queue.enqueue(conn, [{"n": 0}, {"n": 1}])
+    (ok, _), (bad, _) = batch_queue.claim(conn, "a", 2)
+    assert batch_queue.complete(conn, "a", ok, {"pdf": "x.pdf"})
+    assert batch_queue.complete(conn, "a", bad, {"error": "boom"})
+    manifest = batch_queue.manifest(conn)
+    assert (manifest["jobs"], manifest["done"], manifest["failed"]) == (2, 1, 1)
+    assert manifest["entries"][0]["result"] == {"pdf": "x.pdf"}
+
+
+def test_expired_lease_is_reclaimed_and_stale_owner_rejected(conn):
+    batch_queue.enqueue(conn, [{"n": 0}])
+    [(job_id, _)] = batch_queue.claim(conn, "a", 1)
+    expire_leases(conn)
+    assert batch_queue.claim(conn, "b", 1) == [(job_id, {"n": 0})]
+    assert not batch_queue.complete(conn, "a", job_id, {"pdf": "stale.pdf"})
+    assert batch_queue.heartbeat(conn, "a", [job_id]) == 0
+    assert batch_queue.heartbeat(conn, "b", [job_id]) == 1
+    assert batch_queue.complete(conn, "b", job_id, {"pdf": "fresh.pdf"})
+    entry = batch_queue.manifest(conn)["entries"][0]
+    assert entry["attempts"] == 2
+    assert entry["result"] == {"pdf": "fresh.pdf"}
+
+
+def test_job_fails_after_max_attempts(conn, monkeypatch):
+    monkeypatch.setattr(batch_queue, "QUEUE_MAX_ATTEMPTS", 2)
+    batch_queue.enqueue(conn, [{"n": 0}])
+    for owner in ("a", "b"):
+        assert len(batch_queue.claim(conn, owner, 1)) == 1
+        expire_leases(conn)
+    assert batch_queue.claim(conn, "c", 1) == []
+    entry = batch_queue.manifest(conn)["entries"][0]
+    assert entry["status"] == "failed"
+    assert "2 attempts" in entry["result"]["error"]
@@ -0,0 +1,58 @@
+import pytest
+
+import metrics_index
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "metrics.sqlite3")
+    rows = [
+        ("r1", "p1", "2024-01-15T10:00:00Z", 5.0, True),
+        ("r2", "p1", "2024-02-15T10:00:00Z", 15.0, True),
+        ("r3", "p2", "2024-02-20T10:00:00Z", 25.0, True),
+        ("r4", "p2", 1711929600, 35.0, False),  # 2024-04-01T00:00:00Z
+    ]
+    for record_id, patient_id, visit_time, coverage, qr in rows:
+        metrics_index.record_metrics(record_id, patient_id, visit_time, coverage, int(coverage * 10),
+                                     qr_triggered=qr and coverage >= metrics_index.QR_TRIGGER_COVERAGE,
+                                     path=path)
+    return path
+
+
+def ids(rows):
+    return [r["record_id"] for r in rows]
+
+
+def test_epoch_accepts_iso_naive_and_numeric():
+    assert metrics_index._epoch("2024-01-01T00:00:00Z") == 1704067200
+    assert metrics_index._epoch("2024-01-01T08:00:00+08:00") == 1704067200
+    assert metrics_index._epoch("2024-01-01 00:00:00") == 1704067200
+    assert metrics_index._epoch(1704067200.7) == 1704067200
+
+
+def test_record_metrics_replaces_same_record(db):
+    metrics_index.record_metrics("r1", "p1", "2024-01-15T10:00:00Z", 50.0, 500, path=db)
+    rows = list(metrics_index.query(path=db, patient_id="p1"))
+    assert ids(rows) == ["r1", "r2"]
+    assert rows[0]["coverage"] == 50.0
+
+
+def test_query_filters(db):
+    assert ids(metrics_index.query(path=db, min_coverage=10, max_coverage=30)) == ["r2", "r3"]
+    assert ids(metrics_index.query(path=db, since="2024-02-01", until="2024-04-01T00:00:00Z")) == ["r2", "r3"]
+    assert ids(metrics_index.query(path=db, patient_id="p2")) == ["r3", "r4"]
+    assert ids(metrics_index.query(path=db, limit=1)) == ["r1"]
+
+
+def test_aggregate_by_patient_and_month(db):
+    by_patient = {g["grp"]: g for g in metrics_index.aggregate("patient", path=db)}
+    assert by_patient["p1"]["records"] == 2
+    assert by_patient["p1"]["mean_coverage"] == 10.0
+    assert by_patient["p2"]["max_coverage"] == 35.0
+    by_month = metrics_index.aggregate("month", path=db, min_coverage=10)
+    assert [(g["grp"], g["records"], g["qr_triggered"]) for g in by_month] == [
+        ("2024-02", 2, 2),
+        ("2024-04", 1, 0),
+    ]
+    with pytest.raises(ValueError):
+        metrics_index.aggregate("week", path=db)
@@ -0,0 +1,52 @@
+import pytest
+
+import plaque_trends
+
+
+@pytest.fixture(autouse=True)
+def trends_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(plaque_trends, "TRENDS_DIR", str(tmp_path))
+    return tmp_path
+
+
+def test_mixed_timestamp_formats_sort_chronologically():
+    plaque_trends.append_visit("p1", "r1", "2024-03-01T09:00:00+08:00", 12.0, 100)
+    plaque_trends.append_visit("p1", "r2", "2024-02-28T23:30:00Z", 10.0, 90)
+    history = plaque_trends.append_visit("p1", "r3", 1709251200, 8.0, 80)
+    assert [(v["record_id"], v["timestamp"]) for v in history] == [
+        ("r2", "2024-02-28T23:30:00+00:00"),
+        ("r3", "2024-03-01T00:00:00+00:00"),
+        ("r1", "2024-03-01T01:00:00+00:00"),
+    ]
+    assert plaque_trends.load_history("p1") == history
+
+
+def test_repeated_record_replaces_earlier_visit():
+    plaque_trends.append_visit("p1", "r1", "2024-01-01T00:00:00Z", 20.0, 200)
+    plaque_trends.append_visit("p1", "r2", "2024-02-01T00:00:00Z", 10.0, 100)
+    history = plaque_trends.append_visit("p1", "r1", "2024-01-01T00:00:00Z", 30.0, 300)
+    assert [(v["record_id"], v["coverage"]) for v in history] == [("r1", 30.0), ("r2", 10.0)]
+    summary = plaque_trends.load_summary("p1")
+    assert summary["count"] == 2
+    assert summary["coverage_max"] == 30.0
+    assert summary["coverage_mean"] == 20.0
+
+
+def test_legacy_naive_timestamps_are_read_as_utc(trends_dir):
+    (trends_dir / "p1.jsonl").write_text(
+        '{"record_id": "old", "timestamp": "2023-12-31 23:00:00", "coverage": 5.0, "plaque_pixels": 1}\n'
+        '{"record_id": "bad", "timestamp": "not a time", "coverage": 6.0, "plaque_pixels": 1}\n'
+        "garbage\n",
+        encoding="utf-8",
+    )
+    history = plaque_trends.append_visit("p1", "new", "2024-01-01T00:00:00Z", 4.0, 1)
+    assert [v["record_id"] for v in history] == ["old", "new", "bad"]
+    assert history[0]["timestamp"] == "2023-12-31T23:00:00+00:00"
+
+
+def test_invalid_input_is_rejected():
+    with pytest.raises(ValueError):
+        plaque_trends.append_visit("p1", "r1", "yesterday", 1.0, 1)
+    with pytest.raises(ValueError):
+        plaque_trends.append_visit("../..", "r1", None, 1.0, 1)
+    assert plaque_trends.load_history("p1") == []
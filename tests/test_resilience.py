@@ -0,0 +1,134 @@
+import time
+
+import pytest
+import requests
+
+import resilience
+
+
+def response(status, headers=None):
+    r = requests.Response()
+    r.status_code = status
+    r.headers.update(headers or {})
+    return r
+
+
+@pytest.fixture
+def upstream():
+    u = resilience.Upstream("test", "TEST_UPSTREAM")
+    u.max_retries = 3
+    u.backoff_base = 0
+    u.hedge_delay = 0
+    u.breaker = resilience.CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    return u
+
+
+def sequence(*outcomes):
+    calls = []
+
+    def fn():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return fn, calls
+
+
+def test_retryable_status_is_retried_until_success(upstream):
+    fn, calls = sequence(response(503), response(429), response(200))
+    assert upstream.call(fn).status_code == 200
+    assert len(calls) == 3
+    assert upstream.breaker.state == "closed"
+
+
+def test_last_retryable_response_is_returned(upstream):
+    upstream.breaker.failure_threshold = 10
+    fn, calls = sequence(response(502))
+    assert upstream.call(fn).status_code == 502
+    assert len(calls) == upstream.max_retries + 1
+
+
+def test_connection_errors_are_retried(upstream):
+    fn, calls = sequence(requests.exceptions.ConnectionError(), response(200))
+    assert upstream.call(fn).status_code == 200
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("error", [ValueError("bad"), KeyError("x"), FileNotFoundError("f")])
+def test_local_errors_are_not_retried_or_counted(upstream, error):
+    fn, calls = sequence(error)
+    with pytest.raises(type(error)):
+        upstream.call(fn)
+    assert len(calls) == 1
+    assert upstream.breaker._failures == 0
+
+
+def test_non_retryable_http_error_is_raised_once(upstream):
+    error = requests.exceptions.HTTPError(response=response(401))
+    fn, calls = sequence(error)
+    with pytest.raises(requests.exceptions.HTTPError):
+        upstream.call(fn)
+    assert len(calls) == 1
+
+
+def test_read_timeout_not_retried_when_disabled(upstream):
+    upstream.retry_read_timeouts = False
+    fn, calls = sequence(requests.exceptions.ReadTimeout())
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        upstream.call(fn)
+    assert len(calls) == 1
+
+
+def test_deadline_stops_retries(upstream):
+    upstream.backoff_base = 10
+    fn, calls = sequence(response(503))
+    assert upstream.call(fn, deadline=time.monotonic() + 0.01).status_code == 503
+    assert len(calls) == 1
+
+
+def test_retry_after_header_is_honoured(upstream):
+    assert resilience._retry_after(response(429, {"Retry-After": "2"})) == 2.0
+    assert upstream._backoff(1, retry_after=1000) == upstream.backoff_max
+
+
+def test_breaker_opens_and_fails_fast(upstream):
+    upstream.max_retries = 0
+    fn, calls = sequence(requests.exceptions.ConnectionError())
+    for _ in range(3):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            upstream.call(fn)
+    assert upstream.breaker.state == "open"
+    with pytest.raises(resilience.CircuitOpenError):
+        upstream.call(fn)
+    assert len(calls) == 3
+
+
+def test_half_open_probe_with_non_retryable_status_closes_breaker(upstream):
+    upstream.breaker._failures = 3
+    upstream.breaker._opened_at = time.monotonic() - 120
+    assert upstream.breaker.state == "half_open"
+    fn, _ = sequence(requests.exceptions.HTTPError(response=response(401)))
+    with pytest.raises(requests.exceptions.HTTPError):
+        upstream.call(fn)
+    assert upstream.breaker.state == "closed"
+    assert not upstream.breaker._probing
+
+
+def test_half_open_probe_released_after_local_error(upstream):
+    upstream.breaker._failures = 3
+    upstream.breaker._opened_at = time.monotonic() - 120
+    fn, _ = sequence(ValueError("bad"))
+    with pytest.raises(ValueError):
+        upstream.call(fn)
+    assert not upstream.breaker._probing
+    assert upstream.breaker.allow()
+
+
+def test_collect_sees_only_its_own_attempts(upstream):
+    fn, _ = sequence(response(200))
+    upstream.call(fn)
+    with resilience.collect() as attempts:
+        upstream.call(fn)
+    assert len(attempts) == 1
+    assert attempts[0]["upstream"] == "test"
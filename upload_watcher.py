@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+上傳目錄監看服務：照片一上傳就在背景先做分析與 AI 建議
+監看 public/<patientId>/ 的新照片（Linux 用 inotify，其他平台或 inotify 不可用時改為定期掃描），
+同一病人的照片寫入完成並靜止 WATCH_SETTLE_SECONDS 後，以 report_pipeline.PREPARE_STAGES
+（品質檢查、推論、分析、建議）處理；結果存在 image_dedup 的快取與 derivatives/ 衍生圖中，
+之後 GET /api/report/... 產生報告時會直接沿用，只剩產生 PDF
+
+用法：
+    python upload_watcher.py [--dir public] [--poll] [--backfill]
+"""
+import os
+import sys
+import json
+import time
+import select
+import struct
+import shutil
+import argparse
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+WATCH_DIR = os.getenv("WATCH_DIR", os.path.join(BASE_DIR, "public"))
+# 只預先處理報告會用到的照片欄位（multer 檔名為 <欄位>_<時間戳>.<副檔名>）
+WATCH_FIELDS = [f.strip() for f in os.getenv("WATCH_FIELDS", "FacePhoto").split(",") if f.strip()]
+# 預先產生建議的語言；第一個語言與推論一起處理，其餘語言沿用推論結果只補建議
+WATCH_LANGUAGES = [l.strip() for l in os.getenv("WATCH_LANGUAGES", os.getenv("REPORT_LANGUAGE", "en")).split(",")
+                   if l.strip()]
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "2"))
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "5"))
+WATCH_LOG = os.getenv("WATCH_LOG", os.path.join(BASE_DIR, "outputs", "watch_log.jsonl"))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tif", ".tiff", ".webp")
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def is_candidate(path):
+    name = os.path.basename(path)
+    return (name.lower().endswith(IMAGE_EXTENSIONS)
+            and any(name.startswith(f"{field}_") for field in WATCH_FIELDS)
+            and os.path.basename(os.path.dirname(path)) != "derivatives")
+
+
+def scan(root):
+    """目前所有候選照片 -> {path: (size, mtime_ns)}"""
+    found = {}
+    for entry in os.scandir(root) if os.path.isdir(root) else []:
+        if not entry.is_dir():
+            continue
+        for photo in os.scandir(entry.path):
+            if photo.is_file() and is_candidate(photo.path):
+                st = photo.stat()
+                found[photo.path] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+class InotifySource:
+    """以 ctypes 呼叫 libc 的 inotify；新建立的病人資料夾會自動加入監看"""
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.dirs = {}
+        self._watch(root, IN_CREATE | IN_MOVED_TO)
+        for entry in os.scandir(root):
+            if entry.is_dir():
+                self._watch(entry.path, IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    def _watch(self, path, mask):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        self.dirs[wd] = path
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，回傳寫入完成的檔案路徑；事件佇列溢位時回傳 None（呼叫端應重新掃描）"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        paths, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            folder = self.dirs.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if folder == self.root:
+                    self._watch(path, IN_CLOSE_WRITE | IN_MOVED_TO)
+                    # 監看建立之前就寫入的檔案
+                    paths.extend(os.path.join(path, n) for n in os.listdir(path))
+            elif folder != self.root:
+                paths.append(path)
+        return [p for p in paths if is_candidate(p)]
+
+
+class PollingSource:
+    """定期掃描；比較大小與修改時間找出新的（或被覆寫的）照片"""
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.seen = scan(root)
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = scan(self.root)
+        changed = [p for p, sig in current.items() if self.seen.get(p) != sig]
+        self.seen = current
+        return changed
+
+
+def prepare(paths):
+    """以 PREPARE_STAGES 處理一批照片（病人 id 取自資料夾名稱），回傳每張照片的結果"""
+    import report_pipeline
+    work_dir = tempfile.mkdtemp(prefix="watch_")
+    results = []
+    try:
+        for lang in WATCH_LANGUAGES:
+            jobs = [report_pipeline.new_job(path, lang=lang, patient_id=os.path.basename(os.path.dirname(path)),
+                                            out_dir=os.path.join(work_dir, f"{i}_{lang}"))
+                    for i, path in enumerate(paths)]
+            stages = report_pipeline.stages_for(report_pipeline.PREPARE_STAGES)
+            for path, result in zip(paths, report_pipeline.run_jobs(jobs, stages=stages)):
+                results.append({
+                    "image": path,
+                    "lang": lang,
+                    "ok": "error" not in result,
+                    "error": result.get("error"),
+                    "reused": bool((result.get("near_duplicate") or {}).get("reused")),
+                    "advice_source": (result.get("advice") or {}).get("source"),
+                    "timings_ms": result.get("timings_ms"),
+                    "at": int(time.time()),
+                })
+            # 推論失敗的照片不再嘗試其他語言
+            paths = [r["image"] for r in results[-len(paths):] if r["ok"]]
+            if not paths:
+                break
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(WATCH_LOG), exist_ok=True)
+    with open(WATCH_LOG, "a", encoding="utf-8") as f:
+        for r in results:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    return results
+
+
+def run(root=None, poll=False, backfill=False):
+    import image_dedup
+    root = root or WATCH_DIR
+    os.makedirs(root, exist_ok=True)
+    if not image_dedup.DEDUP_ENABLED:
+        print("[Watch] DEDUP_ENABLED=0: prepared results cannot be reused by report requests", file=sys.stderr)
+    source = None
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            source = InotifySource(root)
+            print(f"[Watch] inotify on {root}", file=sys.stderr)
+        except OSError as e:
+            print(f"[Watch] inotify unavailable ({e}); polling every {WATCH_POLL_SECONDS}s", file=sys.stderr)
+    if source is None:
+        source = PollingSource(root, WATCH_POLL_SECONDS)
+        print(f"[Watch] polling {root} every {WATCH_POLL_SECONDS}s", file=sys.stderr)
+
+    pending = {}
+    if backfill:
+        # 已存在的照片也處理一次（已分析過的會命中近似重複快取，不會重複呼叫 API）
+        pending = {path: time.monotonic() for path in scan(root)}
+    while True:
+        events = source.wait(WATCH_SETTLE_SECONDS / 2 if pending else WATCH_POLL_SECONDS)
+        now = time.monotonic()
+        if events is None:
+            print("[Watch] inotify queue overflow; rescanning", file=sys.stderr)
+            events = list(scan(root))
+        for path in events:
+            pending[path] = now
+        # 同一批上傳的照片寫入後靜止一段時間才處理
+        ready = [p for p, t in pending.items() if now - t >= WATCH_SETTLE_SECONDS]
+        if not ready:
+            continue
+        for path in ready:
+            del pending[path]
+        ready = [p for p in ready if os.path.exists(p)]
+        if ready:
+            started = time.perf_counter()
+            results = prepare(ready)
+            ok = sum(1 for r in results if r["ok"])
+            print(f"[Watch] prepared {ok}/{len(results)} (photo, language) in "
+                  f"{time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze uploaded photos as soon as they arrive")
+    parser.add_argument("--dir", default=None)
+    parser.add_argument("--poll", action="store_true", help="force polling instead of inotify")
+    parser.add_argument("--backfill", action="store_true", help="also process photos already on disk")
+    args = parser.parse_args(argv)
+    try:
+        run(args.dir, args.poll, args.backfill)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()